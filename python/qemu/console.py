@@ -0,0 +1,262 @@
+"""
+QEMU console module:
+
+The console module provides the ConsoleReader class, which reads the
+output of a guest console in large chunks and waits for any of several
+patterns to show up in it.
+"""
+
+# Copyright (C) 2019 Red Hat Inc.
+#
+# This work is licensed under the terms of the GNU GPL, version 2.  See
+# the COPYING file in the top-level directory.
+
+import re
+import select
+import time
+
+
+class ConsoleError(Exception):
+    """
+    Exception raised when the console is closed while waiting on it
+    """
+
+
+class ConsoleTimeoutError(ConsoleError):
+    """
+    Exception raised when no pattern is seen on the console in time
+    """
+
+
+class PatternMatcher(object):
+    """
+    Searches for any of several patterns at once
+
+    Literal patterns are compiled into a single alternation, so a buffer
+    is scanned once no matter how many of them are looked for.  Regular
+    expressions are searched for on their own, so that their flags and
+    group numbers stay as the caller wrote them.  The match that starts
+    first wins, or the pattern listed first if several start at the same
+    position.
+    """
+
+    def __init__(self, patterns):
+        """
+        @param patterns: sequence of patterns, each of them either a string
+                         or bytes to be matched literally, or a compiled
+                         bytes regular expression
+        """
+        self._literals = {}
+        self._regexes = []
+        for index, pattern in enumerate(patterns):
+            if hasattr(pattern, 'pattern'):
+                self._regexes.append((index, pattern))
+                continue
+            if not isinstance(pattern, bytes):
+                pattern = pattern.encode('utf-8')
+            self._literals.setdefault(pattern, index)
+        self._literal_regex = None
+        if self._literals:
+            # Alternatives are tried in order, as their patterns were listed
+            literals = sorted(self._literals, key=self._literals.get)
+            self._literal_regex = re.compile(
+                b'|'.join(re.escape(literal) for literal in literals))
+
+    def search(self, data, pos=0):
+        """
+        Search data starting at pos
+
+        @return a tuple (index, match) where index is the position of the
+                matching pattern in the pattern list, or None
+        """
+        found = None
+        if self._literal_regex is not None:
+            match = self._literal_regex.search(data, pos)
+            if match is not None:
+                found = self._literals[match.group(0)], match
+        for index, regex in self._regexes:
+            match = regex.search(data, pos)
+            if match is None:
+                continue
+            if found is None or (match.start(), index) < (found[1].start(),
+                                                          found[0]):
+                found = index, match
+        return found
+
+
+class ConsoleReader(object):
+    """
+    Buffered reader for a guest console
+
+    Data is read in chunks of up to chunk_size bytes and scanned once: a
+    match may span chunks as long as it fits in window bytes, and only the
+    last window bytes of unmatched output are kept in memory::
+
+        console = vm.console_reader()
+        index, match = console.wait_for(['login:', 'Kernel panic'],
+                                        timeout=120)
+    """
+
+    # Most chunks read by a single poll()
+    POLL_CHUNKS = 16
+
+    def __init__(self, sock, logfile=None, line_callback=None,
+                 chunk_size=65536, window=4096, encoding='utf-8'):
+        """
+        @param sock: connected console socket
+        @param logfile: path of a file, or file object opened in binary
+                        mode, receiving all the console output
+        @param line_callback: callable invoked with each complete line of
+                              output, decoded, without the newline
+        @param chunk_size: maximum size of a single read
+        @param window: longest text a pattern is expected to match
+        @param encoding: encoding of the lines passed to line_callback;
+                         undecodable bytes are replaced
+        """
+        self._sock = sock
+        self._chunk_size = chunk_size
+        self._window = window
+        self._buffer = b''
+        self._scanned = 0
+        self._partial_line = b''
+        self._line_callback = line_callback
+        self._encoding = encoding
+        # Anything that cannot be written to is a path, str or unicode
+        self._own_logfile = (logfile is not None and
+                             not hasattr(logfile, 'write'))
+        if self._own_logfile:
+            logfile = open(logfile, 'wb')
+        self._logfile = logfile
+        self._eof = False
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def _feed(self, data):
+        if self._logfile is not None:
+            self._logfile.write(data)
+        if self._line_callback is not None:
+            lines = (self._partial_line + data).split(b'\n')
+            self._partial_line = lines.pop()
+            for line in lines:
+                self._line_callback(line.rstrip(b'\r').decode(self._encoding,
+                                                              'replace'))
+        self._buffer += data
+
+    def _read(self, timeout):
+        """
+        Read one chunk, waiting at most timeout seconds (None: forever)
+
+        @return False if nothing was read before the timeout
+        """
+        readable, _, _ = select.select([self._sock], [], [], timeout)
+        if not readable:
+            return False
+        data = self._sock.recv(self._chunk_size)
+        if not data:
+            self._eof = True
+            return False
+        self._feed(data)
+        return True
+
+    def _scan(self, matcher):
+        # Rescan the tail of the previous data in case a match straddles
+        # the chunk boundary
+        start = max(0, self._scanned - self._window)
+        found = matcher.search(self._buffer, start)
+        if found is not None:
+            self._buffer = self._buffer[found[1].end():]
+            self._scanned = 0
+            return found
+        if len(self._buffer) > self._window:
+            self._buffer = self._buffer[-self._window:]
+        self._scanned = len(self._buffer)
+        return None
+
+    def poll(self, patterns):
+        """
+        Read whatever is available without blocking and look for patterns
+
+        This allows waiting on the console while doing something else,
+        such as processing QMP events.  At most POLL_CHUNKS chunks are
+        read per call, so that a guest printing continuously cannot keep
+        the caller here.
+
+        @param patterns: a sequence of patterns, or a PatternMatcher
+        @return a tuple (index, match) as for wait_for(), or None
+        """
+        if not isinstance(patterns, PatternMatcher):
+            patterns = PatternMatcher(patterns)
+        found = self._scan(patterns)
+        chunks = 0
+        while found is None and chunks < self.POLL_CHUNKS and self._read(0):
+            found = self._scan(patterns)
+            chunks += 1
+        return found
+
+    def wait_for(self, patterns, timeout=None, idle_timeout=None):
+        """
+        Wait until any of the patterns shows up on the console
+
+        Output up to the end of the match is consumed.
+
+        @param patterns: a sequence of patterns as accepted by
+                         PatternMatcher, or a PatternMatcher
+        @param timeout: maximum time to wait, in seconds.  None waits
+                        forever.
+        @param idle_timeout: maximum time to wait without any output, in
+                             seconds.  None waits forever.
+        @return a tuple (index, match) where index is the position of the
+                matching pattern in patterns, and match the re match object
+        @raise ConsoleTimeoutError if no pattern shows up in time, or the
+               console stays silent for idle_timeout seconds
+        @raise ConsoleError if the console is closed
+        """
+        if not isinstance(patterns, PatternMatcher):
+            patterns = PatternMatcher(patterns)
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while True:
+            found = self._scan(patterns)
+            if found is not None:
+                return found
+            if self._eof:
+                raise ConsoleError('Console closed')
+            remaining = None
+            if timeout is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise ConsoleTimeoutError('Timeout waiting for console '
+                                              'output')
+            idle = idle_timeout is not None and (remaining is None or
+                                                 idle_timeout < remaining)
+            if idle:
+                remaining = idle_timeout
+            if not self._read(remaining) and idle and not self._eof:
+                raise ConsoleTimeoutError('No console output for %s seconds'
+                                          % idle_timeout)
+
+    def tail(self):
+        """
+        Returns the unconsumed output kept in the window
+        """
+        return self._buffer
+
+    def send(self, data):
+        """
+        Send data to the console
+        """
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        self._sock.sendall(data)
+
+    def close(self):
+        """
+        Flush and close the log file, if any.  The socket is left open.
+        """
+        if self._logfile is not None:
+            if self._own_logfile:
+                self._logfile.close()
+            else:
+                self._logfile.flush()
+            self._logfile = None
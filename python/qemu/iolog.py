@@ -0,0 +1,205 @@
+"""
+QEMU output capture module:
+
+The iolog module provides the LogCapture class, which collects the
+output of a running QEMU process into a bounded in-memory ring buffer,
+optionally saving it to size-rotated files as well.
+"""
+
+# Copyright (C) 2019 Red Hat Inc.
+#
+# This work is licensed under the terms of the GNU GPL, version 2.  See
+# the COPYING file in the top-level directory.
+
+import collections
+import os
+import threading
+import time
+
+from .console import PatternMatcher
+
+
+class LogCaptureTimeoutError(Exception):
+    """
+    Exception raised when no pattern shows up in the output in time
+    """
+
+
+class LogCapture(object):
+    """
+    Collects the output read from a pipe in a background thread
+
+    Only the last max_bytes bytes are kept in memory.  The output can be
+    inspected with tail() and waited on with wait_for() while the process
+    is running.
+    """
+
+    #: Longest text a pattern passed to wait_for() is expected to match
+    window = 4096
+
+    def __init__(self, pipe, max_bytes=1024 * 1024, logfile=None,
+                 max_file_size=None, backup_count=1, chunk_size=65536):
+        """
+        @param pipe: file object the output is read from; it is closed when
+                     the end of the output is reached
+        @param max_bytes: size of the in-memory ring buffer
+        @param logfile: path of a file receiving all the output
+        @param max_file_size: rotate logfile once it reaches that size;
+                              None never rotates
+        @param backup_count: number of rotated files to keep, named
+                             logfile.1 (newest) to logfile.N (oldest)
+        @param chunk_size: maximum size of a single read
+        """
+        self._pipe = pipe
+        self._max_bytes = max_bytes
+        self._chunk_size = chunk_size
+        self._chunks = collections.deque()
+        self._size = 0
+        # Offset in the whole output of the first byte still buffered,
+        # and of the first byte not consumed by wait_for() yet
+        self._start = 0
+        self._cursor = 0
+        self._eof = False
+        # Exception that stopped the reader thread early, if any
+        self._error = None
+        self._cond = threading.Condition()
+        self._logfile_path = logfile
+        self._max_file_size = max_file_size
+        self._backup_count = backup_count
+        self._logfile = None
+        if logfile is not None:
+            self._logfile = open(logfile, 'wb')
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _rotate(self):
+        self._logfile.close()
+        for i in range(self._backup_count - 1, 0, -1):
+            src = '%s.%d' % (self._logfile_path, i)
+            if os.path.exists(src):
+                os.rename(src, '%s.%d' % (self._logfile_path, i + 1))
+        if self._backup_count > 0:
+            os.rename(self._logfile_path, self._logfile_path + '.1')
+        self._logfile = open(self._logfile_path, 'wb')
+
+    def _write_logfile(self, data):
+        if self._max_file_size is not None and \
+           self._logfile.tell() + len(data) > self._max_file_size:
+            self._rotate()
+        self._logfile.write(data)
+        self._logfile.flush()
+
+    def _run(self):
+        try:
+            fd = self._pipe.fileno()
+            while True:
+                data = os.read(fd, self._chunk_size)
+                if not data:
+                    break
+                if self._logfile is not None:
+                    self._write_logfile(data)
+                with self._cond:
+                    self._chunks.append(data)
+                    self._size += len(data)
+                    while self._size - len(self._chunks[0]) >= self._max_bytes:
+                        dropped = self._chunks.popleft()
+                        self._size -= len(dropped)
+                        self._start += len(dropped)
+                    self._cond.notify_all()
+        except Exception as err:
+            # Reading or logging failed; waiters re-raise the error
+            self._error = err
+        finally:
+            with self._cond:
+                self._eof = True
+                self._cond.notify_all()
+            self._pipe.close()
+            if self._logfile is not None:
+                self._logfile.close()
+
+    def _data_from(self, offset):
+        # Called with the lock held
+        offset = max(offset, self._start)
+        pieces = []
+        pos = self._start + self._size
+        for chunk in reversed(self._chunks):
+            if pos <= offset:
+                break
+            pieces.append(chunk)
+            pos -= len(chunk)
+        data = b''.join(reversed(pieces))
+        return offset, data[offset - pos:]
+
+    def getvalue(self):
+        """
+        Returns the buffered output
+
+        That is all of the output until it reaches max_bytes bytes.  After
+        that the output is dropped a whole read at a time, so between
+        max_bytes and max_bytes + chunk_size - 1 of the last bytes are
+        returned.
+        """
+        with self._cond:
+            return b''.join(self._chunks)
+
+    def tail(self, lines=10):
+        """
+        Returns the last lines of buffered output, decoded as UTF-8
+        """
+        data = self.getvalue()
+        text = data.decode('utf-8', 'replace')
+        return '\n'.join(text.splitlines()[-lines:])
+
+    def wait_for(self, patterns, timeout=None):
+        """
+        Wait until any of the patterns shows up in the output
+
+        Output up to the end of the match is consumed, so that successive
+        calls find successive occurrences.  Output that was dropped from
+        the ring buffer before being searched is not seen.
+
+        @param patterns: a sequence of patterns as accepted by
+                         console.PatternMatcher, or a PatternMatcher
+        @param timeout: maximum time to wait, in seconds.  None waits
+                        forever.
+        @return a tuple (index, match) as for console.ConsoleReader
+        @raise LogCaptureTimeoutError if no pattern shows up in time or the
+               output ends
+        @raise the exception that stopped reading the output, if reading
+               or writing the log file failed
+        """
+        if not isinstance(patterns, PatternMatcher):
+            patterns = PatternMatcher(patterns)
+        if timeout is not None:
+            deadline = time.time() + timeout
+        with self._cond:
+            scanned = self._cursor
+            while True:
+                # Rescan the tail of the data already searched in case a
+                # match straddles two chunks
+                start = max(self._cursor, scanned - self.window)
+                offset, data = self._data_from(start)
+                found = patterns.search(data)
+                if found is not None:
+                    self._cursor = offset + found[1].end()
+                    return found
+                scanned = offset + len(data)
+                if self._eof:
+                    if self._error is not None:
+                        raise self._error
+                    raise LogCaptureTimeoutError('Output ended')
+                remaining = None
+                if timeout is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise LogCaptureTimeoutError('Timeout waiting for '
+                                                     'output')
+                self._cond.wait(remaining)
+
+    def close(self):
+        """
+        Wait for the end of the output, which happens when the process
+        exits
+        """
+        self._thread.join()
@@ -17,14 +17,23 @@ which provides facilities for managing the lifetime of a QEMU VM.
 # Based on qmp.py.
 #
 
+import array
+import collections
+import ctypes
 import errno
 import logging
+import mmap
 import os
+import select
 import subprocess
 import shutil
 import socket
 import tempfile
+import threading
+import time
 
+from . import console
+from . import iolog
 from . import qmp
 
 LOG = logging.getLogger(__name__)
@@ -45,6 +54,22 @@ class QEMUMachineAddDeviceError(QEMUMachineError):
     """
 
 
+class QEMUMachineLaunchError(QEMUMachineError):
+    """
+    Exception raised by launch_many() when some of the VMs failed to start
+
+    @ivar failures: list of (machine, exception) tuples for the failed VMs
+    @ivar timings: list of startup timings, as returned by launch_many()
+    """
+    def __init__(self, failures, timings):
+        desc = '; '.join('%s: %s' % (machine._name, err)
+                         for machine, err in failures)
+        super(QEMUMachineLaunchError, self).__init__(
+            '%d VM(s) failed to launch: %s' % (len(failures), desc))
+        self.failures = failures
+        self.timings = timings
+
+
 class MonitorResponseError(qmp.QMPError):
     """
     Represents erroneous QMP monitor reply
@@ -58,6 +83,406 @@ class MonitorResponseError(qmp.QMPError):
         self.reply = reply
 
 
+class QEMUEventSubscription(object):
+    """
+    A queue receiving the QMP events that match a set of filters
+
+    Subscriptions are created with QEMUMachine.subscribe().  Every event read
+    from the monitor is dispatched once, as it is read, to all the matching
+    subscriptions, so events emitted between the subscription and a later
+    get() are never lost.  Use the object as a context manager to make sure
+    it is unsubscribed::
+
+        with vm.subscribe('BLOCK_JOB_READY', {'data': {'device': 'job0'}}) as sub:
+            vm.command('drive-mirror', ...)
+            event = sub.get(timeout=10.0)
+    """
+
+    def __init__(self, machine, events):
+        self._machine = machine
+        self._filters = list(events)
+        self._queue = collections.deque()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+    def __len__(self):
+        return len(self._queue)
+
+    def matches(self, event):
+        """
+        Check whether an event is accepted by any of the filters
+        """
+        for name, match in self._filters:
+            if name is not None and event['event'] != name:
+                continue
+            if callable(match):
+                if match(event):
+                    return True
+            elif QEMUMachine.event_match(event, match):
+                return True
+        return False
+
+    def put(self, event):
+        """
+        Queue an event, normally called when dispatching
+        """
+        self._queue.append(event)
+
+    def get(self, timeout=60.0):
+        """
+        Return the oldest queued event, waiting for one if needed
+
+        @param timeout: maximum time to wait, in seconds.  None waits
+                        forever.
+        @raise QMPTimeoutError if no matching event arrives in time
+        """
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while not self._queue:
+            if timeout is None:
+                wait = True
+            else:
+                wait = deadline - time.time()
+                if wait <= 0:
+                    raise qmp.QMPTimeoutError("Timeout waiting for event")
+            self._machine.dispatch_events(wait=wait)
+        return self._queue.popleft()
+
+    def get_nowait(self):
+        """
+        Return the oldest queued event, or None if there is none
+        """
+        if not self._queue:
+            self._machine.dispatch_events()
+        if self._queue:
+            return self._queue.popleft()
+        return None
+
+    def close(self):
+        """
+        Stop receiving events.  Events still queued are dropped.
+        """
+        self._machine.unsubscribe(self)
+        self._queue.clear()
+
+
+class GuestMemory(object):
+    """
+    Direct access to guest RAM shared with QEMU, indexed by guest physical
+    address
+
+    Obtained from QEMUMachine.guest_memory().  Reads and writes go straight
+    to the memory mapped RAM backend, without involving the monitor.
+    Indexing and slicing work as for a bytearray, except that addresses are
+    guest physical addresses and slices must stay within one RAM region.
+    A slice with no end extends to the end of the region it starts in::
+
+        mem = vm.guest_memory()
+        mem[0x1000:0x1004] = b'\\x01\\x02\\x03\\x04'
+        header = mem.view(0x100000, 4096)
+    """
+
+    def __init__(self, path, size, regions):
+        self._file = open(path, 'r+b')
+        self._map = mmap.mmap(self._file.fileno(), size, mmap.MAP_SHARED)
+        self._regions = sorted(regions)
+
+    def _offset(self, addr, size):
+        for gpa, length, offset in self._regions:
+            if gpa <= addr and addr + size <= gpa + length:
+                return offset + addr - gpa
+        raise IndexError('guest range 0x%x+0x%x is not backed by a single '
+                         'RAM region' % (addr, size))
+
+    def _region_end(self, addr):
+        for gpa, length, offset in self._regions:
+            if gpa <= addr < gpa + length:
+                return gpa + length
+        raise IndexError('guest address 0x%x is not backed by a RAM region'
+                         % addr)
+
+    def _slice(self, key):
+        if isinstance(key, slice):
+            if key.step not in (None, 1):
+                raise IndexError('guest memory slices cannot have a step')
+            start = key.start
+            if start is None:
+                start = 0
+            stop = key.stop
+            if stop is None:
+                stop = self._region_end(start)
+            size = max(stop - start, 0)
+            offset = self._offset(start, size)
+            return slice(offset, offset + size)
+        return self._offset(key, 1)
+
+    def __getitem__(self, key):
+        return self._map[self._slice(key)]
+
+    def __setitem__(self, key, value):
+        self._map[self._slice(key)] = value
+
+    def read(self, addr, size):
+        """
+        Read size bytes at guest physical address addr
+        """
+        offset = self._offset(addr, size)
+        return self._map[offset:offset + size]
+
+    def write(self, addr, data):
+        """
+        Write data at guest physical address addr
+        """
+        offset = self._offset(addr, len(data))
+        self._map[offset:offset + len(data)] = data
+
+    def view(self, addr, size):
+        """
+        Return a writable memoryview of guest memory, without copying it.
+        It must be released before close() is called.
+        """
+        offset = self._offset(addr, size)
+        try:
+            return memoryview(self._map)[offset:offset + size]
+        except TypeError:
+            # Python 2 mmap objects only have the old buffer interface
+            array = (ctypes.c_char * size).from_buffer(self._map, offset)
+            return memoryview(array)
+
+    def close(self):
+        """
+        Unmap the guest memory
+        """
+        self._map.close()
+        self._file.close()
+
+
+class QEMUResourceSampler(object):
+    """
+    Periodically samples the host resources used by a running VM
+
+    Every interval seconds a background thread records, from /proc, the
+    CPU time of the QEMU process and of each of its threads, its RSS and
+    PSS, its context switches and its I/O byte counts.  Samples are kept
+    in compact arrays, one per metric.  vCPU threads are identified with
+    QMP when the sampler is started::
+
+        with vm.resource_sampler(interval=0.5) as sampler:
+            run_workload()
+        assert sampler.summary()['rss']['max'] < 512 * 1024 * 1024
+    """
+
+    #: Per-process metrics, all of them cumulative except rss and pss
+    METRICS = ('time', 'cpu', 'rss', 'pss', 'voluntary_ctxt_switches',
+               'nonvoluntary_ctxt_switches', 'read_bytes', 'write_bytes')
+
+    def __init__(self, machine, interval=1.0):
+        self._machine = machine
+        self._interval = interval
+        self._pid = None
+        self._ticks = float(os.sysconf(os.sysconf_names['SC_CLK_TCK']))
+        self._samples = dict((m, array.array('d')) for m in self.METRICS)
+        self._thread_cpu = {}
+        self._thread_names = {}
+        self._vcpus = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+        return False
+
+    def _map_vcpus(self):
+        try:
+            cpus = self._machine.command('query-cpus-fast')
+            self._vcpus = dict((cpu['thread-id'], cpu['cpu-index'])
+                               for cpu in cpus)
+        except MonitorResponseError:
+            cpus = self._machine.command('query-cpus')
+            self._vcpus = dict((cpu['thread_id'], cpu['CPU'])
+                               for cpu in cpus)
+
+    def _stat_cpu(self, path):
+        with open(path, 'r') as stat:
+            # The command name may contain spaces, skip past it
+            fields = stat.read().rsplit(')', 1)[1].split()
+        # utime and stime are fields 14 and 15 of the stat file
+        return (int(fields[11]) + int(fields[12])) / self._ticks
+
+    @staticmethod
+    def _read_fields(path, fields):
+        values = dict((field, float('nan')) for field in fields)
+        try:
+            with open(path, 'r') as data:
+                for line in data:
+                    key, _, value = line.partition(':')
+                    if key in values:
+                        values[key] = float(value.split()[0])
+        except (IOError, OSError):
+            pass
+        return values
+
+    def sample(self):
+        """
+        Take one sample now
+
+        Everything is read before anything is recorded, so that a sample
+        that fails part-way is dropped as a whole and all arrays keep the
+        same length.
+        """
+        proc = '/proc/%d' % self._pid
+        values = {'time': time.time(),
+                  'cpu': self._stat_cpu(proc + '/stat')}
+        status = self._read_fields(proc + '/status',
+                                   ('VmRSS', 'voluntary_ctxt_switches',
+                                    'nonvoluntary_ctxt_switches'))
+        values['rss'] = status.pop('VmRSS') * 1024
+        values.update(status)
+        values['pss'] = self._read_fields(proc + '/smaps_rollup',
+                                          ('Pss',))['Pss'] * 1024
+        values.update(self._read_fields(proc + '/io',
+                                        ('read_bytes', 'write_bytes')))
+        threads = {}
+        for tid in os.listdir(proc + '/task'):
+            try:
+                threads[int(tid)] = self._stat_cpu('%s/task/%s/stat' %
+                                                   (proc, tid))
+            except (IOError, OSError):
+                # The thread exited in the meantime
+                continue
+        names = {}
+        for tid in threads:
+            if tid in self._thread_cpu:
+                continue
+            try:
+                with open('%s/task/%d/comm' % (proc, tid), 'r') as comm:
+                    names[tid] = comm.read().strip()
+            except (IOError, OSError):
+                names[tid] = None
+
+        index = len(self._samples['time'])
+        for metric in self.METRICS:
+            self._samples[metric].append(values[metric])
+        for tid, cpu in threads.items():
+            samples = self._thread_cpu.get(tid)
+            if samples is None:
+                samples = array.array('d', [float('nan')] * index)
+                self._thread_cpu[tid] = samples
+                self._thread_names[tid] = names[tid]
+            samples.append(cpu)
+        # Threads that went away get a gap
+        for samples in self._thread_cpu.values():
+            if len(samples) == index:
+                samples.append(float('nan'))
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            try:
+                self.sample()
+            except (IOError, OSError):
+                # The sample is dropped; stop only if QEMU exited
+                if not self._machine.is_running():
+                    break
+
+    def start(self):
+        """
+        Identify the vCPU threads and start sampling in the background
+        """
+        self._pid = self._machine.get_pid()
+        if self._pid is None:
+            raise QEMUMachineError('VM is not running')
+        self._map_vcpus()
+        self.sample()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop sampling, taking a last sample if QEMU is still running
+        """
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        try:
+            self.sample()
+        except (IOError, OSError):
+            pass
+
+    def samples(self, metric):
+        """
+        Returns the array of samples of one of the METRICS
+        """
+        return self._samples[metric]
+
+    def thread_samples(self):
+        """
+        Returns a dict mapping thread ids to the array of their cumulative
+        CPU time samples, NaN where the thread did not exist
+        """
+        return self._thread_cpu
+
+    @staticmethod
+    def _delta(samples):
+        valid = [value for value in samples if value == value]
+        if not valid:
+            return None
+        return valid[-1] - valid[0]
+
+    @staticmethod
+    def _gauge(samples):
+        valid = [value for value in samples if value == value]
+        if not valid:
+            return None
+        return {'min': min(valid), 'max': max(valid),
+                'mean': sum(valid) / len(valid)}
+
+    def summary(self):
+        """
+        Returns a dict summarizing the samples taken so far
+
+        CPU times are in seconds, utilization in CPUs (1.0 being one host
+        CPU fully busy), sizes in bytes.  Counters are given as the
+        difference between the first and the last sample.
+        """
+        times = self._samples['time']
+        if len(times) < 2:
+            raise QEMUMachineError('Not enough samples')
+        duration = times[-1] - times[0]
+        cpu = self._delta(self._samples['cpu'])
+        threads = {}
+        for tid, samples in self._thread_cpu.items():
+            thread_cpu = self._delta(samples)
+            threads[tid] = {'name': self._thread_names[tid],
+                            'vcpu': self._vcpus.get(tid),
+                            'cpu': thread_cpu,
+                            'utilization': (thread_cpu or 0) / duration}
+        result = {'duration': duration,
+                  'samples': len(times),
+                  'cpu': cpu,
+                  'utilization': cpu / duration,
+                  'rss': self._gauge(self._samples['rss']),
+                  'pss': self._gauge(self._samples['pss']),
+                  'threads': threads}
+        for metric in ('voluntary_ctxt_switches',
+                       'nonvoluntary_ctxt_switches',
+                       'read_bytes', 'write_bytes'):
+            result[metric] = self._delta(self._samples[metric])
+        return result
+
+
 class QEMUMachine(object):
     """
     A QEMU VM
@@ -95,6 +520,11 @@ class QEMUMachine(object):
         self._vm_monitor = None
         self._qemu_log_path = None
         self._qemu_log_file = None
+        self._log_capture_args = None
+        self._log_capture = None
+        self._shared_memory = None
+        self._shared_memory_file = None
+        self._guest_memory = None
         self._popen = None
         self._binary = binary
         self._args = list(args)     # Force copy args in case we modify them
@@ -112,6 +542,11 @@ class QEMUMachine(object):
         self._console_device_type = None
         self._console_address = None
         self._console_socket = None
+        self._console_reader = None
+        self._qmp_instrumentation = None
+        self._qmp_codec = None
+        self._subscriptions = []
+        self._launch_timing = None
 
         # just in case logging wasn't configured by the main script:
         logging.basicConfig()
@@ -219,7 +654,11 @@ class QEMUMachine(object):
         return self._popen.pid
 
     def _load_io_log(self):
-        if self._qemu_log_path is not None:
+        if self._log_capture is not None:
+            self._log_capture.close()
+            self._iolog = self._log_capture.getvalue().decode('utf-8',
+                                                              'replace')
+        elif self._qemu_log_path is not None:
             with open(self._qemu_log_path, "r") as iolog:
                 self._iolog = iolog.read()
 
@@ -246,8 +685,34 @@ class QEMUMachine(object):
             else:
                 device = '%s,chardev=console' % self._console_device_type
                 args.extend(['-device', device])
+        if self._shared_memory is not None:
+            size = self._shared_memory['size']
+            if '-m' not in self._args:
+                args.extend(['-m', '%dM' % (size >> 20)])
+            args.extend(['-object',
+                         'memory-backend-file,id=shmem0,size=%d,'
+                         'mem-path=%s,share=on' %
+                         (size, self._shared_memory_path())])
+            if '-numa' not in self._args:
+                args.extend(['-numa', 'node,memdev=shmem0'])
         return args
 
+    def _shared_memory_path(self):
+        """
+        Returns the path of the file backing guest RAM
+        """
+        if self._shared_memory['path'] is not None:
+            return self._shared_memory['path']
+        if self._shared_memory_file is None:
+            # tmpfs if available, so that guest RAM never hits the disk
+            directory = self._temp_dir
+            if os.path.isdir('/dev/shm'):
+                directory = '/dev/shm'
+            fd, self._shared_memory_file = tempfile.mkstemp(
+                prefix=self._name + '-ram-', dir=directory)
+            os.close(fd)
+        return self._shared_memory_file
+
     def _pre_launch(self):
         self._temp_dir = tempfile.mkdtemp(dir=self._test_dir)
         if self._monitor_address is not None:
@@ -255,11 +720,15 @@ class QEMUMachine(object):
         else:
             self._vm_monitor = os.path.join(self._temp_dir,
                                             self._name + "-monitor.sock")
-        self._qemu_log_path = os.path.join(self._temp_dir, self._name + ".log")
-        self._qemu_log_file = open(self._qemu_log_path, 'wb')
+        if self._log_capture_args is None:
+            self._qemu_log_path = os.path.join(self._temp_dir,
+                                               self._name + ".log")
+            self._qemu_log_file = open(self._qemu_log_path, 'wb')
 
-        self._qmp = qmp.QEMUMonitorProtocol(self._vm_monitor,
-                                            server=True)
+        self._qmp = qmp.QEMUMonitorProtocol(
+            self._vm_monitor, server=True,
+            instrumentation=self._qmp_instrumentation,
+            codec=self._qmp_codec)
 
     def _post_launch(self):
         self._qmp.accept()
@@ -270,6 +739,19 @@ class QEMUMachine(object):
             self._qemu_log_file = None
 
         self._qemu_log_path = None
+        self._log_capture = None
+
+        if self._guest_memory is not None:
+            self._guest_memory.close()
+            self._guest_memory = None
+
+        if self._shared_memory_file is not None:
+            os.remove(self._shared_memory_file)
+            self._shared_memory_file = None
+
+        if self._console_reader is not None:
+            self._console_reader.close()
+            self._console_reader = None
 
         if self._console_socket is not None:
             self._console_socket.close()
@@ -294,31 +776,72 @@ class QEMUMachine(object):
             self._launch()
             self._launched = True
         except:
-            self.shutdown()
-
-            LOG.debug('Error launching VM')
-            if self._qemu_full_args:
-                LOG.debug('Command: %r', ' '.join(self._qemu_full_args))
-            if self._iolog:
-                LOG.debug('Output: %r', self._iolog)
+            self._launch_failed()
             raise
 
+    def _launch_failed(self):
+        self.shutdown()
+
+        LOG.debug('Error launching VM')
+        if self._qemu_full_args:
+            LOG.debug('Command: %r', ' '.join(self._qemu_full_args))
+        if self._iolog:
+            LOG.debug('Output: %r', self._iolog)
+
     def _launch(self):
         """
         Launch the VM and establish a QMP connection
         """
+        self._spawn()
+        self._connect()
+
+    def _spawn(self):
+        """
+        Start the QEMU process, without waiting for it to connect
+        """
+        self._launch_timing = {'start': time.time()}
         devnull = open(os.path.devnull, 'rb')
         self._pre_launch()
         self._qemu_full_args = (self._wrapper + [self._binary] +
                                 self._base_args() + self._args)
         LOG.debug('VM launch command: %r', ' '.join(self._qemu_full_args))
+        if self._log_capture_args is None:
+            stdout = self._qemu_log_file
+        else:
+            stdout = subprocess.PIPE
         self._popen = subprocess.Popen(self._qemu_full_args,
                                        stdin=devnull,
-                                       stdout=self._qemu_log_file,
+                                       stdout=stdout,
                                        stderr=subprocess.STDOUT,
                                        shell=False,
                                        close_fds=False)
+        if self._log_capture_args is not None:
+            self._log_capture = iolog.LogCapture(self._popen.stdout,
+                                                 **self._log_capture_args)
+        self._launch_timing['spawned'] = time.time()
+
+    def _connect(self):
+        """
+        Wait for the QEMU process started by _spawn() to connect
+        """
         self._post_launch()
+        self._launch_timing['ready'] = time.time()
+
+    def get_launch_timing(self):
+        """
+        Returns how long the last launch took, or None if it did not
+        complete
+
+        The result is a dict with the time spent in seconds starting the
+        QEMU process ('spawn'), waiting for it to connect and complete QMP
+        negotiation ('connect'), and overall ('total').
+        """
+        timing = self._launch_timing
+        if timing is None or 'ready' not in timing:
+            return None
+        return {'spawn': timing['spawned'] - timing['start'],
+                'connect': timing['ready'] - timing['spawned'],
+                'total': timing['ready'] - timing['start']}
 
     def wait(self):
         """
@@ -382,19 +905,81 @@ class QEMUMachine(object):
             raise MonitorResponseError(reply)
         return reply["return"]
 
+    def _dispatch_event(self, event):
+        """
+        Hand an event over to the matching subscriptions, returning
+        True if at least one of them took it
+        """
+        taken = False
+        for subscription in self._subscriptions:
+            if subscription.matches(event):
+                subscription.put(event)
+                taken = True
+        return taken
+
+    def dispatch_events(self, wait=False):
+        """
+        Read the pending QMP events and dispatch them to the subscriptions.
+        Events not taken by any subscription are kept for get_qmp_events().
+
+        @param wait: see QEMUMonitorProtocol.get_events()
+        """
+        for event in self._qmp.get_events(wait=wait):
+            if not self._dispatch_event(event):
+                self._events.append(event)
+        self._qmp.clear_events()
+
+    def subscribe(self, name=None, match=None, events=None):
+        """
+        Subscribe to QMP events
+
+        Returns a QEMUEventSubscription receiving all the subsequent
+        events that match either the (name, match) pair or any of the
+        pairs in events.  A name of None accepts any event name, and
+        match may be either match criteria as in event_match() or a
+        callable taking the event and returning a bool.
+
+        @param name: the event name
+        @param match: match criteria or predicate for that event
+        @param events: a sequence of (name, match) tuples, used instead
+                       of name and match
+        """
+        if events is None:
+            events = [(name, match)]
+        subscription = QEMUEventSubscription(self, events)
+        self._subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """
+        Remove a subscription created by subscribe()
+        """
+        if subscription in self._subscriptions:
+            self._subscriptions.remove(subscription)
+
     def get_qmp_event(self, wait=False):
         """
         Poll for one queued QMP events and return it
         """
         if self._events:
             return self._events.pop(0)
-        return self._qmp.pull_event(wait=wait)
+        if isinstance(wait, float):
+            deadline = time.time() + wait
+        while True:
+            event = self._qmp.pull_event(wait=wait)
+            if event is None or not self._dispatch_event(event):
+                return event
+            if isinstance(wait, float) and wait:
+                wait = deadline - time.time()
+                if wait <= 0:
+                    raise qmp.QMPTimeoutError("Timeout waiting for event")
 
     def get_qmp_events(self, wait=False):
         """
         Poll for queued QMP events and return a list of dicts
         """
-        events = self._qmp.get_events(wait=wait)
+        events = [event for event in self._qmp.get_events(wait=wait)
+                  if not self._dispatch_event(event)]
         events.extend(self._events)
         del self._events[:]
         self._qmp.clear_events()
@@ -438,7 +1023,7 @@ class QEMUMachine(object):
         event_wait waits for and returns a named event from QMP with a timeout.
 
         name: The event to wait for.
-        timeout: QEMUMonitorProtocol.pull_event timeout parameter.
+        timeout: maximum time to wait, in seconds.
         match: Optional match criteria. See event_match for details.
         """
         return self.events_wait([(name, match)], timeout)
@@ -450,36 +1035,50 @@ class QEMUMachine(object):
         events: a sequence of (name, match_criteria) tuples.
                 The match criteria are optional and may be None.
                 See event_match for details.
-        timeout: QEMUMonitorProtocol.pull_event timeout parameter.
+        timeout: maximum time to wait, in seconds.
         """
-        def _match(event):
-            for name, match in events:
-                if event['event'] == name and self.event_match(event, match):
-                    return True
-            return False
-
-        # Search cached events
-        for event in self._events:
-            if _match(event):
-                self._events.remove(event)
-                return event
-
-        # Poll for new events
-        while True:
-            event = self._qmp.pull_event(wait=timeout)
-            if _match(event):
-                return event
-            self._events.append(event)
+        with self.subscribe(events=events) as subscription:
+            # Search cached events
+            for event in self._events:
+                if subscription.matches(event):
+                    self._events.remove(event)
+                    return event
 
-        return None
+            return subscription.get(timeout=timeout)
 
     def get_log(self):
         """
         After self.shutdown or failed qemu execution, this returns the output
         of the qemu process.
+
+        With set_log_capture(), only the last max_bytes bytes are returned.
         """
         return self._iolog
 
+    def set_log_capture(self, max_bytes=1024 * 1024, logfile=None,
+                        max_file_size=None, backup_count=1):
+        """
+        Capture the output of QEMU through a pipe while it runs
+
+        Instead of being written to a file and read back after shutdown,
+        the output goes to an in-memory ring buffer which can be inspected
+        at any time through log_capture(), and optionally to size-rotated
+        files.  See iolog.LogCapture for the meaning of the arguments.
+        Takes effect on the next launch.
+        """
+        self._log_capture_args = {'max_bytes': max_bytes,
+                                  'logfile': logfile,
+                                  'max_file_size': max_file_size,
+                                  'backup_count': backup_count}
+
+    def log_capture(self):
+        """
+        Returns the iolog.LogCapture collecting the output of the running
+        QEMU process, or None if set_log_capture() was not used or the VM
+        is not running.
+        """
+        return self._log_capture
+
     def add_args(self, *args):
         """
         Adds to the list of extra arguments to be given to the QEMU binary
@@ -495,6 +1094,29 @@ class QEMUMachine(object):
         """
         self._machine = machine_type
 
+    def set_qmp_instrumentation(self, instrumentation):
+        """
+        Sets the instrumentation notified of QMP commands and events
+
+        @param instrumentation: a qmp.QMPInstrumentation instance, such as
+                                a qmp.QMPLatencyRecorder, or None to
+                                disable instrumentation.
+        """
+        self._qmp_instrumentation = instrumentation
+        if self._qmp is not None:
+            self._qmp.set_instrumentation(instrumentation)
+
+    def set_qmp_codec(self, codec):
+        """
+        Sets the JSON codec used on the QMP monitor
+
+        Only takes effect on the next launch.
+
+        @param codec: a qmp.QMPCodec instance, as returned by
+                      qmp.get_codec(), or None for the standard json module.
+        """
+        self._qmp_codec = codec
+
     def set_console(self, device_type=None):
         """
         Sets the device type for a console device
@@ -530,3 +1152,137 @@ class QEMUMachine(object):
                                                  socket.SOCK_STREAM)
             self._console_socket.connect(self._console_address)
         return self._console_socket
+
+    def set_shared_memory(self, size, path=None, regions=None):
+        """
+        Back guest RAM with memory shared with this process
+
+        Guest RAM is given to QEMU as a NUMA node backed by a shared
+        memory-backend-file object with id "shmem0", which guest_memory()
+        maps once the VM is launched.  The machine type must support -numa.
+        The -m and -numa options are only added if the VM arguments do not
+        have their own, which must then agree with size and use shmem0.
+
+        @param size: guest RAM size in bytes, a multiple of 1 MiB
+        @param path: the file to use, for example on hugetlbfs.  By default
+                     a file is created in /dev/shm, or in the VM temporary
+                     directory if there is no /dev/shm, and removed on
+                     shutdown.
+        @param regions: list of (guest physical address, length, offset)
+                        tuples describing where RAM appears in the guest
+                        address space, for machines that split it.  The
+                        default is a single region at address 0.
+        """
+        if size % (1 << 20):
+            raise QEMUMachineError('Shared memory size must be a multiple '
+                                   'of 1 MiB')
+        if regions is None:
+            regions = [(0, size, 0)]
+        self._shared_memory = {'size': size, 'path': path,
+                               'regions': regions}
+
+    def guest_memory(self):
+        """
+        Returns a GuestMemory giving direct access to the guest RAM of the
+        running VM, as configured with set_shared_memory()
+        """
+        if self._shared_memory is None:
+            raise QEMUMachineError('Shared memory is not enabled')
+        if not self._launched:
+            raise QEMUMachineError('VM not launched')
+        if self._guest_memory is None:
+            self._guest_memory = GuestMemory(self._shared_memory_path(),
+                                             self._shared_memory['size'],
+                                             self._shared_memory['regions'])
+        return self._guest_memory
+
+    def resource_sampler(self, interval=1.0):
+        """
+        Returns a QEMUResourceSampler for the running VM, to be started
+        with its start() method or used as a context manager
+
+        @param interval: time between samples, in seconds
+        """
+        return QEMUResourceSampler(self, interval)
+
+    def console_reader(self, logfile=None, line_callback=None,
+                       encoding='utf-8'):
+        """
+        Returns a console.ConsoleReader reading from the console socket
+
+        The reader is created on the first call, with the given arguments,
+        and returned as is by later calls.  See console.ConsoleReader for
+        the meaning of the arguments.
+        """
+        if self._console_reader is None:
+            self._console_reader = console.ConsoleReader(
+                self.console_socket, logfile=logfile,
+                line_callback=line_callback, encoding=encoding)
+        return self._console_reader
+
+
+def launch_many(machines, timeout=15.0):
+    """
+    Launch several VMs concurrently
+
+    All the QEMU processes are started first, then their QMP connections
+    are accepted as they come in, so the startup latency of the VMs
+    overlaps instead of adding up.
+
+    @param machines: sequence of QEMUMachine objects, not launched yet
+    @param timeout: time given to all the VMs to connect, in seconds
+    @return a list with the get_launch_timing() result of each machine, in
+            the same order as machines
+    @raise QEMUMachineLaunchError if any of the VMs failed to start.  The
+           VMs that did start are left running and must be shut down by
+           the caller as usual.
+    """
+    for machine in machines:
+        if machine._launched:
+            raise QEMUMachineError('VM already launched')
+
+    failures = []
+    pending = {}
+    for machine in machines:
+        machine._iolog = None
+        machine._qemu_full_args = None
+        try:
+            machine._spawn()
+        except Exception as err:
+            machine._launch_failed()
+            failures.append((machine, err))
+            continue
+        pending[machine._qmp.get_sock_fd()] = machine
+
+    deadline = time.time() + timeout
+    while pending:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        # Wake up regularly to notice processes that exited early
+        readable, _, _ = select.select(list(pending), [], [],
+                                       min(remaining, 0.5))
+        for fd in readable:
+            machine = pending.pop(fd)
+            try:
+                machine._connect()
+                machine._launched = True
+            except Exception as err:
+                machine._launch_failed()
+                failures.append((machine, err))
+        for fd, machine in list(pending.items()):
+            if not machine.is_running():
+                del pending[fd]
+                machine._launch_failed()
+                failures.append((machine, QEMUMachineError(
+                    'QEMU exited with code %s' % machine.exitcode())))
+
+    for machine in pending.values():
+        machine._launch_failed()
+        failures.append((machine, QEMUMachineError(
+            'Timeout waiting for QMP connection')))
+
+    timings = [machine.get_launch_timing() for machine in machines]
+    if failures:
+        raise QEMUMachineLaunchError(failures, timings)
+    return timings
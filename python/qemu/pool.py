@@ -0,0 +1,187 @@
+"""
+QEMU machine pool module:
+
+The pool module provides the QEMUMachinePool class, which keeps a
+number of paused QEMU VMs started in advance so that tests do not pay
+the QEMU startup cost when they need a VM.
+"""
+
+# Copyright (C) 2019 Red Hat Inc.
+#
+# This work is licensed under the terms of the GNU GPL, version 2.  See
+# the COPYING file in the top-level directory.
+
+import logging
+import select
+import time
+
+from .machine import QEMUMachineError
+
+LOG = logging.getLogger(__name__)
+
+
+class QEMUMachinePool(object):
+    """
+    A pool of pre-launched, paused QEMU VMs
+
+    The pool starts its VMs with -S, so that the guest does not run until
+    the user is done configuring it, typically with blockdev-add and
+    device_add, and issues "cont".  Replacement VMs are started as soon
+    as a VM is handed out, and are only waited for when acquired, so
+    their startup overlaps with whatever the caller does in between::
+
+        with QEMUMachinePool(lambda: QEMUMachine(binary), size=2) as pool:
+            vm = pool.acquire()
+            vm.command('device_add', driver='virtio-net-pci')
+            vm.command('cont')
+            ...
+            pool.release(vm)
+    """
+
+    def __init__(self, factory, size=4):
+        """
+        Initialize a QEMUMachinePool
+
+        @param factory: callable returning a new QEMUMachine, not launched
+                        yet.  Machines are alive at the same time, so their
+                        names must not clash.  The pool adds -S to the
+                        command line.
+        @param size: number of VMs to keep ready
+        @note: No VM is started until fill() or acquire() is used.
+        """
+        self._factory = factory
+        self._size = size
+        self._warm = []
+        self._idle = []
+        self._stats = {'acquired': 0, 'recycled': 0, 'discarded': 0,
+                       'failed': 0, 'wait': 0.0}
+        # Launch failures since the last successful one
+        self._failures = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+    def _start_one(self):
+        machine = self._factory()
+        machine.add_args('-S')
+        machine._iolog = None
+        machine._qemu_full_args = None
+        try:
+            machine._spawn()
+        except:
+            machine._launch_failed()
+            raise
+        self._warm.append(machine)
+
+    @staticmethod
+    def _wait_connection(machine, timeout=15.0):
+        # As in launch_many(), wake up regularly to notice a VM that
+        # exited early, rather than wait for the QMP accept() timeout
+        deadline = time.time() + timeout
+        fd = machine._qmp.get_sock_fd()
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise QEMUMachineError('Timeout waiting for QMP connection')
+            readable, _, _ = select.select([fd], [], [], min(remaining, 0.5))
+            if readable:
+                return
+            if not machine.is_running():
+                raise QEMUMachineError('QEMU exited with code %s' %
+                                       machine.exitcode())
+
+    def fill(self):
+        """
+        Start VMs until the pool holds its configured size
+        """
+        while len(self._warm) + len(self._idle) < self._size:
+            self._start_one()
+
+    def acquire(self):
+        """
+        Take a launched, paused VM out of the pool
+
+        Recycled VMs are handed out first.  The pool is topped up again
+        before returning.
+        """
+        start = time.time()
+        if self._idle:
+            machine = self._idle.pop(0)
+        else:
+            machine = None
+        while machine is None:
+            if not self._warm:
+                self._start_one()
+            candidate = self._warm.pop(0)
+            try:
+                self._wait_connection(candidate)
+                candidate._connect()
+                candidate._launched = True
+                machine = candidate
+                self._failures = 0
+            except Exception as err:
+                LOG.warning('Pooled VM failed to launch: %s', err)
+                candidate._launch_failed()
+                self._stats['failed'] += 1
+                self._failures += 1
+                if self._failures > self._size:
+                    raise QEMUMachineError('Too many pooled VMs failed to '
+                                           'launch, last error: %s' % err)
+        self._stats['acquired'] += 1
+        self._stats['wait'] += time.time() - start
+        self.fill()
+        return machine
+
+    def release(self, machine, recycle=False):
+        """
+        Give a VM back to the pool
+
+        @param machine: a VM obtained from acquire()
+        @param recycle: if True, the caller guarantees that the VM is still
+                        paused and in the state it was handed out in, and
+                        it is kept for a later acquire().  Otherwise it is
+                        shut down.
+        """
+        if recycle and machine.is_running():
+            self._idle.append(machine)
+            self._stats['recycled'] += 1
+            return
+        machine.shutdown()
+        self._stats['discarded'] += 1
+        self.fill()
+
+    def get_stats(self):
+        """
+        Returns a dict with the number of VMs acquired, recycled, discarded
+        and failed to launch so far, and the total time acquire() spent
+        waiting for VMs, in seconds ('wait').
+        """
+        return dict(self._stats)
+
+    @staticmethod
+    def _stop_unconnected(machine):
+        # A VM that has not been acquired has not completed its QMP
+        # handshake, so it cannot be asked to quit.  Kill it rather than
+        # wait for the handshake, which is as slow as the startup the pool
+        # is there to hide.
+        if machine.is_running():
+            machine._popen.kill()
+            machine._popen.wait()
+        machine._qmp.close()
+        machine._load_io_log()
+        machine._post_shutdown()
+
+    def close(self):
+        """
+        Shut down all the VMs held by the pool
+        """
+        for machine in self._warm:
+            self._stop_unconnected(machine)
+        for machine in self._idle:
+            machine.shutdown()
+        self._warm = []
+        self._idle = []
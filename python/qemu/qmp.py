@@ -10,8 +10,20 @@
 
 import json
 import errno
+import select
 import socket
 import logging
+import time
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
 
 
 class QMPError(Exception):
@@ -30,6 +42,228 @@ class QMPTimeoutError(QMPError):
     pass
 
 
+class QMPCodec(object):
+    """
+    JSON codec used on the QMP wire, based on the standard json module.
+
+    Both directions work on bytes so that a faster codec never has to
+    round trip through text strings.
+    """
+
+    #: Name used by get_codec()
+    name = 'json'
+
+    def loads(self, data):
+        """
+        Decode one QMP message.
+
+        @param data: UTF-8 encoded JSON document (bytes)
+        """
+        return json.loads(data.decode('utf-8'))
+
+    def dumps(self, obj):
+        """
+        Encode one QMP message, returning UTF-8 encoded bytes.
+        """
+        return json.dumps(obj).encode('utf-8')
+
+
+class QMPOrjsonCodec(QMPCodec):
+    """
+    Codec based on the optional orjson module.
+    """
+    name = 'orjson'
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+    def dumps(self, obj):
+        return orjson.dumps(obj)
+
+
+class QMPUjsonCodec(QMPCodec):
+    """
+    Codec based on the optional ujson module.
+    """
+    name = 'ujson'
+
+    def loads(self, data):
+        return ujson.loads(data)
+
+    def dumps(self, obj):
+        return ujson.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+
+def available_codecs():
+    """
+    Return the QMP codec classes usable on this host, fastest first.
+    """
+    codecs = []
+    if orjson is not None:
+        codecs.append(QMPOrjsonCodec)
+    if ujson is not None:
+        codecs.append(QMPUjsonCodec)
+    codecs.append(QMPCodec)
+    return codecs
+
+
+def get_codec(name=None):
+    """
+    Return a QMP codec instance.
+
+    The faster codecs differ from the json module in details such as
+    float formatting and the handling of large integers, so they are
+    only used when asked for.
+
+    @param name: one of 'orjson', 'ujson' or 'json', or 'fastest' for the
+                 fastest codec available.  If None, the standard json
+                 module is used.
+    @raise QMPError if the requested codec is not available
+    """
+    codecs = available_codecs()
+    if name is None:
+        return QMPCodec()
+    if name == 'fastest':
+        return codecs[0]()
+    for codec in codecs:
+        if codec.name == name:
+            return codec()
+    raise QMPError("QMP codec '%s' is not available" % name)
+
+
+# Monotonic clock used for latency measurements (Python 2 lacks one)
+_clock = getattr(time, 'monotonic', time.time)
+
+
+class QMPInstrumentation(object):
+    """
+    Hooks invoked by QEMUMonitorProtocol for every command and event.
+
+    This is the callback interface for external metrics: subclass it and
+    override the methods of interest, then hand an instance over to
+    QEMUMonitorProtocol (or QEMUMachine.set_qmp_instrumentation()).
+    All timestamps come from the same monotonic clock.
+    """
+
+    def command(self, name, sent, first_byte, complete, reply_size):
+        """
+        Called once a command reply has been received.
+
+        @param name: the command name, as in the 'execute' key, or None
+                     for commands sent pre-encoded with cmd_raw()
+        @param sent: time at which the command started to be sent
+        @param first_byte: time at which the first reply byte was readable
+        @param complete: time at which the reply was fully parsed
+        @param reply_size: size of the reply on the wire, in bytes
+        """
+        pass
+
+    def event(self, name, arrival, size):
+        """
+        Called for every event read from the monitor.
+
+        @param name: the event name
+        @param arrival: time at which the event was read
+        @param size: size of the event on the wire, in bytes
+        """
+        pass
+
+
+class QMPLatencyRecorder(QMPInstrumentation):
+    """
+    Collects per-command latency histograms and event arrival rates.
+
+    Latencies are bucketed in powers of two of microseconds, so memory use
+    is constant regardless of how many commands are issued.  Use summary()
+    to export the collected data as a JSON serializable dict.
+    """
+
+    def __init__(self):
+        self._commands = {}
+        self._events = {}
+
+    def command(self, name, sent, first_byte, complete, reply_size):
+        stats = self._commands.get(name)
+        if stats is None:
+            stats = {'count': 0, 'total': 0.0, 'min': None, 'max': 0.0,
+                     'first_byte_total': 0.0, 'reply_bytes': 0,
+                     'buckets': {}}
+            self._commands[name] = stats
+        latency = complete - sent
+        stats['count'] += 1
+        stats['total'] += latency
+        stats['first_byte_total'] += first_byte - sent
+        stats['reply_bytes'] += reply_size
+        if stats['min'] is None or latency < stats['min']:
+            stats['min'] = latency
+        stats['max'] = max(stats['max'], latency)
+        bucket = int(latency * 1000000).bit_length()
+        stats['buckets'][bucket] = stats['buckets'].get(bucket, 0) + 1
+
+    def event(self, name, arrival, size):
+        stats = self._events.get(name)
+        if stats is None:
+            stats = {'count': 0, 'bytes': 0, 'first': arrival, 'last': arrival}
+            self._events[name] = stats
+        stats['count'] += 1
+        stats['bytes'] += size
+        stats['last'] = arrival
+
+    def reset(self):
+        """
+        Drop all the data collected so far.
+        """
+        self._commands = {}
+        self._events = {}
+
+    @staticmethod
+    def _percentile(buckets, count, fraction):
+        # Upper bound of the bucket holding the requested sample, in seconds
+        rank = fraction * count
+        seen = 0
+        for bucket in sorted(buckets):
+            seen += buckets[bucket]
+            if seen >= rank:
+                return (1 << bucket) / 1000000.0
+        return None
+
+    def summary(self):
+        """
+        Return the collected statistics as a dict.
+
+        Times are in seconds.  Histograms map the upper bound of each
+        bucket, in microseconds, to the number of samples in it.  Event
+        rates are in events per second between the first and last
+        occurrence of each event.
+        """
+        commands = {}
+        for name, stats in self._commands.items():
+            count = stats['count']
+            buckets = stats['buckets']
+            commands[name] = {
+                'count': count,
+                'min': stats['min'],
+                'max': stats['max'],
+                'mean': stats['total'] / count,
+                'mean-first-byte': stats['first_byte_total'] / count,
+                'p50': self._percentile(buckets, count, 0.5),
+                'p90': self._percentile(buckets, count, 0.9),
+                'p99': self._percentile(buckets, count, 0.99),
+                'reply-bytes': stats['reply_bytes'],
+                'histogram': dict((1 << b, n) for b, n in buckets.items()),
+            }
+        events = {}
+        for name, stats in self._events.items():
+            elapsed = stats['last'] - stats['first']
+            rate = None
+            if elapsed > 0:
+                rate = (stats['count'] - 1) / elapsed
+            events[name] = {'count': stats['count'],
+                            'bytes': stats['bytes'],
+                            'rate': rate}
+        return {'commands': commands, 'events': events}
+
+
 class QEMUMonitorProtocol(object):
 
     #: Logger object for debugging messages
@@ -39,7 +273,8 @@ class QEMUMonitorProtocol(object):
     #: Socket's timeout
     timeout = socket.timeout
 
-    def __init__(self, address, server=False):
+    def __init__(self, address, server=False, instrumentation=None,
+                 codec=None):
         """
         Create a QEMUMonitorProtocol class.
 
@@ -47,6 +282,9 @@ class QEMUMonitorProtocol(object):
                         or a tuple in the form ( address, port ) for a TCP
                         connection
         @param server: server mode listens on the socket (bool)
+        @param instrumentation: optional QMPInstrumentation instance
+        @param codec: QMPCodec instance used to encode and decode messages
+                      (default: the standard json module, see get_codec())
         @raise socket.error on socket connection errors
         @note No connection is established, this is done by the connect() or
               accept() methods
@@ -54,7 +292,13 @@ class QEMUMonitorProtocol(object):
         self.__events = []
         self.__address = address
         self.__sock = self.__get_sock()
-        self.__sockfile = None
+        self.__rbuf = b''
+        self.__instrumentation = instrumentation
+        self.__reply_size = 0
+        self.__reply_data = None
+        if codec is None:
+            codec = get_codec()
+        self.__codec = codec
         if server:
             self.__sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             self.__sock.bind(self.__address)
@@ -77,17 +321,54 @@ class QEMUMonitorProtocol(object):
             return greeting
         raise QMPCapabilitiesError
 
-    def __json_read(self, only_event=False):
+    def __readline(self, timeout=None):
+        """
+        Read one line from the monitor.
+
+        The monitor is line buffered here rather than through a socket file
+        so that the buffer can be looked at before waiting on the socket:
+        select() cannot see lines that came in with an earlier read.
+
+        @param timeout: seconds to wait for a complete line, 0 to only take
+                        what is already available, or None to block
+        @raise QMPTimeoutError: If the timeout elapses.
+        @return the line, or b'' if the connection has been closed
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = _clock() + timeout
         while True:
-            data = self.__sockfile.readline()
+            end = self.__rbuf.find(b'\n')
+            if end >= 0:
+                line = self.__rbuf[:end + 1]
+                self.__rbuf = self.__rbuf[end + 1:]
+                return line
+            if deadline is not None:
+                remaining = max(deadline - _clock(), 0)
+                readable, _, _ = select.select([self.__sock], [], [], remaining)
+                if not readable:
+                    raise QMPTimeoutError("Timeout waiting for data")
+            data = self.__sock.recv(65536)
+            if not data:
+                return data
+            self.__rbuf += data
+
+    def __json_read(self, only_event=False, timeout=None):
+        while True:
+            data = self.__readline(timeout)
             if not data:
                 return
-            resp = json.loads(data)
+            resp = self.__codec.loads(data)
             if 'event' in resp:
                 self.logger.debug("<<< %s", resp)
+                if self.__instrumentation is not None:
+                    self.__instrumentation.event(resp['event'], _clock(),
+                                                 len(data))
                 self.__events.append(resp)
                 if not only_event:
                     continue
+            self.__reply_size = len(data)
+            self.__reply_data = data
             return resp
 
     def __get_events(self, wait=False):
@@ -104,29 +385,28 @@ class QEMUMonitorProtocol(object):
         """
 
         # Check for new events regardless and pull them into the cache:
-        self.__sock.setblocking(0)
         try:
-            self.__json_read()
-        except socket.error as err:
-            if err[0] == errno.EAGAIN:
-                # No data available
-                pass
-        self.__sock.setblocking(1)
+            self.__json_read(timeout=0)
+        except QMPTimeoutError:
+            # No data available
+            pass
 
         # Wait for new events, if needed.
         # if wait is 0.0, this means "no wait" and is also implicitly false.
         if not self.__events and wait:
+            timeout = None
             if isinstance(wait, float):
-                self.__sock.settimeout(wait)
+                # A timeout leaves any partial line buffered, so that the
+                # caller can wait again later.
+                timeout = wait
             try:
-                ret = self.__json_read(only_event=True)
-            except socket.timeout:
+                ret = self.__json_read(only_event=True, timeout=timeout)
+            except QMPTimeoutError:
                 raise QMPTimeoutError("Timeout waiting for event")
             except:
                 raise QMPConnectError("Error while reading from socket")
             if ret is None:
                 raise QMPConnectError("Error while reading from socket")
-            self.__sock.settimeout(None)
 
     def connect(self, negotiate=True):
         """
@@ -138,7 +418,6 @@ class QEMUMonitorProtocol(object):
         @raise QMPCapabilitiesError if fails to negotiate capabilities
         """
         self.__sock.connect(self.__address)
-        self.__sockfile = self.__sock.makefile()
         if negotiate:
             return self.__negotiate_capabilities()
 
@@ -153,9 +432,29 @@ class QEMUMonitorProtocol(object):
         """
         self.__sock.settimeout(15)
         self.__sock, _ = self.__sock.accept()
-        self.__sockfile = self.__sock.makefile()
         return self.__negotiate_capabilities()
 
+    def __send(self, data, name):
+        sent = _clock()
+        try:
+            self.__sock.sendall(data)
+        except socket.error as err:
+            if err[0] == errno.EPIPE:
+                return
+            raise socket.error(err)
+        if self.__instrumentation is None:
+            return self.__json_read()
+        # Events read along with an earlier reply may be buffered, in
+        # which case the reply is timed from now.
+        if not self.__rbuf:
+            select.select([self.__sock], [], [], self.__sock.gettimeout())
+        first_byte = _clock()
+        resp = self.__json_read()
+        if resp is not None:
+            self.__instrumentation.command(name, sent, first_byte, _clock(),
+                                           self.__reply_size)
+        return resp
+
     def cmd_obj(self, qmp_cmd):
         """
         Send a QMP command to the QMP Monitor.
@@ -165,16 +464,28 @@ class QEMUMonitorProtocol(object):
                 been closed
         """
         self.logger.debug(">>> %s", qmp_cmd)
-        try:
-            self.__sock.sendall(json.dumps(qmp_cmd).encode('utf-8'))
-        except socket.error as err:
-            if err[0] == errno.EPIPE:
-                return
-            raise socket.error(err)
-        resp = self.__json_read()
+        resp = self.__send(self.__codec.dumps(qmp_cmd),
+                           qmp_cmd.get('execute'))
         self.logger.debug("<<< %s", resp)
         return resp
 
+    def cmd_raw(self, data):
+        """
+        Send an already encoded QMP command to the QMP Monitor.
+
+        Events received while waiting for the reply are decoded and
+        queued as usual.
+
+        @param data: QMP command as UTF-8 encoded JSON (bytes)
+        @return QMP response as it was received on the wire (bytes), or None
+                if the connection has been closed
+        """
+        self.logger.debug(">>> %s", data)
+        if self.__send(data, None) is None:
+            return None
+        self.logger.debug("<<< %s", self.__reply_data)
+        return self.__reply_data
+
     def cmd(self, name, args=None, cmd_id=None):
         """
         Build a QMP command and send it to the QMP Monitor.
@@ -242,9 +553,17 @@ class QEMUMonitorProtocol(object):
         """
         self.__events = []
 
+    def set_instrumentation(self, instrumentation):
+        """
+        Set the QMPInstrumentation instance notified of commands and events.
+
+        @param instrumentation: QMPInstrumentation instance, or None to
+                                disable instrumentation
+        """
+        self.__instrumentation = instrumentation
+
     def close(self):
         self.__sock.close()
-        self.__sockfile.close()
 
     def settimeout(self, timeout):
         self.__sock.settimeout(timeout)
@@ -11,13 +11,51 @@
 # Based on qmp.py.
 #
 
+import base64
+import binascii
+import errno
+import select
 import socket
 import os
 
 from .machine import QEMUMachine
 
 
+class QEMUQtestError(Exception):
+    """
+    Exception raised when QEMU reports a failed qtest command
+    """
+
+
+def _byte_view(data, writable=False):
+    """
+    Return a memoryview of data, which may be any object exposing a
+    buffer, with one unsigned byte per item
+
+    Python 2 memoryviews cannot be cast, so other buffers are copied
+    there, which is only possible when they are not written to.
+    """
+    view = memoryview(data)
+    if view.format != 'B' or view.ndim != 1:
+        if hasattr(view, 'cast'):
+            view = view.cast('B')
+        elif writable:
+            raise TypeError('only byte buffers can be read into with '
+                            'Python 2')
+        else:
+            view = memoryview(view.tobytes())
+    return view
+
+
 class QEMUQtestProtocol(object):
+    #: Largest amount of guest memory moved by a single qtest command
+    #: in the bulk memory helpers.  QEMU looks for the end of a command
+    #: line each time it receives 1 KiB, so very long lines cost it
+    #: quadratic time.
+    mem_chunk_size = 32 * 1024
+    #: Number of such commands sent at once by the bulk memory helpers
+    mem_batch_size = 64
+
     def __init__(self, address, server=False):
         """
         Create a QEMUQtestProtocol object.
@@ -32,7 +70,8 @@ class QEMUQtestProtocol(object):
         """
         self._address = address
         self._sock = self._get_sock()
-        self._sockfile = None
+        self._rbuf = b''
+        self._irqs = []
         if server:
             self._sock.bind(self._address)
             self._sock.listen(1)
@@ -51,7 +90,6 @@ class QEMUQtestProtocol(object):
         @raise socket.error on socket connection errors
         """
         self._sock.connect(self._address)
-        self._sockfile = self._sock.makefile()
 
     def accept(self):
         """
@@ -60,7 +98,28 @@ class QEMUQtestProtocol(object):
         @raise socket.error on socket connection errors
         """
         self._sock, _ = self._sock.accept()
-        self._sockfile = self._sock.makefile()
+
+    def _pop_replies(self, replies, count):
+        """
+        Move complete reply lines from the receive buffer to replies,
+        setting aside asynchronous IRQ notifications
+        """
+        while len(replies) < count:
+            end = self._rbuf.find(b'\n')
+            if end < 0:
+                return
+            line = self._rbuf[:end + 1].decode('utf-8')
+            self._rbuf = self._rbuf[end + 1:]
+            if line.startswith('IRQ '):
+                self._irqs.append(line)
+            else:
+                replies.append(line)
+
+    def _recv(self):
+        data = self._sock.recv(65536)
+        if not data:
+            raise socket.error(errno.ECONNRESET, 'qtest connection closed')
+        self._rbuf += data
 
     def cmd(self, qtest_cmd):
         """
@@ -69,12 +128,168 @@ class QEMUQtestProtocol(object):
         @param qtest_cmd: qtest command text to be sent
         """
         self._sock.sendall((qtest_cmd + "\n").encode('utf-8'))
-        resp = self._sockfile.readline()
-        return resp
+        replies = []
+        self._pop_replies(replies, 1)
+        while not replies:
+            self._recv()
+            self._pop_replies(replies, 1)
+        return replies[0]
+
+    def cmd_batch(self, qtest_cmds):
+        """
+        Send several qtest commands at once and collect all their replies.
+
+        Commands are pipelined: they are written while replies are being
+        read, so there is no round trip per command.
+
+        @param qtest_cmds: sequence of qtest command texts
+        @return the list of replies, in the same order as the commands
+        """
+        data = memoryview(''.join(cmd + '\n' for cmd in qtest_cmds)
+                          .encode('utf-8'))
+        count = len(qtest_cmds)
+        replies = []
+        sent = 0
+        timeout = self._sock.gettimeout()
+        self._pop_replies(replies, count)
+        # Writing without reading could deadlock once QEMU blocks on a
+        # full socket buffer while sending replies, so do both at once
+        self._sock.setblocking(0)
+        try:
+            while len(replies) < count:
+                wlist = [self._sock] if sent < len(data) else []
+                readable, writable, _ = select.select([self._sock], wlist,
+                                                      [], timeout)
+                if not readable and not writable:
+                    raise socket.timeout('timed out')
+                if writable:
+                    sent += self._sock.send(data[sent:])
+                if readable:
+                    self._recv()
+                    self._pop_replies(replies, count)
+        finally:
+            self._sock.settimeout(timeout)
+        return replies
+
+    def get_irqs(self):
+        """
+        Return and clear the IRQ notifications received so far.
+        """
+        irqs = self._irqs
+        self._irqs = []
+        return irqs
+
+    @staticmethod
+    def _check_reply(reply, qtest_cmd):
+        if not reply.startswith('OK'):
+            raise QEMUQtestError('%s: %s' % (qtest_cmd.split(' ')[0],
+                                             reply.strip()))
+
+    def _mem_batches(self, size):
+        """
+        Split a range of size bytes into batches of (offset, length)
+        chunks, so that large transfers are never held in memory as a
+        whole in encoded form
+        """
+        chunks = []
+        for offset in range(0, size, self.mem_chunk_size):
+            chunks.append((offset, min(self.mem_chunk_size, size - offset)))
+            if len(chunks) == self.mem_batch_size:
+                yield chunks
+                chunks = []
+        if chunks:
+            yield chunks
+
+    def _memread_chunks(self, addr, size):
+        """
+        Yield (offset, data) for consecutive chunks of guest memory
+        """
+        for chunks in self._mem_batches(size):
+            cmds = ['b64read 0x%x 0x%x' % (addr + offset, length)
+                    for offset, length in chunks]
+            replies = self.cmd_batch(cmds)
+            for (offset, length), qtest_cmd, reply in zip(chunks, cmds,
+                                                          replies):
+                self._check_reply(reply, qtest_cmd)
+                data = binascii.a2b_base64(reply[3:])
+                if len(data) != length:
+                    raise QEMUQtestError('b64read: got %d bytes instead of '
+                                         '%d' % (len(data), length))
+                yield offset, data
+
+    def memread_into(self, addr, buf):
+        """
+        Read guest physical memory into a writable buffer such as a
+        bytearray, filling it entirely.
+
+        The range is transferred base64 encoded, in chunks of at most
+        mem_chunk_size bytes, mem_batch_size chunks per batch.
+        """
+        view = _byte_view(buf, writable=True)
+        for offset, data in self._memread_chunks(addr, len(view)):
+            view[offset:offset + len(data)] = data
+
+    def memread(self, addr, size):
+        """
+        Read a range of guest physical memory of any size.
+
+        @return the memory contents as a bytearray
+        """
+        buf = bytearray(size)
+        self.memread_into(addr, buf)
+        return buf
+
+    def memwrite(self, addr, data):
+        """
+        Write guest physical memory, in base64 encoded chunks of at most
+        mem_chunk_size bytes, mem_batch_size chunks per batch.
+
+        @param data: bytes, bytearray, memoryview or other object exposing
+                     a byte buffer; it is encoded chunk by chunk without
+                     being copied as a whole
+        """
+        view = _byte_view(data)
+        for chunks in self._mem_batches(len(view)):
+            cmds = []
+            for offset, length in chunks:
+                encoded = base64.b64encode(view[offset:offset + length])
+                cmds.append('b64write 0x%x 0x%x %s' %
+                            (addr + offset, length, encoded.decode('ascii')))
+            for qtest_cmd, reply in zip(cmds, self.cmd_batch(cmds)):
+                self._check_reply(reply, qtest_cmd)
+
+    def memcmp(self, addr, expected):
+        """
+        Compare guest physical memory with expected contents, one chunk
+        at a time, stopping at the first difference.
+
+        @param expected: bytes-like object holding the expected contents
+        @return the offset of the first differing byte, or None if the
+                memory matches
+        """
+        view = _byte_view(expected)
+        for offset, data in self._memread_chunks(addr, len(view)):
+            # Indexing a memoryview gives a str on Python 2, compare
+            # integers on both sides
+            data = bytearray(data)
+            chunk = bytearray(view[offset:offset + len(data)])
+            if data != chunk:
+                for i, (byte, expected_byte) in enumerate(zip(data, chunk)):
+                    if byte != expected_byte:
+                        return offset + i
+        return None
+
+    def memset(self, addr, size, value):
+        """
+        Fill a range of guest physical memory with a byte value.
+        """
+        if size == 0:
+            return
+        qtest_cmd = 'memset 0x%x 0x%x 0x%x' % (addr, size, value)
+        self._check_reply(self.cmd(qtest_cmd), qtest_cmd)
 
     def close(self):
         self._sock.close()
-        self._sockfile.close()
 
     def settimeout(self, timeout):
         self._sock.settimeout(timeout)
@@ -114,3 +329,31 @@ class QEMUQtestMachine(QEMUMachine):
     def qtest(self, cmd):
         '''Send a qtest command to guest'''
         return self._qtest.cmd(cmd)
+
+    def qtest_batch(self, cmds):
+        '''Send several qtest commands to guest at once, returning the
+        list of replies'''
+        return self._qtest.cmd_batch(cmds)
+
+    def b64write(self, addr, data):
+        '''Write a buffer of any size to guest physical memory, see
+        QEMUQtestProtocol.memwrite()'''
+        self._qtest.memwrite(addr, data)
+
+    def b64read(self, addr, size):
+        '''Read a range of guest physical memory of any size into a new
+        bytearray'''
+        return self._qtest.memread(addr, size)
+
+    def b64read_into(self, addr, buf):
+        '''Read guest physical memory into an existing writable buffer'''
+        self._qtest.memread_into(addr, buf)
+
+    def memset(self, addr, size, value):
+        '''Fill a range of guest physical memory with a byte value'''
+        self._qtest.memset(addr, size, value)
+
+    def memcmp(self, addr, expected):
+        '''Compare guest physical memory against expected contents,
+        returning the offset of the first difference or None'''
+        return self._qtest.memcmp(addr, expected)
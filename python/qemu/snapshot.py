@@ -0,0 +1,154 @@
+"""
+QEMU VM state snapshot module:
+
+The snapshot module provides the QEMUStateSnapshot class, which boots
+and sets up a VM once, saves its state to a file through migration,
+and then starts any number of VMs directly from that state.
+"""
+
+# Copyright (C) 2019 Red Hat Inc.
+#
+# This work is licensed under the terms of the GNU GPL, version 2.  See
+# the COPYING file in the top-level directory.
+
+import logging
+import os
+import tempfile
+import time
+
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+from .machine import QEMUMachineError
+
+LOG = logging.getLogger(__name__)
+
+
+class QEMUStateSnapshot(object):
+    """
+    A saved VM state, restored into new VMs on demand
+
+    The first call to restore() launches a VM, runs the setup callable on
+    it (for example booting the guest up to a shell prompt), saves its
+    state with the "migrate" command into the snapshot file and shuts it
+    down.  Every call then launches a new VM with -incoming reading that
+    file, which is much faster than booting::
+
+        def boot(vm):
+            vm.console_reader().wait_for(['login:'], timeout=120)
+
+        snapshot = QEMUStateSnapshot(make_vm, '/tmp/boot.state', boot)
+        vm = snapshot.restore()
+
+    The factory must return VMs with the same configuration every time,
+    as required by migration.  Disk images must not be modified by the
+    guest (use snapshot=on or read-only drives), otherwise restored VMs
+    see disks that no longer match their memory.
+
+    The snapshot file is kept when the object goes away, so that it can be
+    shared by tests running in separate processes: an existing file is
+    used as is, and remove() deletes it.
+    """
+
+    def __init__(self, factory, path, setup=None, timeout=300.0):
+        """
+        @param factory: callable returning a new QEMUMachine, not launched
+                        yet.  The snapshot adds -incoming and -S to it.
+        @param path: file holding the saved state
+        @param setup: callable invoked with the running VM before saving
+                      its state
+        @param timeout: maximum time to save or load the state, in seconds
+        """
+        self._factory = factory
+        self._path = path
+        self._setup = setup
+        self._timeout = timeout
+
+    @property
+    def path(self):
+        return self._path
+
+    def _wait(self, machine, command, busy_states):
+        deadline = time.time() + self._timeout
+        while True:
+            status = machine.command(command)['status']
+            if status not in busy_states:
+                return status
+            if time.time() > deadline:
+                raise QEMUMachineError('Timeout waiting for VM state '
+                                       'transfer (%s: %s)' % (command, status))
+            time.sleep(0.05)
+
+    def save(self, machine):
+        """
+        Save the state of a running VM into the snapshot file
+
+        The VM is left paused in the postmigrate state.
+        """
+        # A temporary file of our own, so that processes creating the same
+        # snapshot concurrently cannot write into each other's file, and a
+        # partially written state is impossible to pick up
+        fd, tmp = tempfile.mkstemp(prefix=os.path.basename(self._path) + '.',
+                                   suffix='.tmp',
+                                   dir=os.path.dirname(self._path) or '.')
+        os.close(fd)
+        try:
+            machine.command('migrate', uri='exec:cat > %s' % quote(tmp))
+            status = self._wait(machine, 'query-migrate',
+                                ('setup', 'active', 'pre-switchover',
+                                 'device'))
+            if status != 'completed':
+                raise QEMUMachineError('Saving VM state failed: %s' % status)
+            os.rename(tmp, self._path)
+        except:
+            os.remove(tmp)
+            raise
+
+    def create(self):
+        """
+        Boot and set up a VM, and save its state into the snapshot file
+        """
+        start = time.time()
+        machine = self._factory()
+        machine.launch()
+        try:
+            if self._setup is not None:
+                self._setup(machine)
+            self.save(machine)
+        finally:
+            machine.shutdown()
+        LOG.debug('Created VM state snapshot %s in %.3fs', self._path,
+                  time.time() - start)
+
+    def restore(self, paused=False):
+        """
+        Launch a new VM from the saved state, creating it first if needed
+
+        @param paused: leave the VM paused after loading its state, so
+                       that it can be configured before issuing "cont"
+        @return the launched QEMUMachine
+        """
+        if not os.path.exists(self._path):
+            self.create()
+        machine = self._factory()
+        machine.add_args('-S', '-incoming', 'exec:cat %s' % quote(self._path))
+        machine.launch()
+        try:
+            status = self._wait(machine, 'query-status', ('inmigrate',))
+            if status == 'paused' and not paused:
+                machine.command('cont')
+        except:
+            machine.shutdown()
+            raise
+        return machine
+
+    def remove(self):
+        """
+        Delete the snapshot file, if it exists
+        """
+        try:
+            os.remove(self._path)
+        except OSError:
+            pass
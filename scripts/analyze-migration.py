@@ -18,11 +18,18 @@
 # License along with this library; if not, see <http://www.gnu.org/licenses/>.
 
 from __future__ import print_function
-import numpy as np
 import json
+import mmap
 import os
 import argparse
+import array
 import collections
+import hashlib
+import heapq
+import struct
+import sys
+import time
+import zlib
 
 def mkdir_p(path):
     try:
@@ -30,80 +37,172 @@ def mkdir_p(path):
     except OSError:
         pass
 
+# Estimate the number of distinct values in a stream with constant memory,
+# by keeping the k smallest hashes (K-minimum values).  The hashes must be
+# uniformly distributed 64-bit numbers.
+class DistinctEstimator(object):
+    HASH_RANGE = 1 << 64
+
+    def __init__(self, k = 4096):
+        self.k = k
+        self.count = 0
+        # Max-heap of the k smallest hashes, stored negated
+        self.heap = []
+        self.members = set()
+
+    def add(self, value):
+        self.count += 1
+        if value in self.members:
+            return
+        if len(self.heap) < self.k:
+            heapq.heappush(self.heap, -value)
+            self.members.add(value)
+        elif value < -self.heap[0]:
+            self.members.remove(-heapq.heapreplace(self.heap, -value))
+            self.members.add(value)
+
+    def estimate(self):
+        if len(self.heap) < self.k:
+            return len(self.heap)
+        return int((self.k - 1) * float(self.HASH_RANGE) / -self.heap[0])
+
 class MigrationFile(object):
+    int64 = struct.Struct('>q')
+    int32 = struct.Struct('>i')
+    int16 = struct.Struct('>h')
+    int8 = struct.Struct('>b')
+
     def __init__(self, filename):
         self.filename = filename
         self.file = open(self.filename, "rb")
+        # The whole stream is mapped and parsed in place, so that reading
+        # an integer does not cost a system call
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.size = len(self.data)
+        self.pos = 0
+
+    def unexpected_eof(self):
+        return Exception("Unexpected end of %s at 0x%x" % (self.filename, self.pos))
+
+    def readstruct(self, fmt):
+        try:
+            values = fmt.unpack_from(self.data, self.pos)
+        except struct.error:
+            raise self.unexpected_eof()
+        self.pos += fmt.size
+        return values
+
+    def unpack(self, fmt):
+        try:
+            value, = fmt.unpack_from(self.data, self.pos)
+        except struct.error:
+            raise self.unexpected_eof()
+        self.pos += fmt.size
+        return value
 
     def read64(self):
-        return np.asscalar(np.fromfile(self.file, count=1, dtype='>i8')[0])
+        return self.unpack(self.int64)
 
     def read32(self):
-        return np.asscalar(np.fromfile(self.file, count=1, dtype='>i4')[0])
+        return self.unpack(self.int32)
 
     def read16(self):
-        return np.asscalar(np.fromfile(self.file, count=1, dtype='>i2')[0])
+        return self.unpack(self.int16)
 
     def read8(self):
-        return np.asscalar(np.fromfile(self.file, count=1, dtype='>i1')[0])
+        return self.unpack(self.int8)
 
     def readstr(self, len = None):
         if len is None:
             len = self.read8()
         if len == 0:
             return ""
-        return np.fromfile(self.file, count=1, dtype=('S%d' % len))[0]
+        value = self.readvar(len)
+        if str is not bytes:
+            value = value.decode('latin-1')
+        return value
 
     def readvar(self, size = None):
         if size is None:
             size = self.read8()
         if size == 0:
             return ""
-        value = self.file.read(size)
-        if len(value) != size:
-            raise Exception("Unexpected end of %s at 0x%x" % (self.filename, self.file.tell()))
+        if self.pos + size > self.size:
+            raise self.unexpected_eof()
+        value = self.data[self.pos:self.pos + size]
+        self.pos += size
+        return value
+
+    # Like readvar(), but avoid copying the data where possible. The view
+    # must be released before the file is closed.
+    def readview(self, size):
+        if str is bytes:
+            return self.readvar(size)
+        if self.pos + size > self.size:
+            raise self.unexpected_eof()
+        value = memoryview(self.data)[self.pos:self.pos + size]
+        self.pos += size
         return value
 
     def tell(self):
-        return self.file.tell()
+        return self.pos
+
+    def seek(self, offset, whence = os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self.pos = offset
 
     # The VMSD description is at the end of the file, after EOF. Look for
-    # the last NULL byte, then for the beginning brace of JSON.
+    # the last NULL byte, then for the beginning brace of JSON.  Returns
+    # None if there is no description, as in postcopy streams.
     def read_migration_debug_json(self):
         QEMU_VM_VMDESCRIPTION = 0x06
 
         # Remember the offset in the file when we started
-        entrypos = self.file.tell()
-
-        # Read the last 10MB
-        self.file.seek(0, os.SEEK_END)
-        endpos = self.file.tell()
-        self.file.seek(max(-endpos, -10 * 1024 * 1024), os.SEEK_END)
-        datapos = self.file.tell()
-        data = self.file.read()
-        # The full file read closed the file as well, reopen it
-        self.file = open(self.filename, "rb")
+        entrypos = self.pos
+
+        # Look at the last 10MB only
+        datapos = max(0, self.size - 10 * 1024 * 1024)
 
         # Find the last NULL byte, then the first brace after that. This should
         # be the beginning of our JSON data.
-        nulpos = data.rfind("\0")
-        jsonpos = data.find("{", nulpos)
+        nulpos = self.data.rfind(b"\0", datapos)
+        jsonpos = self.data.find(b"{", nulpos)
 
         # Check backwards from there and see whether we guessed right
-        self.file.seek(datapos + jsonpos - 5, 0)
+        if jsonpos < 5:
+            return None
+        self.pos = jsonpos - 5
         if self.read8() != QEMU_VM_VMDESCRIPTION:
-            raise Exception("No Debug Migration device found")
+            self.pos = entrypos
+            return None
 
         jsonlen = self.read32()
 
         # Seek back to where we were at the beginning
-        self.file.seek(entrypos, 0)
+        self.pos = entrypos
 
-        return data[jsonpos:jsonpos + jsonlen]
+        return self.data[jsonpos:jsonpos + jsonlen].decode('utf-8')
 
     def close(self):
+        self.data.close()
         self.file.close()
 
+# Bytes as space separated hex digits; this is what most of the output of
+# a memory dump is made of
+try:
+    b''.hex(' ')
+
+    def hexstr(data):
+        return data.hex(' ')
+except (AttributeError, TypeError):
+    HEX_BYTES = ['%02x' % c for c in range(256)]
+
+    def hexstr(data):
+        return ' '.join([HEX_BYTES[c] for c in bytearray(data)])
+
 class RamSection(object):
     RAM_SAVE_FLAG_COMPRESS = 0x02
     RAM_SAVE_FLAG_MEM_SIZE = 0x04
@@ -112,25 +211,95 @@ class RamSection(object):
     RAM_SAVE_FLAG_CONTINUE = 0x20
     RAM_SAVE_FLAG_XBZRLE   = 0x40
     RAM_SAVE_FLAG_HOOK     = 0x80
+    RAM_SAVE_FLAG_COMPRESS_PAGE = 0x100
+
+    ENCODING_FLAG_XBZRLE   = 0x1
+
+    # Kinds of page runs in a page map
+    PAGE_DATA = 'page'
+    PAGE_FILL = 'fill'
+    PAGE_XBZRLE = 'xbzrle'
+    PAGE_ZLIB = 'zlib'
+
+    # Page cache entry of a page whose content was decoded from XBZRLE or
+    # zlib; other entries are the stream offset of the page data, or minus
+    # one minus the fill byte
+    CACHED_DECODED = -1000
+
+    # Page cache entries are stream offsets, which need 64 bits.  Python 2
+    # has no 'q' type code and its 'l' is only 64-bit on LP64 hosts; lists
+    # take more memory but work everywhere.
+    try:
+        array.array('q')
+        CACHE_TYPECODE = 'q'
+    except ValueError:
+        CACHE_TYPECODE = 'l' if array.array('l').itemsize == 8 else None
+
+    def int64_array(self, size):
+        if self.CACHE_TYPECODE is None:
+            return [0] * size
+        return array.array(self.CACHE_TYPECODE, [0]) * size
 
     def __init__(self, file, version_id, ramargs, section_key):
         if version_id != 4:
             raise Exception("Unknown RAM version %d" % version_id)
+        if ramargs['page_size'] is None:
+            raise Exception("Unknown page size: no VMSD description or postcopy advise")
 
         self.file = file
         self.section_key = section_key
         self.TARGET_PAGE_SIZE = ramargs['page_size']
         self.dump_memory = ramargs['dump_memory']
         self.write_memory = ramargs['write_memory']
+        self.page_map = ramargs.get('page_map')
+        self.channels = ramargs.get('channels') or []
+        # XBZRLE pages are encoded against the previous content of the
+        # page, so it must be known when the content is needed
+        if self.write_memory or self.dump_memory or ramargs.get('page_cache'):
+            self.page_cache = { }
+            self.decoded = { }
+        else:
+            self.page_cache = None
+        if ramargs.get('iterations'):
+            self.iterations = []
+            # One byte per page, set for the pages sent in the current
+            # iteration and for the pages sent at all
+            self.sent = { }
+            self.ever_sent = { }
+        else:
+            self.iterations = None
+        if ramargs.get('stats'):
+            self.totals = self.new_stats()
+            # Only pages sent in full are hashed, as the content of the
+            # other ones is not known without keeping a page cache
+            self.distinct = DistinctEstimator()
+        else:
+            self.totals = None
+            self.distinct = None
+        self.accounting = self.iterations is not None or self.totals is not None
         self.sizeinfo = collections.OrderedDict()
         self.data = collections.OrderedDict()
         self.data['section sizes'] = self.sizeinfo
         self.name = ''
         if self.write_memory:
             self.files = { }
+            # One byte per page, set for the pages that may hold nonzero
+            # data in the extracted file
+            self.written = { }
+            self.fill_pages = { }
+            # Contiguous pages waiting to be written: block name, address,
+            # list of buffers and total size
+            self.pending = None
+            self.extracted = 0
         if self.dump_memory:
+            # Pages in the order they first show up, as block index and
+            # page number.  Their last content is only looked up in the
+            # page cache when the dump is written out.
             self.memory = collections.OrderedDict()
             self.data['memory'] = self.memory
+            self.dump_blocks = []
+            self.dump_seen = { }
+            self.dump_order = self.int64_array(0)
 
     def __repr__(self):
         return self.data.__repr__()
@@ -141,9 +310,264 @@ class RamSection(object):
     def getDict(self):
         return self.data
 
+    try:
+        MAX_IOV = os.sysconf('SC_IOV_MAX')
+    except (AttributeError, ValueError, OSError):
+        MAX_IOV = 1024
+
+    def write_page(self, addr, data):
+        run = self.pending
+        if run is not None and (run[0] != self.name or run[1] + run[3] != addr
+                                or len(run[2]) >= self.MAX_IOV):
+            self.flush_pages()
+            run = None
+        if run is None:
+            run = self.pending = [self.name, addr, [], 0]
+        run[2].append(data)
+        run[3] += len(data)
+
+    def flush_pages(self):
+        if self.pending is None:
+            return
+        name, addr, buffers, size = self.pending
+        self.pending = None
+        fd = self.files[name].fileno()
+        if hasattr(os, 'pwritev'):
+            written = os.pwritev(fd, buffers, addr)
+        else:
+            written = 0
+        if written < size:
+            # Decoded pages are bytearrays, which b''.join() does not
+            # take on Python 2
+            data = bytearray().join(buffers)[written:]
+            os.lseek(fd, addr + written, os.SEEK_SET)
+            while data:
+                data = data[os.write(fd, data):]
+        self.extracted += size
+
+    # Record where the content of a page is in the stream, or in the file
+    # of the multifd channel with the given id. Runs of pages that are
+    # contiguous in guest memory and evenly spaced in the same file are
+    # stored as [addr, count, offset, stride, kind, channel].
+    def map_page(self, addr, kind, offset, channel = None):
+        runs = self.page_map[self.name]['runs']
+        if runs:
+            run = runs[-1]
+            if run[4] == kind and run[5] == channel and \
+               run[0] + run[1] * self.TARGET_PAGE_SIZE == addr:
+                if run[1] == 1:
+                    run[1] = 2
+                    run[3] = offset - run[2]
+                    return
+                if run[2] + run[1] * run[3] == offset:
+                    run[1] += 1
+                    return
+        runs.append([addr, 1, offset, 0, kind, channel])
+
+    @staticmethod
+    def decode_xbzrle(old, encoded):
+        page = bytearray(old)
+        encoded = bytearray(encoded)
+        i = 0
+        d = 0
+        while i < len(encoded):
+            # Alternate runs of unchanged and of new bytes, each preceded
+            # by its length as a ULEB128 number of at most two bytes
+            for zrun in (True, False):
+                if len(encoded) - i < 2:
+                    raise Exception("Truncated XBZRLE page")
+                count = encoded[i] & 0x7f
+                if encoded[i] & 0x80:
+                    i += 1
+                    count |= encoded[i] << 7
+                i += 1
+                if zrun:
+                    d += count
+                else:
+                    if count == 0 or i + count > len(encoded):
+                        raise Exception("Invalid XBZRLE page")
+                    page[d:d + count] = encoded[i:i + count]
+                    d += count
+                    i += count
+                if d > len(page):
+                    raise Exception("XBZRLE page overflow")
+        return page
+
+    @staticmethod
+    def decode_zlib(encoded, page_size):
+        try:
+            page = bytearray(zlib.decompress(encoded))
+        except zlib.error as e:
+            raise Exception("Invalid compressed page: %s" % e)
+        if len(page) != page_size:
+            raise Exception("Invalid compressed page")
+        return page
+
+    def get_page(self, addr, name = None):
+        if name is None:
+            name = self.name
+        page = addr // self.TARGET_PAGE_SIZE
+        value = self.page_cache[name][page]
+        if value > 0:
+            data = self.file.data
+            offset = value
+            for channel in self.channels:
+                if value >= channel.base:
+                    data = channel.file.data
+                    offset = value - channel.base
+            return data[offset:offset + self.TARGET_PAGE_SIZE]
+        if value == self.CACHED_DECODED:
+            return self.decoded[(name, page)]
+        if value == 0:
+            # Never sent
+            return bytearray(self.TARGET_PAGE_SIZE)
+        return struct.pack('B', -1 - value) * self.TARGET_PAGE_SIZE
+
+    def dump_page(self, addr):
+        page = addr // self.TARGET_PAGE_SIZE
+        seen = self.dump_seen[self.name]
+        if not seen[page]:
+            seen[page] = 1
+            block = self.dump_blocks.index(self.name)
+            self.dump_order.append(block << 40 | page)
+
+    # The dumped pages with their last content, as a key and a string
+    def memory_items(self):
+        for entry in self.dump_order:
+            name = self.dump_blocks[entry >> 40]
+            addr = (entry & ((1 << 40) - 1)) * self.TARGET_PAGE_SIZE
+            key = '%s (0x%016x)' % (name, addr)
+            value = self.page_cache[name][addr // self.TARGET_PAGE_SIZE]
+            if value < 0 and value != self.CACHED_DECODED:
+                yield key, 'Filled with 0x%02x' % (-1 - value)
+            else:
+                yield key, hexstr(self.get_page(addr, name))
+
+    # Drop the decoded content of pages of a RAMBlock that is not needed
+    # any more; the pages cannot be looked up afterwards
+    def forget_decoded(self, name, start, end):
+        if not self.decoded:
+            return
+        for page in range(start, end):
+            self.decoded.pop((name, page), None)
+
+    def set_page(self, addr, value):
+        page = addr // self.TARGET_PAGE_SIZE
+        cache = self.page_cache[self.name]
+        if cache[page] == self.CACHED_DECODED:
+            del self.decoded[(self.name, page)]
+        cache[page] = value
+
+    @staticmethod
+    def new_stats():
+        stats = collections.OrderedDict()
+        for key in ('pages', 'normal', 'zero', 'filled', 'xbzrle',
+                    'compressed', 'resent', 'bytes'):
+            stats[key] = 0
+        return stats
+
+    # Overall and per-iteration statistics. Pages are sent once per
+    # iteration, so a page that was already sent starts a new one.
+    def account_page(self, addr, kind, size):
+        if self.totals is not None:
+            self.totals['pages'] += 1
+            self.totals[kind] += 1
+            self.totals['bytes'] += size
+        if self.iterations is None:
+            return
+        page = addr // self.TARGET_PAGE_SIZE
+        sent = self.sent[self.name]
+        if not self.iterations or sent[page]:
+            for name in self.sent:
+                self.sent[name] = bytearray(len(self.sent[name]))
+            sent = self.sent[self.name]
+            self.iterations.append(self.new_stats())
+        stats = self.iterations[-1]
+        sent[page] = 1
+        stats['pages'] += 1
+        stats[kind] += 1
+        if self.ever_sent[self.name][page]:
+            stats['resent'] += 1
+            if self.totals is not None:
+                self.totals['resent'] += 1
+        self.ever_sent[self.name][page] = 1
+        stats['bytes'] += size
+
+    def page_stats(self):
+        stats = collections.OrderedDict(self.totals)
+        if self.iterations is not None:
+            stats['iterations'] = len(self.iterations)
+        else:
+            del stats['resent']
+        if stats['pages']:
+            stats['zero ratio'] = round(float(stats['zero']) / stats['pages'], 4)
+        # The estimate may be a little above the exact count
+        distinct = min(self.distinct.estimate(), self.distinct.count)
+        stats['distinct normal pages'] = distinct
+        if self.distinct.count:
+            stats['duplicate normal pages'] = self.distinct.count - distinct
+            stats['dedup ratio'] = round(1 - float(distinct) / self.distinct.count, 4)
+        return stats
+
+    def iteration_stats(self):
+        result = []
+        for stats in self.iterations:
+            stats = collections.OrderedDict(stats)
+            stats['zero ratio'] = round(float(stats['zero']) / stats['pages'], 4)
+            if stats['resent']:
+                stats['xbzrle hit ratio'] = round(float(stats['xbzrle']) / stats['resent'], 4)
+            result.append(stats)
+        return result
+
+    # A page sent in full at the current position of file, which is the
+    # main stream or a multifd channel at offset base in the page cache
+    def read_page(self, addr, file, base, start):
+        if self.page_cache is not None:
+            self.set_page(addr, base + file.tell())
+        if self.write_memory or self.distinct is not None:
+            data = file.readview(self.TARGET_PAGE_SIZE)
+        else: # Just skip RAM data
+            file.seek(self.TARGET_PAGE_SIZE, os.SEEK_CUR)
+
+        if self.distinct is not None:
+            digest = hashlib.sha1(data).digest()
+            self.distinct.add(struct.unpack_from('<Q', digest)[0])
+
+        if self.write_memory:
+            self.write_page(addr, data)
+            self.written[self.name][addr // self.TARGET_PAGE_SIZE] = 1
+        if self.dump_memory:
+            self.dump_page(addr)
+
+        if self.accounting:
+            self.account_page(addr, 'normal', file.tell() - start)
+
+    # Apply the pages sent on the multifd channels since the previous
+    # sync point.  The source synchronises all channels before each
+    # RAM_SAVE_FLAG_EOS, and sends a page at most once in between, so
+    # replaying the packets of all channels in the order they were
+    # numbered in puts every page update in its place.
+    def read_multifd(self):
+        packets = []
+        for channel in self.channels:
+            packets.extend(channel.read_packets(self.TARGET_PAGE_SIZE))
+        packets.sort(key = lambda packet: packet[0])
+        for packet_num, channel, name, offsets, pos in packets:
+            start = time.time()
+            if name not in self.sizeinfo:
+                raise Exception("Multifd packet %d for unknown RAMBlock %s" % (packet_num, name))
+            self.name = name
+            channel.file.seek(pos)
+            for offset in offsets:
+                if self.page_map is not None:
+                    self.map_page(offset, self.PAGE_DATA, channel.file.tell(), channel.id)
+                self.read_page(offset, channel.file, channel.base, channel.file.tell())
+            channel.elapsed += time.time() - start
+
     def read(self):
         # Read all RAM sections
         while True:
+            start = self.file.tell()
             addr = self.file.read64()
             flags = addr & (self.TARGET_PAGE_SIZE - 1)
             addr &= ~(self.TARGET_PAGE_SIZE - 1)
@@ -156,7 +580,7 @@ class RamSection(object):
                     # a zero here we know it has to be an address, not the
                     # length of the next block.
                     if namelen == 0:
-                        self.file.file.seek(-1, 1)
+                        self.file.seek(-1, os.SEEK_CUR)
                         break
                     self.name = self.file.readstr(len = namelen)
                     len = self.file.read64()
@@ -166,8 +590,20 @@ class RamSection(object):
                         mkdir_p('./' + os.path.dirname(self.name))
                         f = open('./' + self.name, "wb")
                         f.truncate(0)
+                        # Pages never written stay holes
                         f.truncate(len)
                         self.files[self.name] = f
+                        self.written[self.name] = bytearray(len // self.TARGET_PAGE_SIZE)
+                    if self.page_map is not None:
+                        self.page_map[self.name] = { 'size' : len, 'runs' : [] }
+                    if self.page_cache is not None:
+                        self.page_cache[self.name] = self.int64_array(len // self.TARGET_PAGE_SIZE)
+                    if self.dump_memory:
+                        self.dump_blocks.append(self.name)
+                        self.dump_seen[self.name] = bytearray(len // self.TARGET_PAGE_SIZE)
+                    if self.iterations is not None:
+                        self.sent[self.name] = bytearray(len // self.TARGET_PAGE_SIZE)
+                        self.ever_sent[self.name] = bytearray(len // self.TARGET_PAGE_SIZE)
                 flags &= ~self.RAM_SAVE_FLAG_MEM_SIZE
 
             if flags & self.RAM_SAVE_FLAG_COMPRESS:
@@ -175,13 +611,26 @@ class RamSection(object):
                     flags &= ~self.RAM_SAVE_FLAG_CONTINUE
                 else:
                     self.name = self.file.readstr()
+                if self.page_map is not None:
+                    self.map_page(addr, self.PAGE_FILL, self.file.tell())
                 fill_char = self.file.read8()
-                # The page in question is filled with fill_char now
-                if self.write_memory and fill_char != 0:
-                    self.files[self.name].seek(addr, os.SEEK_SET)
-                    self.files[self.name].write(chr(fill_char) * self.TARGET_PAGE_SIZE)
+                # The page in question is filled with fill_char now. A zero
+                # page only needs writing if it replaces earlier data.
+                if self.write_memory:
+                    written = self.written[self.name]
+                    page = addr // self.TARGET_PAGE_SIZE
+                    if fill_char != 0 or written[page]:
+                        if fill_char not in self.fill_pages:
+                            self.fill_pages[fill_char] = struct.pack('B', fill_char & 0xff) * self.TARGET_PAGE_SIZE
+                        self.write_page(addr, self.fill_pages[fill_char])
+                        written[page] = fill_char != 0
                 if self.dump_memory:
-                    self.memory['%s (0x%016x)' % (self.name, addr)] = 'Filled with 0x%02x' % fill_char
+                    self.dump_page(addr)
+                if self.page_cache is not None:
+                    self.set_page(addr, -1 - (fill_char & 0xff))
+                if self.accounting:
+                    self.account_page(addr, 'filled' if fill_char else 'zero',
+                                      self.file.tell() - start)
                 flags &= ~self.RAM_SAVE_FLAG_COMPRESS
             elif flags & self.RAM_SAVE_FLAG_PAGE:
                 if flags & self.RAM_SAVE_FLAG_CONTINUE:
@@ -189,26 +638,73 @@ class RamSection(object):
                 else:
                     self.name = self.file.readstr()
 
-                if self.write_memory or self.dump_memory:
-                    data = self.file.readvar(size = self.TARGET_PAGE_SIZE)
-                else: # Just skip RAM data
-                    self.file.file.seek(self.TARGET_PAGE_SIZE, 1)
+                if self.page_map is not None:
+                    self.map_page(addr, self.PAGE_DATA, self.file.tell())
+                self.read_page(addr, self.file, 0, start)
+                flags &= ~self.RAM_SAVE_FLAG_PAGE
+            elif flags & self.RAM_SAVE_FLAG_XBZRLE:
+                if flags & self.RAM_SAVE_FLAG_CONTINUE:
+                    flags &= ~self.RAM_SAVE_FLAG_CONTINUE
+                else:
+                    self.name = self.file.readstr()
+
+                if self.page_map is not None:
+                    self.map_page(addr, self.PAGE_XBZRLE, self.file.tell())
+                xh_flags = self.file.read8()
+                xh_len = self.file.read16() & 0xffff
+                if xh_flags != self.ENCODING_FLAG_XBZRLE:
+                    raise Exception("Unknown XBZRLE encoding %x" % xh_flags)
+                if self.page_cache is not None:
+                    data = self.decode_xbzrle(self.get_page(addr),
+                                              self.file.readvar(xh_len))
+                    self.set_page(addr, self.CACHED_DECODED)
+                    self.decoded[(self.name, addr // self.TARGET_PAGE_SIZE)] = data
+                else:
+                    self.file.seek(xh_len, os.SEEK_CUR)
 
                 if self.write_memory:
-                    self.files[self.name].seek(addr, os.SEEK_SET)
-                    self.files[self.name].write(data)
+                    self.write_page(addr, data)
+                    self.written[self.name][addr // self.TARGET_PAGE_SIZE] = 1
                 if self.dump_memory:
-                    hexdata = " ".join("{0:02x}".format(ord(c)) for c in data)
-                    self.memory['%s (0x%016x)' % (self.name, addr)] = hexdata
+                    self.dump_page(addr)
+                if self.accounting:
+                    self.account_page(addr, 'xbzrle', self.file.tell() - start)
+                flags &= ~self.RAM_SAVE_FLAG_XBZRLE
+            elif flags & self.RAM_SAVE_FLAG_COMPRESS_PAGE:
+                # Page compressed with zlib by the compression threads
+                if flags & self.RAM_SAVE_FLAG_CONTINUE:
+                    flags &= ~self.RAM_SAVE_FLAG_CONTINUE
+                else:
+                    self.name = self.file.readstr()
 
-                flags &= ~self.RAM_SAVE_FLAG_PAGE
-            elif flags & self.RAM_SAVE_FLAG_XBZRLE:
-                raise Exception("XBZRLE RAM compression is not supported yet")
+                if self.page_map is not None:
+                    self.map_page(addr, self.PAGE_ZLIB, self.file.tell())
+                size = self.file.read32()
+                if self.page_cache is not None:
+                    data = self.decode_zlib(self.file.readvar(size),
+                                            self.TARGET_PAGE_SIZE)
+                    self.set_page(addr, self.CACHED_DECODED)
+                    self.decoded[(self.name, addr // self.TARGET_PAGE_SIZE)] = data
+                else:
+                    self.file.seek(size, os.SEEK_CUR)
+
+                if self.write_memory:
+                    self.write_page(addr, data)
+                    self.written[self.name][addr // self.TARGET_PAGE_SIZE] = 1
+                if self.dump_memory:
+                    self.dump_page(addr)
+                if self.accounting:
+                    self.account_page(addr, 'compressed', self.file.tell() - start)
+                flags &= ~self.RAM_SAVE_FLAG_COMPRESS_PAGE
             elif flags & self.RAM_SAVE_FLAG_HOOK:
                 raise Exception("RAM hooks don't make sense with files")
 
             # End of RAM section
             if flags & self.RAM_SAVE_FLAG_EOS:
+                if self.channels:
+                    self.read_multifd()
+                if self.write_memory:
+                    self.flush_pages()
                 break
 
             if flags != 0:
@@ -216,10 +712,101 @@ class RamSection(object):
 
     def __del__(self):
         if self.write_memory:
+            self.flush_pages()
             for key in self.files:
                 self.files[key].close()
 
 
+# One multifd channel of a migration, captured to its own file.  Each
+# channel starts with an initial packet, then carries packets of up to
+# MULTIFD_PACKET_SIZE worth of normal pages of a single RAMBlock, each
+# made of a fixed size header with the page offsets, followed by the
+# page data.  Zero pages, and every other RAM page encoding, still go
+# through the main stream.
+class MultifdChannel(object):
+    MULTIFD_MAGIC = 0x11223344
+    MULTIFD_VERSION = 1
+    MULTIFD_FLAG_SYNC = 0x1
+
+    # MultiFDInit_t and MultiFDPacket_t without its offset array
+    init_packet = struct.Struct('>II16sB7x32x')
+    packet_header = struct.Struct('>IIIIIIQ32x256s')
+
+    def __init__(self, filename):
+        self.file = MigrationFile(filename)
+        # Offset of the channel in the page cache of RAM sections, as if
+        # the channel files followed the main stream
+        self.base = 0
+        self.elapsed = 0.0
+        magic, version, uuid, self.id = self.file.readstruct(self.init_packet)
+        if magic != self.MULTIFD_MAGIC:
+            raise Exception("Invalid multifd magic %x in %s" % (magic, filename))
+        if version != self.MULTIFD_VERSION:
+            raise Exception("Invalid multifd version %d in %s" % (version, filename))
+        self.uuid = uuid
+        # Position of the next packet; the file is also read from when
+        # the pages of earlier packets are applied
+        self.pos = self.file.tell()
+        self.stats = collections.OrderedDict()
+        self.stats['file'] = filename
+        self.stats['id'] = self.id
+        self.stats['bytes'] = self.file.size
+        for key in ('packets', 'sync packets', 'pages', 'page bytes'):
+            self.stats[key] = 0
+
+    # Packets up to and including the next sync packet, as tuples
+    # (packet number, channel, RAMBlock name, page offsets, position of
+    # the page data)
+    def read_packets(self, page_size):
+        start = time.time()
+        packets = []
+        self.file.seek(self.pos)
+        while True:
+            if self.file.tell() == self.file.size:
+                raise Exception("Multifd channel %d ended before a sync packet" % self.id)
+            magic, version, flags, pages_alloc, pages_used, next_packet_size, \
+                packet_num, ramblock = self.file.readstruct(self.packet_header)
+            if magic != self.MULTIFD_MAGIC or version != self.MULTIFD_VERSION:
+                raise Exception("Invalid multifd packet in %s at 0x%x" %
+                                (self.file.filename, self.file.tell() - self.packet_header.size))
+            if pages_used > pages_alloc:
+                raise Exception("Multifd packet with %d pages out of %d" % (pages_used, pages_alloc))
+            offsets = struct.unpack_from('>%dQ' % pages_used, self.file.data, self.file.tell())
+            self.file.seek(8 * pages_alloc, os.SEEK_CUR)
+            pos = self.file.tell()
+            self.file.seek(pages_used * page_size, os.SEEK_CUR)
+            if self.file.tell() > self.file.size:
+                raise self.file.unexpected_eof()
+            if str is not bytes:
+                ramblock = ramblock.decode('latin-1')
+            self.stats['packets'] += 1
+            self.stats['pages'] += pages_used
+            self.stats['page bytes'] += pages_used * page_size
+            if pages_used:
+                packets.append((packet_num, self, ramblock.split('\0', 1)[0], offsets, pos))
+            if flags & self.MULTIFD_FLAG_SYNC:
+                self.stats['sync packets'] += 1
+                break
+        self.pos = self.file.tell()
+        self.elapsed += time.time() - start
+        return packets
+
+    def check_end(self):
+        if self.pos != self.file.size:
+            raise Exception("Unexpected data after the last sync packet of multifd channel %d" % self.id)
+
+    def getStats(self):
+        stats = collections.OrderedDict(self.stats)
+        stats['overhead'] = stats['bytes'] - stats['page bytes']
+        stats['seconds'] = round(self.elapsed, 3)
+        if self.elapsed:
+            stats['MiB/s'] = round(stats['bytes'] / self.elapsed / (1 << 20), 1)
+        return stats
+
+    def close(self):
+        self.file.close()
+
+
 class HTABSection(object):
     HASH_PTE_SIZE_64       = 16
 
@@ -265,110 +852,199 @@ class ConfigurationSection(object):
         name_len = self.file.read32()
         name = self.file.readstr(len = name_len)
 
-class VMSDFieldGeneric(object):
-    def __init__(self, desc, file):
-        self.file = file
-        self.desc = desc
-        self.data = ""
-
-    def __repr__(self):
-        return str(self.__str__())
-
-    def __str__(self):
-        return " ".join("{0:02x}".format(ord(c)) for c in self.data)
-
-    def getDict(self):
-        return self.__str__()
-
-    def read(self):
-        size = int(self.desc['size'])
-        self.data = self.file.readvar(size)
-        return self.data
-
-class VMSDFieldInt(VMSDFieldGeneric):
-    def __init__(self, desc, file):
-        super(VMSDFieldInt, self).__init__(desc, file)
-        self.size = int(desc['size'])
-        self.format = '0x%%0%dx' % (self.size * 2)
-        self.sdtype = '>i%d' % self.size
-        self.udtype = '>u%d' % self.size
-
-    def __repr__(self):
-        if self.data < 0:
-            return ('%s (%d)' % ((self.format % self.udata), self.data))
-        else:
-            return self.format % self.data
-
-    def __str__(self):
-        return self.__repr__()
-
-    def getDict(self):
-        return self.__str__()
-
-    def read(self):
-        super(VMSDFieldInt, self).read()
-        self.sdata = np.fromstring(self.data, count=1, dtype=(self.sdtype))[0]
-        self.udata = np.fromstring(self.data, count=1, dtype=(self.udtype))[0]
-        self.data = self.sdata
-        return self.data
-
-class VMSDFieldUInt(VMSDFieldInt):
-    def __init__(self, desc, file):
-        super(VMSDFieldUInt, self).__init__(desc, file)
-
-    def read(self):
-        super(VMSDFieldUInt, self).read()
-        self.data = self.udata
-        return self.data
-
-class VMSDFieldIntLE(VMSDFieldInt):
-    def __init__(self, desc, file):
-        super(VMSDFieldIntLE, self).__init__(desc, file)
-        self.dtype = '<i%d' % self.size
-
-class VMSDFieldBool(VMSDFieldGeneric):
-    def __init__(self, desc, file):
-        super(VMSDFieldBool, self).__init__(desc, file)
-
-    def __repr__(self):
-        return self.data.__repr__()
-
-    def __str__(self):
-        return self.data.__str__()
-
-    def getDict(self):
-        return self.data
-
-    def read(self):
-        super(VMSDFieldBool, self).read()
-        if self.data[0] == 0:
-            self.data = False
-        else:
-            self.data = True
-        return self.data
+# How each VMSD field type is decoded: as a bool, a signed or unsigned
+# integer in the given byte order, a nested struct, or (for all the
+# other types) as raw bytes
+vmsd_field_types = {
+    "bool" : ('bool', None),
+    "int8" : ('int', '>'),
+    "int16" : ('int', '>'),
+    "int32" : ('int', '>'),
+    "int32 equal" : ('int', '>'),
+    "int32 le" : ('int', '<'),
+    "int64" : ('int', '>'),
+    "uint8" : ('uint', '>'),
+    "uint16" : ('uint', '>'),
+    "uint32" : ('uint', '>'),
+    "uint32 equal" : ('uint', '>'),
+    "uint64" : ('uint', '>'),
+    "int64 equal" : ('int', '>'),
+    "uint8 equal" : ('int', '>'),
+    "uint16 equal" : ('int', '>'),
+    "struct" : ('struct', None),
+}
 
-class VMSDFieldStruct(VMSDFieldGeneric):
+# Decoder for the fields and subsections of a VMSD description, compiled
+# once per device type.  Consecutive fields of fixed size, including
+# arrays and nested structs without subsections, are read with a single
+# struct unpack and turned into plain dicts, lists and strings.
+class VMSDPlan(object):
     QEMU_VM_SUBSECTION    = 0x05
 
-    def __init__(self, desc, file):
-        super(VMSDFieldStruct, self).__init__(desc, file)
-        self.data = collections.OrderedDict()
+    int_codes = { 1 : 'b', 2 : 'h', 4 : 'i', 8 : 'q' }
+
+    # Plans by description, shared by all instances of a device type
+    plans = { }
+
+    @classmethod
+    def get(cls, desc):
+        key = repr((desc.get('fields'), desc.get('subsections')))
+        plan = cls.plans.get(key)
+        if plan is None:
+            plan = cls.plans[key] = cls(desc)
+        return plan
+
+    def __init__(self, desc):
+        # Steps are ('run', struct, converters, slots) for runs of fixed
+        # size fields, and ('struct', name, index, count, plan) for nested
+        # structs of variable size.  Each unpacked value goes through its
+        # converter, then each slot (name, index, count, slots) takes one
+        # value, count values, or builds a nested struct from its slots.
+        self.steps = []
+        run = ([], [], [])
+        for field in desc['fields']:
+            name = field['name']
+            index = field.get('index')
+            count = field.get('array_len')
+            if field['type'] == 'struct':
+                plan = VMSDPlan.get(field['struct'])
+                if not plan.fixed:
+                    self.add_run(*run)
+                    run = ([], [], [])
+                    self.steps.append(('struct', name, index, count, plan))
+                    continue
+                codes, converters, slots = plan.run
+                for i in range(count or 1):
+                    run[0].append(codes)
+                    run[1].extend(converters)
+                run[2].append((name, index, count, slots))
+            else:
+                code, converter = self.compile_field(field)
+                if count is None:
+                    run[0].append(code)
+                    run[1].append(converter)
+                else:
+                    run[0].append(self.repeat(code, count))
+                    run[1].extend([converter] * count)
+                run[2].append((name, index, count, None))
+        self.add_run(*run)
+
+        self.subsections = [(subsection['vmsd_name'], VMSDPlan.get(subsection))
+                            for subsection in desc.get('subsections', [])]
+
+        # A fixed plan is a single run, which is inlined in the runs of
+        # the structs containing it
+        self.fixed = not self.subsections and \
+                     all(step[0] == 'run' for step in self.steps)
+        if self.fixed:
+            self.run = (''.join(run[0]), run[1], run[2])
+
+    def add_run(self, codes, converters, slots):
+        if slots:
+            fmt = struct.Struct('>' + ''.join(codes))
+            self.steps.append(('run', fmt, converters, slots))
+
+    @staticmethod
+    def repeat(code, count):
+        if code[0].isdigit() or len(code) > 1:
+            return code * count
+        return '%d%s' % (count, code)
+
+    def compile_field(self, field):
+        kind, byte_order = vmsd_field_types.get(field['type'], ('buffer', None))
+        size = int(field['size'])
+        if kind in ('int', 'uint') and size not in self.int_codes:
+            kind = 'buffer'
+
+        if kind == 'bool':
+            # Only the first byte matters
+            return '?' + ('%dx' % (size - 1) if size > 1 else ''), bool
+        if kind == 'buffer':
+            return '%ds' % size, hexstr
+
+        fmt = '0x%%0%dx' % (size * 2)
+        if kind == 'uint':
+            convert = fmt.__mod__
+        else:
+            mask = (1 << (size * 8)) - 1
+            def convert(value):
+                if value < 0:
+                    return '%s (%d)' % (fmt % (value & mask), value)
+                return fmt % value
+        if byte_order == '>':
+            code = self.int_codes[size]
+            return (code.upper() if kind == 'uint' else code), convert
+        # Runs are big endian, swap the bytes separately
+        sdtype = struct.Struct(byte_order + self.int_codes[size])
+        return '%ds' % size, lambda value: convert(sdtype.unpack(value)[0])
+
+    # Store an element of an array described one element at a time
+    @staticmethod
+    def store(data, name, index, value):
+        array = data.setdefault(name, [])
+        if len(array) != int(index):
+            raise Exception("internal index of data field unmatched (%d/%d)" % (len(array), int(index)))
+        array.append(value)
+
+    # Fill data from the converted values of a run, starting at pos
+    def build(self, data, slots, values, pos):
+        for name, index, count, struct_slots in slots:
+            if struct_slots is not None:
+                if count is None:
+                    value = collections.OrderedDict()
+                    pos = self.build(value, struct_slots, values, pos)
+                else:
+                    value = []
+                    for i in range(count):
+                        element = collections.OrderedDict()
+                        pos = self.build(element, struct_slots, values, pos)
+                        value.append(element)
+            elif count is None:
+                value = values[pos]
+                pos += 1
+            else:
+                value = values[pos:pos + count]
+                pos += count
+            if index is None:
+                data[name] = value
+            else:
+                self.store(data, name, index, value)
+        return pos
+
+    def read(self, file):
+        data = collections.OrderedDict()
+        for step in self.steps:
+            if step[0] == 'run':
+                fmt, converters, slots = step[1:]
+                values = [convert(value) for convert, value
+                          in zip(converters, file.readstruct(fmt))]
+                self.build(data, slots, values, 0)
+            else:
+                name, index, count, plan = step[1:]
+                if count is None:
+                    value = plan.read(file)
+                else:
+                    value = [plan.read(file) for i in range(count)]
+                if index is None:
+                    data[name] = value
+                else:
+                    self.store(data, name, index, value)
 
-        # When we see compressed array elements, unfold them here
-        new_fields = []
-        for field in self.desc['struct']['fields']:
-            if not 'array_len' in field:
-                new_fields.append(field)
-                continue
-            array_len = field.pop('array_len')
-            field['index'] = 0
-            new_fields.append(field)
-            for i in xrange(1, array_len):
-                c = field.copy()
-                c['index'] = i
-                new_fields.append(c)
+        for vmsd_name, plan in self.subsections:
+            if file.read8() != self.QEMU_VM_SUBSECTION:
+                raise Exception("Subsection %s not found at offset %x" % ( vmsd_name, file.tell()))
+            name = file.readstr()
+            version_id = file.read32()
+            data[name] = plan.read(file)
+        return data
 
-        self.desc['struct']['fields'] = new_fields
+class VMSDSection(object):
+    def __init__(self, file, version_id, device, section_key):
+        self.file = file
+        self.data = ""
+        self.vmsd_name = device.get('vmsd_name', "")
+        self.section_key = section_key
+        self.plan = VMSDPlan.get(device)
 
     def __repr__(self):
         return self.data.__repr__()
@@ -377,103 +1053,10 @@ class VMSDFieldStruct(VMSDFieldGeneric):
         return self.data.__str__()
 
     def read(self):
-        for field in self.desc['struct']['fields']:
-            try:
-                reader = vmsd_field_readers[field['type']]
-            except:
-                reader = VMSDFieldGeneric
-
-            field['data'] = reader(field, self.file)
-            field['data'].read()
-
-            if 'index' in field:
-                if field['name'] not in self.data:
-                    self.data[field['name']] = []
-                a = self.data[field['name']]
-                if len(a) != int(field['index']):
-                    raise Exception("internal index of data field unmatched (%d/%d)" % (len(a), int(field['index'])))
-                a.append(field['data'])
-            else:
-                self.data[field['name']] = field['data']
-
-        if 'subsections' in self.desc['struct']:
-            for subsection in self.desc['struct']['subsections']:
-                if self.file.read8() != self.QEMU_VM_SUBSECTION:
-                    raise Exception("Subsection %s not found at offset %x" % ( subsection['vmsd_name'], self.file.tell()))
-                name = self.file.readstr()
-                version_id = self.file.read32()
-                self.data[name] = VMSDSection(self.file, version_id, subsection, (name, 0))
-                self.data[name].read()
-
-    def getDictItem(self, value):
-       # Strings would fall into the array category, treat
-       # them specially
-       if value.__class__ is ''.__class__:
-           return value
-
-       try:
-           return self.getDictOrderedDict(value)
-       except:
-           try:
-               return self.getDictArray(value)
-           except:
-               try:
-                   return value.getDict()
-               except:
-                   return value
-
-    def getDictArray(self, array):
-        r = []
-        for value in array:
-           r.append(self.getDictItem(value))
-        return r
-
-    def getDictOrderedDict(self, dict):
-        r = collections.OrderedDict()
-        for (key, value) in dict.items():
-            r[key] = self.getDictItem(value)
-        return r
+        self.data = self.plan.read(self.file)
 
     def getDict(self):
-        return self.getDictOrderedDict(self.data)
-
-vmsd_field_readers = {
-    "bool" : VMSDFieldBool,
-    "int8" : VMSDFieldInt,
-    "int16" : VMSDFieldInt,
-    "int32" : VMSDFieldInt,
-    "int32 equal" : VMSDFieldInt,
-    "int32 le" : VMSDFieldIntLE,
-    "int64" : VMSDFieldInt,
-    "uint8" : VMSDFieldUInt,
-    "uint16" : VMSDFieldUInt,
-    "uint32" : VMSDFieldUInt,
-    "uint32 equal" : VMSDFieldUInt,
-    "uint64" : VMSDFieldUInt,
-    "int64 equal" : VMSDFieldInt,
-    "uint8 equal" : VMSDFieldInt,
-    "uint16 equal" : VMSDFieldInt,
-    "float64" : VMSDFieldGeneric,
-    "timer" : VMSDFieldGeneric,
-    "buffer" : VMSDFieldGeneric,
-    "unused_buffer" : VMSDFieldGeneric,
-    "bitmap" : VMSDFieldGeneric,
-    "struct" : VMSDFieldStruct,
-    "unknown" : VMSDFieldGeneric,
-}
-
-class VMSDSection(VMSDFieldStruct):
-    def __init__(self, file, version_id, device, section_key):
-        self.file = file
-        self.data = ""
-        self.vmsd_name = ""
-        self.section_key = section_key
-        desc = device
-        if 'vmsd_name' in device:
-            self.vmsd_name = device['vmsd_name']
-
-        # A section really is nothing but a FieldStruct :)
-        super(VMSDSection, self).__init__({ 'struct' : desc }, file)
+        return self.data
 
 ###############################################################################
 
@@ -488,15 +1071,35 @@ class MigrationDump(object):
     QEMU_VM_SUBSECTION    = 0x05
     QEMU_VM_VMDESCRIPTION = 0x06
     QEMU_VM_CONFIGURATION = 0x07
+    QEMU_VM_COMMAND       = 0x08
     QEMU_VM_SECTION_FOOTER= 0x7e
 
+    # Names and data lengths of the commands, as in mig_cmd_args; -1 is
+    # variable
+    MIG_CMD_ARGS = [ ( 'INVALID', -1 ), ( 'OPEN_RETURN_PATH', 0 ), ( 'PING', 4 ),
+                     ( 'POSTCOPY_ADVISE', -1 ), ( 'POSTCOPY_LISTEN', 0 ),
+                     ( 'POSTCOPY_RUN', 0 ), ( 'POSTCOPY_RAM_DISCARD', -1 ),
+                     ( 'PACKAGED', 4 ), ( 'ENABLE_COLO', 0 ),
+                     ( 'POSTCOPY_RESUME', 0 ), ( 'RECV_BITMAP', -1 ) ]
+    MIG_CMD_PING          = 2
+    MIG_CMD_POSTCOPY_ADVISE = 3
+    MIG_CMD_POSTCOPY_RAM_DISCARD = 6
+    MIG_CMD_PACKAGED      = 7
+    MIG_CMD_RECV_BITMAP   = 10
+
+    TOC_VERSION = 3
+
     def __init__(self, filename):
         self.section_classes = { ( 'ram', 0 ) : [ RamSection, None ],
                                  ( 'spapr/htab', 0) : ( HTABSection, None ) }
         self.filename = filename
         self.vmsd_desc = None
+        self.toc = None
+        self.channels = []
 
-    def read(self, desc_only = False, dump_memory = False, write_memory = False):
+    def read(self, desc_only = False, dump_memory = False, write_memory = False,
+             build_toc = False, iterations = False, stats = False,
+             writer = None, page_cache = False, channels = None):
         # Read in the whole file
         file = MigrationFile(self.filename)
 
@@ -514,23 +1117,93 @@ class MigrationDump(object):
 
         # Read sections
         self.sections = collections.OrderedDict()
+        self.commands = []
 
         if desc_only:
             return
 
+        self.channels = []
+        if channels:
+            self.open_channels(file, channels)
+
         ramargs = {}
-        ramargs['page_size'] = self.vmsd_desc['page_size']
+        # Postcopy streams have no description, but advertise the page
+        # size before any RAM section
+        ramargs['page_size'] = self.vmsd_desc['page_size'] if self.vmsd_desc else None
         ramargs['dump_memory'] = dump_memory
         ramargs['write_memory'] = write_memory
+        ramargs['iterations'] = iterations
+        ramargs['stats'] = stats
+        ramargs['page_cache'] = page_cache
+        ramargs['channels'] = self.channels
+        if stats:
+            self.stats = collections.OrderedDict()
+            self.stats['file size'] = file.size
+            self.stats['header'] = file.tell()
+            self.stats['configuration'] = 0
+            self.stats['sections'] = collections.OrderedDict()
+            self.stats['commands'] = collections.OrderedDict()
+        if build_toc:
+            stat = os.stat(self.filename)
+            self.toc = collections.OrderedDict()
+            self.toc['version'] = self.TOC_VERSION
+            self.toc['size'] = stat.st_size
+            self.toc['mtime'] = stat.st_mtime
+            self.toc['page_size'] = ramargs['page_size']
+            self.toc['channels'] = self.channel_files(channels)
+            self.toc['sections'] = []
+            self.toc['commands'] = self.commands
+            self.toc['ram'] = ramargs['page_map'] = collections.OrderedDict()
+            versions = {}
         self.section_classes[('ram',0)][1] = ramargs
 
+        # The device state sent when switching to postcopy is wrapped in a
+        # package, which the destination loads as a stream of its own;
+        # its sections and commands are read in place.  The package is
+        # LISTEN, the device sections, PING and POSTCOPY_RUN, without an
+        # EOF section, so it ends where its length says.
+        package_end = None
         while True:
+            start = file.tell()
+            if package_end is not None and start >= package_end:
+                if start != package_end:
+                    raise Exception("Postcopy package overrun at 0x%x" % start)
+                package_end = None
             section_type = file.read8()
             if section_type == self.QEMU_VM_EOF:
+                if package_end is not None:
+                    raise Exception("EOF section in postcopy package at 0x%x" % start)
                 break
             elif section_type == self.QEMU_VM_CONFIGURATION:
                 section = ConfigurationSection(file)
                 section.read()
+                if stats:
+                    self.stats['configuration'] = file.tell() - start
+                continue
+            elif section_type == self.QEMU_VM_COMMAND:
+                command = self.read_command(file)
+                self.commands.append(command)
+                if command['command'] == 'POSTCOPY_ADVISE' and \
+                   ramargs['page_size'] is None:
+                    ramargs['page_size'] = command.get('target page size')
+                elif command['command'] == 'PACKAGED':
+                    if self.vmsd_desc is None:
+                        # The device state cannot be decoded without a
+                        # description
+                        command['skipped'] = True
+                        file.seek(command['package length'], os.SEEK_CUR)
+                    else:
+                        package_end = file.tell() + command['package length']
+                command['length'] = file.tell() - start
+                if stats:
+                    entry = self.stats['commands'].get(command['command'])
+                    if entry is None:
+                        entry = self.stats['commands'][command['command']] = collections.OrderedDict()
+                        entry['bytes'] = 0
+                        entry['count'] = 0
+                    entry['bytes'] += command['length']
+                    entry['count'] += 1
+                continue
             elif section_type == self.QEMU_VM_SECTION_START or section_type == self.QEMU_VM_SECTION_FULL:
                 section_id = file.read32()
                 name = file.readstr()
@@ -540,20 +1213,261 @@ class MigrationDump(object):
                 classdesc = self.section_classes[section_key]
                 section = classdesc[0](file, version_id, classdesc[1], section_key)
                 self.sections[section_id] = section
+                if writer is not None:
+                    writer.add_section(section_id, section)
+                offset = file.tell()
                 section.read()
+                if writer is not None and section_type == self.QEMU_VM_SECTION_FULL:
+                    writer.section_done(section_id)
+                if build_toc:
+                    versions[section_id] = version_id
+                    self.add_toc_entry(section_type, section_id, version_id, offset, file.tell())
             elif section_type == self.QEMU_VM_SECTION_PART or section_type == self.QEMU_VM_SECTION_END:
                 section_id = file.read32()
+                offset = file.tell()
                 self.sections[section_id].read()
+                if writer is not None and section_type == self.QEMU_VM_SECTION_END:
+                    writer.section_done(section_id)
+                if build_toc:
+                    self.add_toc_entry(section_type, section_id, versions[section_id], offset, file.tell())
             elif section_type == self.QEMU_VM_SECTION_FOOTER:
                 read_section_id = file.read32()
                 if read_section_id != section_id:
                     raise Exception("Mismatched section footer: %x vs %x" % (read_section_id, section_id))
             else:
                 raise Exception("Unknown section type: %d" % section_type)
+            if stats:
+                # Footers are counted with the section they close
+                self.add_section_bytes(section_id, file.tell() - start,
+                                       section_type != self.QEMU_VM_SECTION_FOOTER)
+        for channel in self.channels:
+            channel.check_end()
+        if build_toc:
+            self.toc['page_size'] = ramargs['page_size']
+        if stats:
+            self.stats['vmsd json'] = self.vmsd_size
+            self.stats['trailer'] = file.size - start - self.vmsd_size
+            ram = collections.OrderedDict()
+            for (key, value) in self.sections.items():
+                if isinstance(value, RamSection):
+                    ram["%s (%d)" % (value.section_key[0], key)] = value.page_stats()
+            self.stats['ram'] = ram
+            if self.channels:
+                self.stats['multifd channels'] = [channel.getStats()
+                                                  for channel in self.channels]
+        # Page contents are read from the stream, so they must be written
+        # out or collected before closing it
+        if writer is not None:
+            writer.close()
+        elif dump_memory:
+            for section in self.sections.values():
+                if isinstance(section, RamSection):
+                    section.memory.update(section.memory_items())
+        if page_cache:
+            # The pages are looked up in the stream
+            self.file = file
+        else:
+            file.close()
+            for channel in self.channels:
+                channel.close()
+
+    def close(self):
+        self.file.close()
+        for channel in self.channels:
+            channel.close()
+
+    # Open the files of the multifd channels, in channel order, and lay
+    # them out after the main stream in the page cache
+    def open_channels(self, file, filenames):
+        self.channels = sorted([MultifdChannel(name) for name in filenames],
+                               key = lambda channel: channel.id)
+        base = file.size
+        for channel in self.channels:
+            if channel.uuid != self.channels[0].uuid:
+                raise Exception("Multifd channels %s and %s are from different VMs" %
+                                (self.channels[0].file.filename, channel.file.filename))
+            channel.base = base
+            base += channel.file.size
+
+    # Read a QEMU_VM_COMMAND element, after its type
+    def read_command(self, file):
+        start = file.tell() - 1
+        cmd = file.read16() & 0xffff
+        length = file.read16() & 0xffff
+        if cmd == 0 or cmd >= len(self.MIG_CMD_ARGS):
+            raise Exception("Unknown command %d at 0x%x" % (cmd, start))
+        name, expected = self.MIG_CMD_ARGS[cmd]
+        if expected != -1 and length != expected:
+            raise Exception("Command %s with bad length %d at 0x%x" % (name, length, start))
+        end = file.tell() + length
+        command = collections.OrderedDict()
+        command['command'] = name
+        command['offset'] = start
+        if cmd == self.MIG_CMD_PING:
+            command['value'] = file.read32() & 0xffffffff
+        elif cmd == self.MIG_CMD_POSTCOPY_ADVISE and length == 16:
+            command['host page sizes'] = file.read64()
+            command['target page size'] = file.read64()
+        elif cmd == self.MIG_CMD_POSTCOPY_RAM_DISCARD:
+            # Version, RAMBlock name with a NULL terminator, then ranges
+            # of addresses as start and length
+            file.read8()
+            command['block'] = file.readstr()
+            file.read8()
+            discarded = 0
+            ranges = (end - file.tell()) // 16
+            for i in range(ranges):
+                file.read64()
+                discarded += file.read64()
+            command['ranges'] = ranges
+            command['discarded'] = discarded
+        elif cmd == self.MIG_CMD_PACKAGED:
+            command['package length'] = file.read32() & 0xffffffff
+        elif cmd == self.MIG_CMD_RECV_BITMAP:
+            command['block'] = file.readstr()
+        if file.tell() > end:
+            raise Exception("Truncated command %s at 0x%x" % (name, start))
+        file.seek(end)
+        return command
+
+    def add_section_bytes(self, section_id, size, part):
+        key = "%s (%d)" % (self.sections[section_id].section_key[0], section_id)
+        entry = self.stats['sections'].get(key)
+        if entry is None:
+            entry = self.stats['sections'][key] = collections.OrderedDict()
+            entry['bytes'] = 0
+            entry['parts'] = 0
+        entry['bytes'] += size
+        if part:
+            entry['parts'] += 1
+
+    def add_toc_entry(self, section_type, section_id, version_id, offset, end):
+        section = self.sections[section_id]
+        entry = collections.OrderedDict()
+        entry['type'] = section_type
+        entry['id'] = section_id
+        entry['name'] = section.section_key[0]
+        entry['instance_id'] = section.section_key[1]
+        entry['version_id'] = version_id
+        entry['offset'] = offset
+        entry['length'] = end - offset
+        self.toc['sections'].append(entry)
+
+    # The files of the multifd channels as recorded in the table of
+    # contents, which is only valid for the same set of files
+    @staticmethod
+    def channel_files(filenames):
+        result = []
+        for name in filenames or []:
+            stat = os.stat(name)
+            entry = collections.OrderedDict()
+            entry['file'] = os.path.abspath(name)
+            entry['size'] = stat.st_size
+            entry['mtime'] = stat.st_mtime
+            result.append(entry)
+        return result
+
+    # Load the table of contents cached next to the stream, or build it
+    # with a full pass and try to cache it.  Pages sent on multifd
+    # channels are only found if the channel files are given.
+    def load_toc(self, channels = None):
+        path = self.filename + '.toc'
+        stat = os.stat(self.filename)
+        files = self.channel_files(channels)
+        try:
+            with open(path) as f:
+                toc = json.load(f, object_pairs_hook=collections.OrderedDict)
+            if toc['version'] == self.TOC_VERSION and \
+               toc['size'] == stat.st_size and toc['mtime'] == stat.st_mtime and \
+               sorted(toc['channels'], key = lambda entry: entry['file']) == \
+               sorted(files, key = lambda entry: entry['file']):
+                self.toc = toc
+                return self.toc
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            pass
+        self.read(build_toc = True, channels = channels)
+        try:
+            with open(path, 'w') as f:
+                json.dump(self.toc, f)
+        except (IOError, OSError):
+            pass
+        return self.toc
+
+    # Read the state of a single device, seeking directly to its section
+    def read_device(self, name, instance_id = 0, channels = None):
+        self.load_toc(channels)
+        file = MigrationFile(self.filename)
+        self.load_vmsd_json(file)
+        self.sections = collections.OrderedDict()
+        for entry in self.toc['sections']:
+            if entry['name'] != name or entry['instance_id'] != instance_id:
+                continue
+            classdesc = self.section_classes[(name, instance_id)]
+            if classdesc[0] is not VMSDSection:
+                raise Exception("Section %s is not a device state section" % name)
+            section = VMSDSection(file, entry['version_id'], classdesc[1], (name, instance_id))
+            file.seek(entry['offset'])
+            section.read()
+            self.sections[entry['id']] = section
         file.close()
+        if not self.sections:
+            raise Exception("No section %s (%d) in %s" % (name, instance_id, self.filename))
+
+    # Return the final content of a range of guest memory of a RAMBlock,
+    # seeking directly to the pages that cover it
+    def read_ram(self, block, start, length, channels = None):
+        self.load_toc(channels)
+        page_size = self.toc['page_size']
+        try:
+            runs = self.toc['ram'][block]['runs']
+        except KeyError:
+            raise Exception("No RAMBlock %s in %s" % (block, self.filename))
+        # Pages of multifd channels are in the channel files, by id
+        files = { None : MigrationFile(self.filename) }
+        for entry in self.toc['channels']:
+            channel = MultifdChannel(entry['file'])
+            files[channel.id] = channel.file
+        # Work on whole pages, as XBZRLE pages are encoded against the
+        # whole previous content
+        first_page = start - start % page_size
+        end = start + length
+        end += -end % page_size
+        data = bytearray(end - first_page)
+        # Runs are in stream order, so later page versions win
+        for addr, count, offset, stride, kind, channel in runs:
+            if addr >= end or addr + count * page_size <= first_page:
+                continue
+            file = files[channel]
+            first = max(0, (first_page - addr) // page_size)
+            last = min(count, (end - addr) // page_size)
+            for i in range(first, last):
+                pos = addr + i * page_size - first_page
+                file.seek(offset + i * stride)
+                if kind == RamSection.PAGE_DATA:
+                    page = file.readvar(page_size)
+                elif kind == RamSection.PAGE_FILL:
+                    page = struct.pack('B', file.read8() & 0xff) * page_size
+                elif kind == RamSection.PAGE_ZLIB:
+                    page = RamSection.decode_zlib(file.readvar(file.read32()),
+                                                  page_size)
+                else:
+                    file.read8()
+                    xh_len = file.read16() & 0xffff
+                    page = RamSection.decode_xbzrle(data[pos:pos + page_size],
+                                                    file.readvar(xh_len))
+                data[pos:pos + page_size] = page
+        for file in files.values():
+            file.close()
+        return data[start - first_page:start - first_page + length]
 
     def load_vmsd_json(self, file):
         vmsd_json = file.read_migration_debug_json()
+        if vmsd_json is None:
+            # Postcopy streams end without a description
+            self.vmsd_size = 0
+            self.vmsd_desc = None
+            return
+        self.vmsd_size = len(vmsd_json.encode('utf-8'))
         self.vmsd_desc = json.loads(vmsd_json, object_pairs_hook=collections.OrderedDict)
         for device in self.vmsd_desc['devices']:
             key = (device['name'], device['instance_id'])
@@ -569,46 +1483,394 @@ class MigrationDump(object):
 
 ###############################################################################
 
-class JSONEncoder(json.JSONEncoder):
-    def default(self, o):
-        if isinstance(o, VMSDFieldGeneric):
-            return str(o)
-        return json.JSONEncoder.default(self, o)
+# Compare two streams of the same VM, for example two snapshots saved at
+# different times: device state field by field, and guest memory page by
+# page.  Each stream keeps the offset of the last version of each page,
+# in the stream or in its multifd channels, and pages are hashed and
+# compared in place.  Memory use is 8 bytes per page per stream for
+# these offsets and one bit per page for the changed bitmaps, plus a
+# copy of each page whose last version is XBZRLE or zlib encoded, kept
+# from the parse until the block of pages it is in has been compared.
+class MigrationDiff(object):
+    # Pages hashed at once; only the pages of blocks whose hash differs
+    # are compared
+    BLOCK_PAGES = 64
+
+    def __init__(self, old, new, old_channels = None, new_channels = None):
+        self.old = MigrationDump(old)
+        self.new = MigrationDump(new)
+        self.old_channels = old_channels
+        self.new_channels = new_channels
+        # Changed page bitmaps by RAMBlock name, one bit per page
+        self.bitmaps = collections.OrderedDict()
+
+    @staticmethod
+    def sections_by_key(dump, cls):
+        result = collections.OrderedDict()
+        for (section_id, section) in dump.sections.items():
+            if isinstance(section, cls):
+                result["%s (%d)" % section.section_key] = section
+        return result
+
+    # Append the differences between two decoded values to result, as
+    # (path, old, new)
+    def diff_values(self, path, old, new, result):
+        if isinstance(old, dict) and isinstance(new, dict):
+            for (key, value) in old.items():
+                subpath = path + '.' + key if path else key
+                if key in new:
+                    self.diff_values(subpath, value, new[key], result)
+                else:
+                    result.append((subpath, value, None))
+            for (key, value) in new.items():
+                if key not in old:
+                    result.append((path + '.' + key if path else key, None, value))
+        elif isinstance(old, list) and isinstance(new, list) and len(old) == len(new):
+            for i in range(len(old)):
+                self.diff_values('%s[%d]' % (path, i), old[i], new[i], result)
+        elif old != new:
+            result.append((path, old, new))
+
+    def diff_devices(self):
+        old = self.sections_by_key(self.old, VMSDSection)
+        new = self.sections_by_key(self.new, VMSDSection)
+        devices = collections.OrderedDict()
+        for (key, section) in old.items():
+            if key not in new:
+                continue
+            changes = []
+            self.diff_values('', section.getDict(), new[key].getDict(), changes)
+            if changes:
+                devices[key] = collections.OrderedDict(
+                    (path, [a, b]) for (path, a, b) in changes)
+        result = collections.OrderedDict()
+        result['changed'] = devices
+        result['added'] = [key for key in new if key not in old]
+        result['removed'] = [key for key in old if key not in new]
+        return result
+
+    @staticmethod
+    def same_page(old, new, name, page):
+        a = old.page_cache[name][page]
+        b = new.page_cache[name][page]
+        # Zero and filled pages, or pages never sent (which are zero)
+        if a <= 0 and b <= 0 and RamSection.CACHED_DECODED not in (a, b):
+            return (a or -1) == (b or -1)
+        addr = page * old.TARGET_PAGE_SIZE
+        return old.get_page(addr, name) == new.get_page(addr, name)
+
+    # If the pages of a block are evenly spaced in the main stream, return
+    # the offset and length of the data between the first and the last
+    @staticmethod
+    def span(offsets, page_size, size):
+        first = offsets[0]
+        if first <= 0 or len(offsets) < 2:
+            return None
+        stride = offsets[1] - first
+        if stride < page_size:
+            return None
+        for i in range(2, len(offsets)):
+            if offsets[i] - offsets[i - 1] != stride:
+                return None
+        length = offsets[-1] - first + page_size
+        if first + length > size:
+            return None
+        return first, length
+
+    # Hash of the content of pages start to end of a RAMBlock.  Pages sent
+    # in full and evenly spaced are hashed in one go, headers included;
+    # zero and filled pages are hashed as their fill byte.  Blocks with
+    # the same content but laid out differently in the two streams hash
+    # differently, and are left to the page by page comparison.
+    def block_digest(self, section, name, start, end):
+        cache = section.page_cache[name]
+        digest = hashlib.sha1()
+        span = self.span(cache[start:end], section.TARGET_PAGE_SIZE,
+                         section.file.size)
+        if span is not None:
+            section.file.seek(span[0])
+            digest.update(section.file.readview(span[1]))
+            return digest.digest()
+        for page in range(start, end):
+            value = cache[page]
+            if value <= 0 and value != RamSection.CACHED_DECODED:
+                digest.update(struct.pack('>Bx', -1 - value if value else 0))
+            else:
+                digest.update(b'\1')
+                digest.update(section.get_page(page * section.TARGET_PAGE_SIZE, name))
+        return digest.digest()
+
+    def diff_block(self, old, new, name, pages):
+        old_cache = old.page_cache[name]
+        new_cache = new.page_cache[name]
+        bitmap = bytearray((pages + 7) // 8)
+        changed = 0
+        for start in range(0, pages, self.BLOCK_PAGES):
+            end = min(start + self.BLOCK_PAGES, pages)
+            a = old_cache[start:end]
+            b = new_cache[start:end]
+            # Same zero or filled pages
+            if a == b and max(a) < 0 and RamSection.CACHED_DECODED not in a:
+                continue
+            if self.block_digest(old, name, start, end) != \
+               self.block_digest(new, name, start, end):
+                for page in range(start, end):
+                    if not self.same_page(old, new, name, page):
+                        bitmap[page >> 3] |= 1 << (page & 7)
+                        changed += 1
+            old.forget_decoded(name, start, end)
+            new.forget_decoded(name, start, end)
+        self.bitmaps[name] = bitmap
+        return changed
+
+    # Changed pages as ranges of guest addresses
+    def ranges(self, name, page_size):
+        bitmap = self.bitmaps[name]
+        result = []
+        first = None
+        for i in range(len(bitmap)):
+            byte = bitmap[i]
+            if byte == 0 and first is None:
+                continue
+            if byte == 0xff and first is not None:
+                continue
+            for bit in range(8):
+                page = i * 8 + bit
+                if byte & (1 << bit):
+                    if first is None:
+                        first = page
+                elif first is not None:
+                    result.append('0x%x-0x%x' % (first * page_size, page * page_size - 1))
+                    first = None
+        if first is not None:
+            page = len(bitmap) * 8
+            result.append('0x%x-0x%x' % (first * page_size, page * page_size - 1))
+        return result
+
+    def diff_ram(self):
+        old = self.sections_by_key(self.old, RamSection)
+        new = self.sections_by_key(self.new, RamSection)
+        result = collections.OrderedDict()
+        for (key, old_section) in old.items():
+            if key not in new:
+                continue
+            new_section = new[key]
+            page_size = old_section.TARGET_PAGE_SIZE
+            for name in old_section.sizeinfo:
+                block = collections.OrderedDict()
+                result[name] = block
+                if name not in new_section.sizeinfo:
+                    block['removed'] = True
+                    continue
+                old_size = old_section.sizeinfo[name]
+                new_size = new_section.sizeinfo[name]
+                if old_size != new_size:
+                    block['size'] = [old_size, new_size]
+                    continue
+                block['size'] = old_size
+                pages = len(old_section.page_cache[name])
+                changed = self.diff_block(old_section, new_section, name, pages)
+                block['pages'] = pages
+                block['changed pages'] = changed
+                block['changed'] = self.ranges(name, page_size)
+            for name in new_section.sizeinfo:
+                if name not in old_section.sizeinfo:
+                    result[name] = collections.OrderedDict([('added', True)])
+        return result
+
+    def diff(self):
+        self.old.read(page_cache = True, channels = self.old_channels)
+        try:
+            self.new.read(page_cache = True, channels = self.new_channels)
+            try:
+                result = collections.OrderedDict()
+                result['devices'] = self.diff_devices()
+                result['ram'] = self.diff_ram()
+            finally:
+                self.new.close()
+        finally:
+            self.old.close()
+        return result
+
+###############################################################################
+
+# Writes the state dump while the stream is parsed, so that the whole of
+# it never has to be in memory.  Sections are written in the order they
+# start in the stream, as soon as they and the sections before them are
+# complete.  The output is either the same JSON document as getDict()
+# would give, or NDJSON with one object {key: value} per line and per
+# section; RAM sections are then split into one line for their sizes and
+# one line per page.
+class StateWriter(object):
+    def __init__(self, out, ndjson = False):
+        self.out = out
+        self.ndjson = ndjson
+        if ndjson:
+            self.encoder = json.JSONEncoder(separators=(',', ':'))
+        else:
+            self.encoder = json.JSONEncoder(indent=4, separators=(',', ': '))
+        self.queue = collections.OrderedDict()
+        self.empty = True
+
+    def add_section(self, section_id, section):
+        self.queue[section_id] = [section, False]
+
+    def section_done(self, section_id):
+        self.queue[section_id][1] = True
+        while self.queue:
+            section_id, (section, done) = next(iter(self.queue.items()))
+            if not done:
+                break
+            del self.queue[section_id]
+            self.write_section(section_id, section)
+
+    def encode(self, value, indent = 0):
+        text = self.encoder.encode(value)
+        if indent:
+            # Raw newlines cannot appear in JSON strings
+            text = text.replace('\n', '\n' + ' ' * indent)
+        return text
+
+    def write_section(self, section_id, section):
+        key = "%s (%d)" % (section.section_key[0], section_id)
+        memory = isinstance(section, RamSection) and section.dump_memory
+        data = section.getDict()
+        if memory:
+            data = collections.OrderedDict((k, v) for (k, v) in data.items()
+                                           if k != 'memory')
+        if self.ndjson:
+            self.out.write(self.encode({ key : data }) + '\n')
+            if memory:
+                for page, text in section.memory_items():
+                    line = { key : { 'memory' : { page : text } } }
+                    self.out.write(self.encode(line) + '\n')
+            return
+
+        self.out.write('{\n    ' if self.empty else ',\n    ')
+        self.empty = False
+        if not memory:
+            self.out.write(self.encode(key) + ': ' + self.encode(data, 4))
+            return
+        self.out.write(self.encode(key) + ': {')
+        for (k, v) in data.items():
+            self.out.write('\n        ' + self.encode(k) + ': ' +
+                           self.encode(v, 8) + ',')
+        self.out.write('\n        "memory": {')
+        chunk = []
+        separator = '\n            '
+        for page, text in section.memory_items():
+            chunk.append(separator + self.encode(page) + ': ' + self.encode(text))
+            separator = ',\n            '
+            if len(chunk) >= 256:
+                self.out.write(''.join(chunk))
+                chunk = []
+        self.out.write(''.join(chunk))
+        self.out.write('}' if separator == '\n            ' else '\n        }')
+        self.out.write('\n    }')
+
+    def close(self):
+        for (section_id, (section, done)) in self.queue.items():
+            self.write_section(section_id, section)
+        self.queue.clear()
+        if not self.ndjson:
+            self.out.write('{}\n' if self.empty else '\n}\n')
+        self.out.flush()
 
 parser = argparse.ArgumentParser()
 parser.add_argument("-f", "--file", help='migration dump to read from', required=True)
 parser.add_argument("-m", "--memory", help='dump RAM contents as well', action='store_true')
 parser.add_argument("-d", "--dump", help='what to dump ("state" or "desc")', default='state')
+parser.add_argument("--ndjson", help='dump the state as one JSON object per section and per page', action='store_true')
 parser.add_argument("-x", "--extract", help='extract contents into individual files', action='store_true')
+parser.add_argument("-t", "--toc", help='print the table of contents, cached in FILE.toc', action='store_true')
+parser.add_argument("--device", help='dump the state of a single device, as NAME[:INSTANCE]')
+parser.add_argument("--ram", help='dump a range of guest memory, as BLOCK:ADDR:LENGTH')
+parser.add_argument("-i", "--iterations", help='print per-iteration RAM statistics', action='store_true')
+parser.add_argument("-s", "--stats", help='print where the bytes of the stream go', action='store_true')
+parser.add_argument("--diff", metavar='OTHER', help='print the device fields and guest pages that differ in OTHER, a later stream of the same VM')
+parser.add_argument("-c", "--channels", metavar='CHANNEL', nargs='+', help='read RAM pages from the capture files of the multifd channels as well')
+parser.add_argument("--diff-channels", metavar='CHANNEL', nargs='+', help='capture files of the multifd channels of the --diff stream')
 args = parser.parse_args()
 
-jsonenc = JSONEncoder(indent=4, separators=(',', ': '))
+jsonenc = json.JSONEncoder(indent=4, separators=(',', ': '))
 
 if args.extract:
     dump = MigrationDump(args.file)
 
     dump.read(desc_only = True)
-    print("desc.json")
-    f = open("desc.json", "wb")
-    f.truncate()
-    f.write(jsonenc.encode(dump.vmsd_desc))
-    f.close()
-
-    dump.read(write_memory = True)
+    if dump.vmsd_desc is not None:
+        print("desc.json")
+        f = open("desc.json", "w")
+        f.truncate()
+        f.write(jsonenc.encode(dump.vmsd_desc))
+        f.close()
+
+    start = time.time()
+    dump.read(write_memory = True, channels = args.channels)
+    elapsed = time.time() - start
+    extracted = sum(section.extracted for section in dump.sections.values()
+                    if isinstance(section, RamSection))
     dict = dump.getDict()
     print("state.json")
-    f = open("state.json", "wb")
+    f = open("state.json", "w")
     f.truncate()
     f.write(jsonenc.encode(dict))
     f.close()
+    size = os.path.getsize(args.file)
+    size += sum(channel.file.size for channel in dump.channels)
+    summary = ("Extracted %d MiB of RAM from %d MiB of stream in %.2f s" %
+               (extracted >> 20, size >> 20, elapsed))
+    if elapsed:
+        summary += " (%.1f MiB/s)" % (size / elapsed / (1 << 20))
+    print(summary)
+    for channel in dump.channels:
+        stats = channel.getStats()
+        print("Multifd channel %d: %d MiB, %d pages in %d packets (%.1f MiB/s)" %
+              (channel.id, stats['bytes'] >> 20, stats['pages'], stats['packets'],
+               stats.get('MiB/s', 0)))
+elif args.diff:
+    diff = MigrationDiff(args.file, args.diff, args.channels, args.diff_channels)
+    print(jsonenc.encode(diff.diff()))
+elif args.stats:
+    dump = MigrationDump(args.file)
+    dump.read(iterations = args.iterations, stats = True, channels = args.channels)
+    print(jsonenc.encode(dump.stats))
+elif args.iterations:
+    dump = MigrationDump(args.file)
+    dump.read(iterations = True, channels = args.channels)
+    stats = collections.OrderedDict()
+    for (key, value) in dump.sections.items():
+        if isinstance(value, RamSection):
+            stats["%s (%d)" % (value.section_key[0], key)] = value.iteration_stats()
+    print(jsonenc.encode(stats))
+elif args.toc:
+    dump = MigrationDump(args.file)
+    print(jsonenc.encode(dump.load_toc(args.channels)))
+elif args.device:
+    dump = MigrationDump(args.file)
+    name, _, instance_id = args.device.partition(':')
+    dump.read_device(name, int(instance_id or '0'), args.channels)
+    print(jsonenc.encode(dump.getDict()))
+elif args.ram:
+    dump = MigrationDump(args.file)
+    block, start, length = args.ram.rsplit(':', 2)
+    start = int(start, 0)
+    data = dump.read_ram(block, start, int(length, 0), args.channels)
+    page_size = dump.toc['page_size']
+    memory = collections.OrderedDict()
+    for offset in range(0, len(data), page_size):
+        page = data[offset:offset + page_size]
+        memory['%s (0x%016x)' % (block, start + offset)] = hexstr(page)
+    print(jsonenc.encode(memory))
 elif args.dump == "state":
     dump = MigrationDump(args.file)
-    dump.read(dump_memory = args.memory)
-    dict = dump.getDict()
-    print(jsonenc.encode(dict))
+    dump.read(dump_memory = args.memory, channels = args.channels,
+              writer = StateWriter(sys.stdout, ndjson = args.ndjson))
 elif args.dump == "desc":
     dump = MigrationDump(args.file)
     dump.read(desc_only = True)
+    if dump.vmsd_desc is None:
+        raise Exception("No Debug Migration device found")
     print(jsonenc.encode(dump.vmsd_desc))
 else:
     raise Exception("Please specify either -x, -d state or -d dump")
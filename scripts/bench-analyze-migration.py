@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+#
+# Benchmark the migration stream analyzer
+#
+# Copyright (C) 2019 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Usage: bench-analyze-migration.py [options] [MODE...]
+#
+# Generates synthetic streams with gen-migration-stream.py, then runs
+# analyze-migration.py on them in each mode (all of them by default)
+# and reports its throughput: the size of the streams it is given,
+# channel files included, over the best wall clock time of --repeat
+# runs.  Times include the start-up of the interpreter, and modes that
+# seek to a part of the stream (--device, --ram) are reported against
+# the whole stream as well, so that all figures compare across runs of
+# the benchmark rather than between modes.
+#
+# Streams are generated in a temporary directory, or kept in --dir and
+# reused by later runs with the same --ram.  --json prints the results
+# in a form suitable for tracking regressions.
+#
+# --analyzer runs another copy of analyze-migration.py, to compare with
+# an older version.  The "parse" mode reads a stream without XBZRLE
+# pages with -d state, which any version supports:
+#
+#   git show v4.1.0:scripts/analyze-migration.py > /tmp/old.py
+#   bench-analyze-migration.py --ram 4096 --analyzer /tmp/old.py parse
+#   bench-analyze-migration.py --ram 4096 parse
+
+from __future__ import print_function
+import argparse
+import collections
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+SCRIPTS = os.path.dirname(os.path.abspath(__file__))
+ANALYZE = os.path.join(SCRIPTS, 'analyze-migration.py')
+GENERATE = os.path.join(SCRIPTS, 'gen-migration-stream.py')
+
+# Streams by name, with their generator options; "later" is "precopy"
+# with one more iteration, as a second snapshot of the same VM
+STREAMS = collections.OrderedDict([
+    ( 'plain', [] ),
+    ( 'precopy', [ '--xbzrle' ] ),
+    ( 'later', [ '--xbzrle', '--iterations', '4' ] ),
+    ( 'compressed', [ '--compress' ] ),
+    ( 'multifd', [ '--multifd', '4' ] ),
+    ( 'postcopy', [ '--postcopy', '--xbzrle' ] ),
+])
+
+MULTIFD_CHANNELS = 4
+
+# Modes by name, with the stream they read and the analyzer options;
+# an option naming a stream stands for its path
+MODES = collections.OrderedDict([
+    ( 'parse', ( 'plain', [ '-d', 'state' ] ) ),
+    ( 'desc', ( 'precopy', [ '-d', 'desc' ] ) ),
+    ( 'state', ( 'precopy', [ '-d', 'state' ] ) ),
+    ( 'memory', ( 'precopy', [ '-d', 'state', '-m' ] ) ),
+    ( 'ndjson', ( 'precopy', [ '-d', 'state', '-m', '--ndjson' ] ) ),
+    ( 'extract', ( 'precopy', [ '-x' ] ) ),
+    ( 'extract-compressed', ( 'compressed', [ '-x' ] ) ),
+    ( 'toc', ( 'precopy', [ '-t' ] ) ),
+    ( 'device', ( 'precopy', [ '--device', 'cpu' ] ) ),
+    ( 'ram', ( 'precopy', [ '--ram', 'pc.ram:0:0x100000' ] ) ),
+    ( 'iterations', ( 'precopy', [ '-i' ] ) ),
+    ( 'stats', ( 'precopy', [ '-s' ] ) ),
+    ( 'diff', ( 'precopy', [ '--diff', 'later' ] ) ),
+    ( 'multifd', ( 'multifd', [ '-s', '-c' ] ) ),
+    ( 'postcopy', ( 'postcopy', [ '-s' ] ) ),
+])
+
+
+class Benchmark(object):
+    def __init__(self, args, directory):
+        self.args = args
+        self.directory = directory
+        self.devnull = open(os.devnull, 'w')
+
+    def stream_path(self, name):
+        return os.path.join(self.directory, '%s-%dM.mig' % (name, self.args.ram))
+
+    def channel_paths(self, name):
+        return ['%s.multifd%d' % (self.stream_path(name), i)
+                for i in range(MULTIFD_CHANNELS)]
+
+    def generate(self, name):
+        path = self.stream_path(name)
+        if os.path.exists(path):
+            return
+        # Written under another name first, so that an interrupted run
+        # does not leave a truncated stream behind to be reused
+        tmp = path + '.tmp'
+        command = [ self.args.python, GENERATE, tmp, '--ram', str(self.args.ram) ]
+        subprocess.check_call(command + STREAMS[name], stdout=self.devnull)
+        if name == 'multifd':
+            for channel in self.channel_paths(name):
+                os.rename(channel.replace(path, tmp), channel)
+        os.rename(tmp, path)
+
+    def command(self, mode):
+        stream, options = MODES[mode]
+        command = [ self.args.python, self.args.analyzer, '-f', self.stream_path(stream) ]
+        files = [ self.stream_path(stream) ]
+        for option in options:
+            if option in STREAMS:
+                option = self.stream_path(option)
+                files.append(option)
+            command.append(option)
+        if mode == 'multifd':
+            command += self.channel_paths(stream)
+            files += self.channel_paths(stream)
+        return command, sum(os.path.getsize(f) for f in files)
+
+    def run(self, mode, command):
+        toc = self.stream_path(MODES[mode][0]) + '.toc'
+        if mode == 'toc' and os.path.exists(toc):
+            os.remove(toc)
+        cwd = None
+        if mode.startswith('extract'):
+            cwd = tempfile.mkdtemp(dir = self.directory)
+        start = time.time()
+        try:
+            ret = subprocess.call(command, stdout = self.devnull, cwd = cwd)
+        finally:
+            elapsed = time.time() - start
+            if cwd is not None:
+                shutil.rmtree(cwd)
+        if ret != 0:
+            raise Exception('%s failed with exit code %d' % (' '.join(command), ret))
+        return elapsed
+
+    def measure(self, mode):
+        stream, options = MODES[mode]
+        for name in [stream] + [option for option in options if option in STREAMS]:
+            self.generate(name)
+        command, size = self.command(mode)
+        if mode in ('device', 'ram'):
+            # Build the table of contents these modes seek with
+            self.run(mode, command)
+        best = min(self.run(mode, command) for i in range(self.args.repeat))
+        result = collections.OrderedDict()
+        result['mode'] = mode
+        result['stream'] = stream
+        result['bytes'] = size
+        result['seconds'] = round(best, 3)
+        result['MiB/s'] = round(size / best / (1 << 20), 1)
+        return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark analyze-migration.py on synthetic streams')
+    parser.add_argument('modes', nargs='*', metavar='MODE',
+                        help='modes to run, among %s (default all)' % ', '.join(MODES))
+    parser.add_argument('--ram', type=int, default=256, help='guest RAM of the streams, in MiB (default 256)')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each mode, the best one counts (default 3)')
+    parser.add_argument('--python', default=sys.executable, help='interpreter to run the scripts with')
+    parser.add_argument('--analyzer', default=ANALYZE, help='analyze-migration.py script to benchmark')
+    parser.add_argument('--dir', help='directory to keep the streams in, instead of a temporary one')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+
+    for mode in args.modes:
+        if mode not in MODES:
+            parser.error('unknown mode %s' % mode)
+    modes = args.modes or list(MODES)
+
+    if args.dir:
+        if not os.path.isdir(args.dir):
+            os.makedirs(args.dir)
+        # Extraction runs in a directory of its own, so paths are absolute
+        directory = os.path.abspath(args.dir)
+    else:
+        directory = tempfile.mkdtemp(prefix = 'bench-analyze-migration-')
+    try:
+        benchmark = Benchmark(args, directory)
+        results = []
+        if not args.json:
+            print('%-20s %-12s %10s %10s %10s' % ('mode', 'stream', 'MiB', 'seconds', 'MiB/s'))
+        for mode in modes:
+            result = benchmark.measure(mode)
+            results.append(result)
+            if not args.json:
+                print('%-20s %-12s %10.1f %10.3f %10.1f' %
+                      (mode, result['stream'], result['bytes'] / float(1 << 20),
+                       result['seconds'], result['MiB/s']))
+                sys.stdout.flush()
+    finally:
+        if not args.dir:
+            shutil.rmtree(directory)
+
+    if args.json:
+        report = collections.OrderedDict()
+        report['python'] = subprocess.check_output(
+            [ args.python, '-c', 'import platform; print(platform.python_version())' ]
+            ).decode('ascii').strip()
+        report['analyzer'] = args.analyzer
+        report['ram'] = args.ram
+        report['repeat'] = args.repeat
+        report['results'] = results
+        print(json.dumps(report, indent = 4, separators = (',', ': ')))
+
+
+if __name__ == '__main__':
+    main()
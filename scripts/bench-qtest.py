@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+#
+# Benchmark the qtest protocol: single commands against pipelined batches
+#
+# Copyright (C) 2019 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Usage: bench-qtest.py [options] QEMU
+#
+# Launches QEMU with the qtest accelerator and times, the best of
+# --repeat runs counting:
+#   single  --count writel followed by --count readl, one command at a
+#           time with QEMUQtestMachine.qtest()
+#   batch   the same sequence with QEMUQtestMachine.qtest_batch()
+#   write   memwrite() of --size bytes of random data
+#   read    memread() of the same range
+# Accesses go to guest RAM from --addr, so that any machine type works.
+
+from __future__ import print_function
+import argparse
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'python'))
+from qemu.qtest import QEMUQtestMachine
+
+
+def best_time(function, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        function()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the qtest protocol')
+    parser.add_argument('qemu', help='QEMU system emulator binary')
+    parser.add_argument('--machine', help='machine type (default: QEMU default)')
+    parser.add_argument('--addr', type=lambda x: int(x, 0), default=0x100000,
+                        help='guest RAM address to access (default 0x100000)')
+    parser.add_argument('--count', type=int, default=20000,
+                        help='writel and readl commands per run (default 20000)')
+    parser.add_argument('--size', type=int, default=4,
+                        help='size of bulk transfers, in MiB (default 4)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs of each test, the best one counts (default 3)')
+    args = parser.parse_args()
+
+    vm = QEMUQtestMachine(args.qemu, args=['-m', str(args.size + 64)])
+    if args.machine:
+        vm.set_machine(args.machine)
+    vm.launch()
+    try:
+        writes = ['writel 0x%x 0x%x' % (args.addr + i * 4, i)
+                  for i in range(args.count)]
+        reads = ['readl 0x%x' % (args.addr + i * 4) for i in range(args.count)]
+        data = os.urandom(args.size << 20)
+
+        def single():
+            for cmd in writes:
+                vm.qtest(cmd)
+            for cmd in reads:
+                vm.qtest(cmd)
+
+        def batch():
+            vm.qtest_batch(writes)
+            vm.qtest_batch(reads)
+
+        def write():
+            vm.b64write(args.addr, data)
+
+        def read():
+            vm.b64read(args.addr, len(data))
+
+        print('%-8s %10s %14s' % ('test', 'seconds', 'rate'))
+        for name, function in (('single', single), ('batch', batch)):
+            elapsed = best_time(function, args.repeat)
+            print('%-8s %10.3f %10.0f op/s' % (name, elapsed,
+                                               2 * args.count / elapsed))
+            sys.stdout.flush()
+        for name, function in (('write', write), ('read', read)):
+            elapsed = best_time(function, args.repeat)
+            print('%-8s %10.3f %8.1f MiB/s' % (name, elapsed,
+                                               args.size / elapsed))
+            sys.stdout.flush()
+        if vm.b64read(args.addr, len(data)) != bytearray(data):
+            raise Exception('Guest memory does not hold the data written')
+    finally:
+        vm.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,574 @@
+#!/usr/bin/env python
+#
+# Generate synthetic migration streams
+#
+# Copyright (C) 2019 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Usage: gen-migration-stream.py [options] FILE
+#
+# Writes a migration stream laid out as QEMU saves it with
+# "migrate exec:cat > FILE": header, configuration section, a RAM
+# section sent over several iterations with zero, normal, XBZRLE or
+# zlib compressed pages, device state sections with arrays, nested
+# structs and subsections, and the VMSD description at the end.  With
+# --multifd, normal pages go to FILE.multifd0 ... FILE.multifdN-1
+# instead, as captured from each channel; with --postcopy, the stream
+# switches to postcopy after the precopy iterations, with the
+# corresponding commands and device state package.
+#
+# With a given Python version, the output is a function of the options
+# and of --seed only, so that streams can be regenerated for tests and
+# benchmarks of scripts/analyze-migration.py.  --reference DIR writes the final
+# content of each RAMBlock into DIR, with the same file names as
+# "analyze-migration.py -x".
+
+from __future__ import print_function
+import argparse
+import binascii
+import io
+import json
+import os
+import random
+import struct
+import sys
+import zlib
+
+QEMU_VM_FILE_MAGIC    = 0x5145564d
+QEMU_VM_FILE_VERSION  = 0x00000003
+QEMU_VM_EOF           = 0x00
+QEMU_VM_SECTION_START = 0x01
+QEMU_VM_SECTION_PART  = 0x02
+QEMU_VM_SECTION_END   = 0x03
+QEMU_VM_SECTION_FULL  = 0x04
+QEMU_VM_SUBSECTION    = 0x05
+QEMU_VM_VMDESCRIPTION = 0x06
+QEMU_VM_CONFIGURATION = 0x07
+QEMU_VM_COMMAND       = 0x08
+QEMU_VM_SECTION_FOOTER= 0x7e
+
+RAM_SAVE_FLAG_COMPRESS = 0x02
+RAM_SAVE_FLAG_MEM_SIZE = 0x04
+RAM_SAVE_FLAG_PAGE     = 0x08
+RAM_SAVE_FLAG_EOS      = 0x10
+RAM_SAVE_FLAG_CONTINUE = 0x20
+RAM_SAVE_FLAG_XBZRLE   = 0x40
+RAM_SAVE_FLAG_COMPRESS_PAGE = 0x100
+ENCODING_FLAG_XBZRLE   = 0x1
+
+MIG_CMD_OPEN_RETURN_PATH = 1
+MIG_CMD_PING           = 2
+MIG_CMD_POSTCOPY_ADVISE = 3
+MIG_CMD_POSTCOPY_LISTEN = 4
+MIG_CMD_POSTCOPY_RUN   = 5
+MIG_CMD_POSTCOPY_RAM_DISCARD = 6
+MIG_CMD_PACKAGED       = 7
+MAX_DISCARDS_PER_COMMAND = 12
+
+MULTIFD_MAGIC = 0x11223344
+MULTIFD_VERSION = 1
+MULTIFD_FLAG_SYNC = 0x1
+MULTIFD_PACKET_SIZE = 512 * 1024
+
+TARGET_PAGE_SIZE = 4096
+
+# Pages sent in each QEMU_VM_SECTION_PART, about what QEMU sends in the
+# 50ms a single ram_save_iterate() call is limited to
+PART_PAGES = 4096
+
+
+def random_bytes(rnd, size):
+    return binascii.unhexlify('%0*x' % (size * 2, rnd.getrandbits(size * 8)))
+
+
+def field(name, type, size, **extra):
+    desc = { 'name' : name, 'type' : type, 'size' : size }
+    desc.update(extra)
+    return desc
+
+
+def vmsd(name, version, fields, subsections = None):
+    desc = { 'vmsd_name' : name, 'version' : version, 'fields' : fields }
+    if subsections:
+        desc['subsections'] = subsections
+    return desc
+
+
+# Device types, in the format of the VMSD description QEMU writes
+QUEUE = vmsd('virtio-queue', 1, [
+    field('vring.num', 'uint32', 4),
+    field('vring.desc', 'uint64', 8),
+    field('last_avail_idx', 'uint16', 2),
+    field('signalled_used_valid', 'bool', 1) ])
+
+# A struct with a subsection has no fixed size
+QUEUE_STATE = vmsd('virtio-queue-state', 1, [
+    field('used_idx', 'uint16', 2),
+    field('inuse', 'int32', 4) ], [
+    vmsd('virtio-queue-state/packed', 1, [
+        field('avail_wrap', 'bool', 1),
+        field('used_wrap', 'bool', 1) ]) ])
+
+DEVICE_TYPES = [
+    ( 'serial', vmsd('serial', 3, [
+        field('divider', 'uint16', 2),
+        field('rbr', 'uint8', 1),
+        field('ier', 'uint8', 1),
+        field('iir', 'uint8', 1),
+        field('lcr', 'uint8', 1),
+        field('mcr', 'uint8', 1),
+        field('lsr', 'uint8', 1),
+        field('msr', 'uint8', 1),
+        field('scr', 'uint8', 1),
+        field('fcr_vmstate', 'uint8', 1) ], [
+        vmsd('serial/thr_ipending', 1, [
+            field('thr_ipending', 'int32', 4) ]),
+        vmsd('serial/timeout_ipending', 1, [
+            field('timeout_ipending', 'int32', 4) ]) ]) ),
+    ( 'virtio-net', vmsd('virtio-net', 11, [
+        field('status', 'uint8', 1),
+        field('isr', 'uint8', 1),
+        field('queue_sel', 'uint16', 2),
+        field('guest_features', 'uint64', 8),
+        field('config_len', 'int32 equal', 4),
+        field('config', 'buffer', 60),
+        field('vq', 'struct', 15, array_len = 3, struct = QUEUE),
+        field('vq_state', 'struct', 6, array_len = 3, struct = QUEUE_STATE),
+        field('mac_table', 'buffer', 6, array_len = 8),
+        field('vlans', 'uint32', 4, array_len = 16),
+        # Fields described one array element at a time
+        field('tx_timer', 'timer', 8, index = 0),
+        field('tx_timer', 'timer', 8, index = 1),
+        field('mtu', 'uint16', 2) ], [
+        vmsd('virtio-net/extra_state', 1, [
+            field('guest_offloads', 'uint64', 8),
+            field('rss', 'struct', 17, struct = vmsd('virtio-net-rss', 1, [
+                field('enabled', 'bool', 1),
+                field('indirections', 'uint16', 2, array_len = 8) ])) ], [
+            vmsd('virtio-net/extra_state/announce', 1, [
+                field('announce_round', 'int32 le', 4) ]) ]) ]) ),
+    ( 'cpu', vmsd('cpu', 12, [
+        field('env.regs', 'uint64', 8, array_len = 16),
+        field('env.eip', 'uint64', 8),
+        field('env.eflags', 'uint64', 8),
+        field('env.hflags', 'uint32', 4),
+        field('env.fpus', 'uint16', 2),
+        field('env.fpregs', 'float64', 8, array_len = 8),
+        field('env.segs', 'struct', 20, array_len = 6, struct = vmsd('segment', 1, [
+            field('selector', 'uint32', 4),
+            field('base', 'uint64', 8),
+            field('limit', 'uint32', 4),
+            field('flags', 'uint32', 4) ])),
+        field('env.cr', 'uint64', 8, array_len = 5),
+        field('env.a20_mask', 'int32', 4),
+        field('env.tsc', 'int64', 8),
+        field('env.xmm_regs', 'buffer', 16, array_len = 16) ], [
+        vmsd('cpu/async_pf_msr', 1, [
+            field('env.async_pf_en_msr', 'uint64', 8) ]),
+        vmsd('cpu/xsave', 1, [
+            field('env.xstate_bv', 'uint64', 8),
+            field('env.zmmh_regs', 'buffer', 32, array_len = 16) ]) ]) ),
+]
+
+
+class GuestMemory(object):
+    """
+    Deterministic page contents
+
+    Normal pages are a copy of one of a few random pages, half of which
+    compresses well, stamped with their address and iteration unless
+    they are meant to be duplicates.
+    """
+
+    POOL_PAGES = 64
+
+    def __init__(self, rnd):
+        self.rnd = rnd
+        self.pool = []
+        for i in range(self.POOL_PAGES):
+            half = TARGET_PAGE_SIZE // 2
+            pattern = random_bytes(rnd, 8) * (half // 8)
+            self.pool.append(random_bytes(rnd, half) + pattern)
+
+    def page(self, addr, iteration, duplicate):
+        page = self.pool[self.rnd.randrange(self.POOL_PAGES)]
+        if duplicate:
+            return page
+        return struct.pack('>QQ', addr, iteration) + page[16:]
+
+    # A new version of a page with a few bytes changed, and its XBZRLE
+    # encoding against the old one: unchanged and changed byte counts
+    # as ULEB128 numbers, each run of changed bytes following its count
+    def xbzrle(self, old):
+        new = bytearray(old)
+        encoded = bytearray()
+        pos = 0
+        for i in range(self.rnd.randrange(1, 5)):
+            start = self.rnd.randrange(pos, pos + 512)
+            size = self.rnd.randrange(1, 256)
+            if start + size > TARGET_PAGE_SIZE:
+                break
+            for count in (start - pos, size):
+                if count >= 0x80:
+                    encoded += struct.pack('BB', (count & 0x7f) | 0x80, count >> 7)
+                else:
+                    encoded += struct.pack('B', count)
+            data = random_bytes(self.rnd, size)
+            new[start:start + size] = data
+            encoded += data
+            pos = start + size
+        return bytes(new), bytes(encoded)
+
+
+class MultifdChannels(object):
+    """
+    Normal pages sent through multifd channels, each into its own file
+    """
+
+    def __init__(self, path, count, uuid):
+        self.files = []
+        for i in range(count):
+            f = open('%s.multifd%d' % (path, i), 'wb')
+            f.write(struct.pack('>II16sB7x32x', MULTIFD_MAGIC, MULTIFD_VERSION, uuid, i))
+            self.files.append(f)
+        self.pages_alloc = MULTIFD_PACKET_SIZE // TARGET_PAGE_SIZE
+        self.packet_num = 0
+        self.next = 0
+        self.block = None
+        self.pages = []
+        self.bytes = 0
+
+    def send_packet(self, f, flags, block, pages):
+        offsets = b''.join(struct.pack('>Q', addr) for addr, data in pages)
+        offsets += bytes(bytearray(8 * (self.pages_alloc - len(pages))))
+        header = struct.pack('>IIIIIIQ32x256s', MULTIFD_MAGIC, MULTIFD_VERSION,
+                             flags, self.pages_alloc, len(pages),
+                             len(pages) * TARGET_PAGE_SIZE, self.packet_num,
+                             (block or '').encode('latin-1'))
+        self.packet_num += 1
+        f.write(header + offsets)
+        for addr, data in pages:
+            f.write(data)
+
+    def flush(self):
+        if self.pages:
+            self.send_packet(self.files[self.next], 0, self.block, self.pages)
+            self.next = (self.next + 1) % len(self.files)
+            self.pages = []
+
+    def queue_page(self, block, addr, data):
+        if block != self.block:
+            self.flush()
+            self.block = block
+        self.pages.append((addr, data))
+        if len(self.pages) == self.pages_alloc:
+            self.flush()
+
+    # Done before each RAM_SAVE_FLAG_EOS in the main stream
+    def sync(self):
+        self.flush()
+        for f in self.files:
+            self.send_packet(f, MULTIFD_FLAG_SYNC, None, [])
+
+    def close(self):
+        for f in self.files:
+            self.bytes += f.tell()
+            f.close()
+
+
+class StreamGenerator(object):
+    def __init__(self, args):
+        self.args = args
+        self.rnd = random.Random(args.seed)
+        self.memory = GuestMemory(self.rnd)
+        self.blocks = [ ( 'pc.ram', args.ram << 20 ),
+                        ( 'vga.vram', 1 << 20 ),
+                        ( '/rom@etc/acpi/tables', 128 << 10 ) ]
+        # Current content of the pages, needed to encode XBZRLE pages
+        self.content = None
+        if args.xbzrle or args.reference:
+            self.content = dict((name, bytearray(size)) for name, size in self.blocks)
+        self.sent = dict((name, bytearray(size // TARGET_PAGE_SIZE))
+                         for name, size in self.blocks)
+        self.counts = dict((kind, 0) for kind in
+                           ('normal', 'zero', 'xbzrle', 'compressed'))
+        self.channels = None
+        self.section_id = 0
+        self.devices = []
+
+    def put(self, fmt, *values):
+        self.out.write(struct.pack(fmt, *values))
+
+    def put_str(self, value):
+        value = value.encode('latin-1')
+        self.put('B', len(value))
+        self.out.write(value)
+
+    def command(self, cmd, data = b''):
+        self.put('>BHH', QEMU_VM_COMMAND, cmd, len(data))
+        self.out.write(data)
+
+    def section_header(self, section_type, section_id, name = None,
+                       instance_id = 0, version_id = 0):
+        self.put('>BI', section_type, section_id)
+        if name is not None:
+            self.put_str(name)
+            self.put('>II', instance_id, version_id)
+
+    def section_footer(self, section_id):
+        if not self.args.no_footer:
+            self.put('>BI', QEMU_VM_SECTION_FOOTER, section_id)
+
+    def page_header(self, name, addr, flags):
+        if name == self.last_block:
+            self.put('>Q', addr | flags | RAM_SAVE_FLAG_CONTINUE)
+        else:
+            self.put('>Q', addr | flags)
+            self.put_str(name)
+            self.last_block = name
+
+    def send_page(self, name, addr, iteration, postcopy):
+        page = addr // TARGET_PAGE_SIZE
+        r = self.rnd.random()
+        if r < self.args.zero:
+            self.page_header(name, addr, RAM_SAVE_FLAG_COMPRESS)
+            self.put('B', 0)
+            data = None
+            self.counts['zero'] += 1
+        elif self.args.xbzrle and self.sent[name][page] and not postcopy and \
+             r < self.args.zero + (1 - self.args.zero) / 2:
+            old = self.content[name][addr:addr + TARGET_PAGE_SIZE]
+            data, encoded = self.memory.xbzrle(old)
+            self.page_header(name, addr, RAM_SAVE_FLAG_XBZRLE)
+            self.put('>BH', ENCODING_FLAG_XBZRLE, len(encoded))
+            self.out.write(encoded)
+            self.counts['xbzrle'] += 1
+        else:
+            duplicate = self.rnd.random() < self.args.duplicates
+            data = self.memory.page(addr, iteration, duplicate)
+            if self.channels is not None:
+                self.channels.queue_page(name, addr, data)
+                self.counts['normal'] += 1
+            elif self.args.compress:
+                encoded = zlib.compress(data, 1)
+                self.page_header(name, addr, RAM_SAVE_FLAG_COMPRESS_PAGE)
+                self.put('>I', len(encoded))
+                self.out.write(encoded)
+                self.counts['compressed'] += 1
+            else:
+                self.page_header(name, addr, RAM_SAVE_FLAG_PAGE)
+                self.out.write(data)
+                self.counts['normal'] += 1
+        self.sent[name][page] = 1
+        if self.content is not None:
+            content = self.content[name]
+            if data is None:
+                content[addr:addr + TARGET_PAGE_SIZE] = bytearray(TARGET_PAGE_SIZE)
+            else:
+                content[addr:addr + TARGET_PAGE_SIZE] = data
+
+    def ram_eos(self):
+        if self.channels is not None:
+            self.channels.sync()
+        self.put('>Q', RAM_SAVE_FLAG_EOS)
+        self.section_footer(0)
+
+    def ram_setup(self):
+        self.section_header(QEMU_VM_SECTION_START, 0, 'ram', 0, 4)
+        self.put('>Q', sum(size for name, size in self.blocks) | RAM_SAVE_FLAG_MEM_SIZE)
+        for name, size in self.blocks:
+            self.put_str(name)
+            self.put('>Q', size)
+        self.ram_eos()
+
+    # Send pages, given as (block, address), in as many sections as it
+    # takes; the last one is QEMU_VM_SECTION_END if last is set
+    def ram_pages(self, pages, iteration, last = False, postcopy = False):
+        for start in range(0, max(len(pages), 1), PART_PAGES):
+            end = start + PART_PAGES >= len(pages)
+            section_type = QEMU_VM_SECTION_END if last and end else QEMU_VM_SECTION_PART
+            self.section_header(section_type, 0)
+            self.last_block = None
+            for name, addr in pages[start:start + PART_PAGES]:
+                self.send_page(name, addr, iteration, postcopy)
+            self.ram_eos()
+
+    # Pages dirtied during an iteration, in the order of the dirty bitmap
+    def dirty_pages(self, fraction):
+        pages = []
+        for name, size in self.blocks:
+            count = size // TARGET_PAGE_SIZE
+            dirty = self.rnd.sample(range(count), int(count * fraction))
+            pages.extend((name, page * TARGET_PAGE_SIZE) for page in sorted(dirty))
+        return pages
+
+    def encode_fields(self, desc):
+        data = []
+        for f in desc['fields']:
+            for i in range(f.get('array_len', 1)):
+                if f['type'] == 'struct':
+                    data.append(self.encode_fields(f['struct']))
+                elif f['type'] == 'bool':
+                    data.append(struct.pack('B', self.rnd.randrange(2)))
+                else:
+                    data.append(random_bytes(self.rnd, f['size']))
+        for subsection in desc.get('subsections', []):
+            name = subsection['vmsd_name'].encode('latin-1')
+            data.append(struct.pack('>BB', QEMU_VM_SUBSECTION, len(name)) + name +
+                        struct.pack('>I', subsection['version']))
+            data.append(self.encode_fields(subsection))
+        return b''.join(data)
+
+    def device_sections(self):
+        instances = {}
+        for i in range(self.args.devices):
+            name, desc = DEVICE_TYPES[i % len(DEVICE_TYPES)]
+            instance_id = instances.get(name, 0)
+            instances[name] = instance_id + 1
+            self.section_id += 1
+            self.section_header(QEMU_VM_SECTION_FULL, self.section_id, name,
+                                instance_id, desc['version'])
+            self.out.write(self.encode_fields(desc))
+            self.section_footer(self.section_id)
+            device = { 'name' : name, 'instance_id' : instance_id }
+            device.update(desc)
+            self.devices.append(device)
+
+    def postcopy_discard(self, pages):
+        ranges = {}
+        for name, addr in pages:
+            if self.sent[name][addr // TARGET_PAGE_SIZE]:
+                block = ranges.setdefault(name, [])
+                if block and block[-1][0] + block[-1][1] == addr:
+                    block[-1][1] += TARGET_PAGE_SIZE
+                else:
+                    block.append([addr, TARGET_PAGE_SIZE])
+        for name, block in ranges.items():
+            for i in range(0, len(block), MAX_DISCARDS_PER_COMMAND):
+                data = struct.pack('>BB', 0, len(name)) + name.encode('latin-1') + b'\0'
+                for start, length in block[i:i + MAX_DISCARDS_PER_COMMAND]:
+                    data += struct.pack('>QQ', start, length)
+                self.command(MIG_CMD_POSTCOPY_RAM_DISCARD, data)
+
+    # The device state, wrapped in a package, and the remaining pages
+    def postcopy(self, pages):
+        self.postcopy_discard(pages)
+        self.command(MIG_CMD_PING, struct.pack('>I', 2))
+        out = self.out
+        self.out = package = io.BytesIO()
+        self.command(MIG_CMD_POSTCOPY_LISTEN)
+        self.device_sections()
+        self.command(MIG_CMD_PING, struct.pack('>I', 3))
+        self.command(MIG_CMD_POSTCOPY_RUN)
+        self.out = out
+        data = package.getvalue()
+        self.command(MIG_CMD_PACKAGED, struct.pack('>I', len(data)))
+        self.out.write(data)
+        self.command(MIG_CMD_PING, struct.pack('>I', 4))
+        self.ram_pages(pages, self.args.iterations, last = True, postcopy = True)
+
+    def generate(self, path):
+        args = self.args
+        self.out = open(path, 'wb')
+        self.put('>II', QEMU_VM_FILE_MAGIC, QEMU_VM_FILE_VERSION)
+        machine = b'pc-i440fx-4.1'
+        self.put('>BI', QEMU_VM_CONFIGURATION, len(machine))
+        self.out.write(machine)
+        if args.postcopy:
+            self.command(MIG_CMD_OPEN_RETURN_PATH)
+            self.command(MIG_CMD_PING, struct.pack('>I', 1))
+            self.command(MIG_CMD_POSTCOPY_ADVISE,
+                         struct.pack('>QQ', TARGET_PAGE_SIZE, TARGET_PAGE_SIZE))
+        if args.multifd:
+            self.channels = MultifdChannels(path, args.multifd,
+                                            random_bytes(self.rnd, 16))
+
+        self.ram_setup()
+        pages = [(name, addr) for name, size in self.blocks
+                 for addr in range(0, size, TARGET_PAGE_SIZE)]
+        for iteration in range(args.iterations):
+            self.ram_pages(pages, iteration)
+            pages = self.dirty_pages(args.dirty)
+
+        if args.postcopy:
+            self.postcopy(pages)
+        else:
+            # The last dirty pages are sent with the VM stopped
+            self.ram_pages(pages, args.iterations, last = True)
+            self.device_sections()
+        self.put('B', QEMU_VM_EOF)
+
+        # Postcopy streams have no description
+        if not args.postcopy:
+            desc = json.dumps({ 'page_size' : TARGET_PAGE_SIZE,
+                                'devices' : self.devices }).encode('utf-8')
+            self.put('>BI', QEMU_VM_VMDESCRIPTION, len(desc))
+            self.out.write(desc)
+        size = self.out.tell()
+        self.out.close()
+        if self.channels is not None:
+            self.channels.close()
+            size += self.channels.bytes
+        return size
+
+    def write_reference(self, path):
+        for name, size in self.blocks:
+            filename = os.path.join(path, name.lstrip('/'))
+            if not os.path.isdir(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+            with open(filename, 'wb') as f:
+                f.write(self.content[name])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic migration stream')
+    parser.add_argument('file', help='migration stream to write')
+    parser.add_argument('--ram', type=int, default=64, help='size of pc.ram, in MiB (default 64)')
+    parser.add_argument('--iterations', type=int, default=3, help='number of precopy iterations (default 3)')
+    parser.add_argument('--dirty', type=float, default=0.1, help='fraction of pages sent again in each iteration (default 0.1)')
+    parser.add_argument('--zero', type=float, default=0.3, help='fraction of zero pages (default 0.3)')
+    parser.add_argument('--duplicates', type=float, default=0.2, help='fraction of normal pages with the same content as others (default 0.2)')
+    parser.add_argument('--xbzrle', action='store_true', help='send half of the pages sent again as XBZRLE')
+    parser.add_argument('--compress', action='store_true', help='compress normal pages with zlib')
+    parser.add_argument('--multifd', type=int, metavar='N', default=0, help='send normal pages through N multifd channels')
+    parser.add_argument('--postcopy', action='store_true', help='switch to postcopy after the precopy iterations')
+    parser.add_argument('--devices', type=int, default=16, help='number of device state sections (default 16)')
+    parser.add_argument('--no-footer', action='store_true', help='do not write section footers')
+    parser.add_argument('--seed', type=int, default=0, help='random seed (default 0)')
+    parser.add_argument('--reference', metavar='DIR', help='write the final content of each RAMBlock into DIR')
+    args = parser.parse_args()
+
+    # Multifd channels take every normal page, so that QEMU sends no
+    # XBZRLE pages then; postcopy with compression is refused by
+    # migrate_caps_check()
+    if args.multifd and (args.xbzrle or args.compress or args.postcopy):
+        parser.error('--multifd cannot be used with --xbzrle, --compress or --postcopy')
+    if args.postcopy and args.compress:
+        parser.error('--postcopy cannot be used with --compress')
+    if args.iterations < 1:
+        parser.error('--iterations must be at least 1')
+
+    generator = StreamGenerator(args)
+    size = generator.generate(args.file)
+    if args.reference:
+        generator.write_reference(args.reference)
+    counts = generator.counts
+    print('%s: %d MiB, %d normal, %d zero, %d XBZRLE and %d compressed pages' %
+          (args.file, size >> 20, counts['normal'], counts['zero'],
+           counts['xbzrle'], counts['compressed']))
+
+
+if __name__ == '__main__':
+    main()
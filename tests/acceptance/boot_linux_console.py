@@ -37,18 +37,12 @@ class BootLinuxConsole(Test):
         :param success_message: if this message appears, test succeeds
         :param failure_message: if this message appears, test fails
         """
-        console = self.vm.console_socket.makefile()
         console_logger = logging.getLogger('console')
-        while True:
-            msg = console.readline().strip()
-            if not msg:
-                continue
-            console_logger.debug(msg)
-            if success_message in msg:
-                break
-            if failure_message in msg:
-                fail = 'Failure message found in console: %s' % failure_message
-                self.fail(fail)
+        console = self.vm.console_reader(line_callback=console_logger.debug)
+        index, _ = console.wait_for([success_message, failure_message])
+        if index == 1:
+            fail = 'Failure message found in console: %s' % failure_message
+            self.fail(fail)
 
     def exec_command_and_wait_for_pattern(self, command, success_message):
         command += '\n'
@@ -0,0 +1,204 @@
+# Stand-in for a QEMU binary, for the tests of the python/qemu library
+#
+# Copyright (c) 2019 Red Hat, Inc.
+#
+# This work is licensed under the terms of the GNU GPL, version 2 or
+# later.  See the COPYING file in the top-level directory.
+#
+# Not a test itself; tests run it through the interpreter, as in
+# QEMUMachine(FAKE_QEMU, wrapper=[sys.executable]).
+#
+# It implements just enough of QEMU for QEMUMachine and the helpers built
+# on it: the QMP monitor given with "-chardev socket,id=mon,path=PATH",
+# -S, "-incoming exec:COMMAND", memory-backend-file objects and migration
+# to "exec:COMMAND" URIs.  The VM state it migrates is a dict set with
+# the x-fake-set command.  The commands it adds are:
+#
+#   x-fake-emit events=[{"event": ..., "data": ...}, ...]
+#       send the events, then the reply
+#   x-fake-set key=... value=...
+#   x-fake-get key=...
+#   x-fake-read offset=... size=...
+#   x-fake-write offset=... data=...
+#       access the memory-backend-file, data being hex encoded
+#   x-fake-spin seconds=...
+#       burn CPU in the main thread
+#
+# "-x-fake-exit CODE" makes it exit before connecting to the monitor,
+# "-x-fake-delay SECONDS" makes it wait that long before connecting, and
+# "-x-fake-migrate-fail on" makes outgoing migration fail.
+
+import binascii
+import json
+import mmap
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+
+def parse_options(value):
+    options = {}
+    for option in value.split(',')[1:]:
+        key, _, option_value = option.partition('=')
+        options[key] = option_value
+    return options
+
+
+class FakeQEMU(object):
+    def __init__(self, args):
+        self.monitor = None
+        self.memory = None
+        self.incoming = None
+        self.paused = False
+        self.migrate_fail = False
+        i = 0
+        while i < len(args):
+            if args[i] == '-S':
+                self.paused = True
+                i += 1
+                continue
+            opt, value = args[i], args[i + 1]
+            i += 2
+            if opt == '-chardev' and 'id=mon' in value.split(','):
+                self.monitor = parse_options(value)['path']
+            elif opt == '-object' and \
+                 value.startswith('memory-backend-file,'):
+                options = parse_options(value)
+                size = int(options['size'])
+                fd = os.open(options['mem-path'], os.O_RDWR | os.O_CREAT)
+                try:
+                    os.ftruncate(fd, size)
+                    self.memory = mmap.mmap(fd, size)
+                finally:
+                    os.close(fd)
+            elif opt == '-incoming':
+                self.incoming = value
+            elif opt == '-x-fake-exit':
+                sys.exit(int(value))
+            elif opt == '-x-fake-delay':
+                time.sleep(float(value))
+            elif opt == '-x-fake-migrate-fail':
+                self.migrate_fail = value == 'on'
+        self.state = {}
+        self.status = 'prelaunch' if self.paused else 'running'
+        self.migration = None
+        self.sock = None
+
+    def send(self, obj):
+        self.sock.sendall(json.dumps(obj).encode('utf-8') + b'\n')
+
+    def event(self, name, data=None):
+        now = time.time()
+        event = {'event': name,
+                 'timestamp': {'seconds': int(now),
+                               'microseconds': int(now * 1000000) % 1000000}}
+        if data is not None:
+            event['data'] = data
+        self.send(event)
+
+    def load_state(self):
+        command = self.incoming[len('exec:'):]
+        self.state = json.loads(subprocess.check_output(command, shell=True)
+                                .decode('utf-8'))
+        self.status = 'paused' if self.paused else 'running'
+
+    def save_state(self, command):
+        if self.migrate_fail:
+            self.migration = 'failed'
+            return
+        proc = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE)
+        proc.communicate(json.dumps(self.state).encode('utf-8'))
+        self.migration = 'completed' if proc.returncode == 0 else 'failed'
+        self.status = 'postmigrate'
+
+    def execute(self, name, args):
+        if name == 'qmp_capabilities':
+            return {}
+        elif name == 'query-status':
+            return {'status': self.status,
+                    'running': self.status == 'running'}
+        elif name == 'cont':
+            self.status = 'running'
+            return {}
+        elif name == 'stop':
+            self.status = 'paused'
+            return {}
+        elif name == 'migrate':
+            self.save_state(args['uri'][len('exec:'):])
+            return {}
+        elif name == 'query-migrate':
+            return {'status': self.migration} if self.migration else {}
+        elif name == 'query-cpus-fast':
+            # The main thread has the process id for thread id
+            return [{'cpu-index': 0, 'thread-id': os.getpid()}]
+        elif name == 'x-fake-emit':
+            for event in args['events']:
+                self.event(event['event'], event.get('data'))
+            return {}
+        elif name == 'x-fake-set':
+            self.state[args['key']] = args['value']
+            return {}
+        elif name == 'x-fake-get':
+            return self.state.get(args['key'])
+        elif name == 'x-fake-read':
+            offset = args['offset']
+            data = self.memory[offset:offset + args['size']]
+            return binascii.hexlify(data).decode('ascii')
+        elif name == 'x-fake-write':
+            data = binascii.unhexlify(args['data'])
+            self.memory[args['offset']:args['offset'] + len(data)] = data
+            return {}
+        elif name == 'x-fake-spin':
+            end = time.time() + args['seconds']
+            while time.time() < end:
+                pass
+            return {}
+        return None
+
+    def commands(self):
+        decoder = json.JSONDecoder()
+        buf = ''
+        while True:
+            data = self.sock.recv(65536)
+            if not data:
+                return
+            buf += data.decode('utf-8')
+            while True:
+                buf = buf.lstrip()
+                try:
+                    obj, end = decoder.raw_decode(buf)
+                except ValueError:
+                    break
+                buf = buf[end:]
+                yield obj
+
+    def run(self):
+        loader = None
+        if self.incoming is not None:
+            self.status = 'inmigrate'
+            loader = threading.Thread(target=self.load_state)
+            loader.daemon = True
+            loader.start()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.monitor)
+        self.send({'QMP': {'version': {}, 'capabilities': []}})
+        for command in self.commands():
+            name = command['execute']
+            if name == 'quit':
+                self.send({'return': {}})
+                self.event('SHUTDOWN', {'guest': False})
+                return
+            ret = self.execute(name, command.get('arguments', {}))
+            if ret is None and name not in ('x-fake-get',):
+                self.send({'error': {'class': 'CommandNotFound',
+                                     'desc': 'The command %s has not been '
+                                             'found' % name}})
+            else:
+                self.send({'return': ret})
+
+
+if __name__ == '__main__':
+    FakeQEMU(sys.argv[1:]).run()
@@ -0,0 +1,85 @@
+# Check QMP event subscriptions of QEMUMachine against a fake QEMU
+#
+# Copyright (c) 2019 Red Hat, Inc.
+#
+# This work is licensed under the terms of the GNU GPL, version 2 or
+# later.  See the COPYING file in the top-level directory.
+
+import os
+import shutil
+import sys
+import tempfile
+
+from avocado import Test
+
+SRC_ROOT_DIR = os.path.join(os.path.dirname(__file__), '..', '..')
+sys.path.append(os.path.join(SRC_ROOT_DIR, 'python'))
+
+from qemu import qmp
+from qemu.machine import QEMUMachine
+
+FAKE_QEMU = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'fake_qemu.py')
+
+
+class MachineEvents(Test):
+    """
+    Subscribes to events emitted by fake_qemu.py; no QEMU binary is
+    needed.
+
+    :avocado: tags=quick
+    """
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.vm = QEMUMachine(FAKE_QEMU, wrapper=[sys.executable],
+                              test_dir=self.test_dir)
+        self.vm.launch()
+
+    def tearDown(self):
+        self.vm.shutdown()
+        shutil.rmtree(self.test_dir)
+
+    def emit(self, *events):
+        self.vm.command('x-fake-emit',
+                        events=[{'event': name, 'data': data}
+                                for name, data in events])
+
+    def test_filters(self):
+        with self.vm.subscribe('JOB', {'data': {'id': 'a'}}) as job, \
+             self.vm.subscribe(events=[
+                 (None, lambda event: event['event'].startswith('BLOCK_'))
+             ]) as block:
+            self.emit(('JOB', {'id': 'b'}), ('JOB', {'id': 'a'}),
+                      ('BLOCK_IO_ERROR', {}), ('RESUME', {}))
+            self.assertEqual(job.get(timeout=1.0)['data'], {'id': 'a'})
+            self.assertEqual(block.get_nowait()['event'], 'BLOCK_IO_ERROR')
+            self.assertIsNone(block.get_nowait())
+            self.assertEqual(len(job), 0)
+        # Events no subscription took are left for get_qmp_events()
+        self.assertEqual([(event['event'], event['data'])
+                          for event in self.vm.get_qmp_events()],
+                         [('JOB', {'id': 'b'}), ('RESUME', {})])
+
+    def test_events_before_get(self):
+        with self.vm.subscribe('JOB') as sub:
+            self.emit(('JOB', {'id': 1}))
+            self.vm.command('query-status')
+            self.emit(('JOB', {'id': 2}))
+            self.assertEqual([sub.get_nowait()['data']['id']
+                              for i in range(2)], [1, 2])
+            self.assertEqual(len(sub), 0)
+
+    def test_timeout(self):
+        with self.vm.subscribe('JOB') as sub:
+            self.emit(('RESUME', {}))
+            with self.assertRaises(qmp.QMPTimeoutError):
+                sub.get(timeout=0.2)
+
+    def test_unsubscribe(self):
+        sub = self.vm.subscribe('JOB')
+        sub.close()
+        self.emit(('JOB', {'id': 1}))
+        self.assertEqual(len(sub), 0)
+        self.assertEqual(self.vm.event_wait('JOB', timeout=1.0)['data'],
+                         {'id': 1})
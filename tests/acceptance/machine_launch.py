@@ -0,0 +1,89 @@
+# Check concurrent VM startup with launch_many() against a fake QEMU
+#
+# Copyright (c) 2019 Red Hat, Inc.
+#
+# This work is licensed under the terms of the GNU GPL, version 2 or
+# later.  See the COPYING file in the top-level directory.
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from avocado import Test
+
+SRC_ROOT_DIR = os.path.join(os.path.dirname(__file__), '..', '..')
+sys.path.append(os.path.join(SRC_ROOT_DIR, 'python'))
+
+from qemu import machine
+
+FAKE_QEMU = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'fake_qemu.py')
+
+
+class MachineLaunch(Test):
+    """
+    Launches several instances of fake_qemu.py at once; no QEMU binary
+    is needed.
+
+    :avocado: tags=quick
+    """
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.vms = []
+
+    def tearDown(self):
+        for vm in self.vms:
+            vm.shutdown()
+        shutil.rmtree(self.test_dir)
+
+    def new_vms(self, *args_list):
+        for args in args_list:
+            vm = machine.QEMUMachine(FAKE_QEMU, args=args,
+                                     wrapper=[sys.executable],
+                                     name='vm%d' % len(self.vms),
+                                     test_dir=self.test_dir)
+            self.vms.append(vm)
+        return self.vms
+
+    def test_concurrent(self):
+        vms = self.new_vms(*[['-x-fake-delay', '0.5']] * 4)
+        start = time.time()
+        timings = machine.launch_many(vms)
+        # The delays overlap instead of adding up
+        self.assertTrue(time.time() - start < 1.5)
+        for vm, timing in zip(vms, timings):
+            self.assertTrue(vm.is_running())
+            self.assertEqual(vm.command('query-status')['status'], 'running')
+            self.assertEqual(timing, vm.get_launch_timing())
+            self.assertTrue(timing['connect'] >= 0.5)
+
+    def test_failure(self):
+        vms = self.new_vms([], ['-x-fake-exit', '1'], [])
+        with self.assertRaises(machine.QEMUMachineLaunchError) as context:
+            machine.launch_many(vms)
+        failures = context.exception.failures
+        self.assertEqual([vm for vm, err in failures], [vms[1]])
+        self.assertIn('exited with code 1', str(failures[0][1]))
+        timings = context.exception.timings
+        self.assertIsNone(timings[1])
+        # The other VMs are left running
+        self.assertTrue(vms[0].is_running())
+        self.assertTrue(vms[2].is_running())
+
+    def test_timeout(self):
+        vms = self.new_vms([], ['-x-fake-delay', '10'])
+        with self.assertRaises(machine.QEMUMachineLaunchError) as context:
+            machine.launch_many(vms, timeout=0.5)
+        failures = context.exception.failures
+        self.assertEqual([vm for vm, err in failures], [vms[1]])
+        self.assertIn('Timeout', str(failures[0][1]))
+        self.assertFalse(vms[1].is_running())
+
+    def test_already_launched(self):
+        vms = self.new_vms([])
+        vms[0].launch()
+        with self.assertRaises(machine.QEMUMachineError):
+            machine.launch_many(vms)
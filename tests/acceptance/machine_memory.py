@@ -0,0 +1,91 @@
+# Check direct guest memory access against a fake QEMU
+#
+# Copyright (c) 2019 Red Hat, Inc.
+#
+# This work is licensed under the terms of the GNU GPL, version 2 or
+# later.  See the COPYING file in the top-level directory.
+
+import binascii
+import os
+import shutil
+import sys
+import tempfile
+
+from avocado import Test
+
+SRC_ROOT_DIR = os.path.join(os.path.dirname(__file__), '..', '..')
+sys.path.append(os.path.join(SRC_ROOT_DIR, 'python'))
+
+from qemu.machine import QEMUMachine, QEMUMachineError
+
+FAKE_QEMU = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'fake_qemu.py')
+
+MiB = 1 << 20
+
+
+class MachineMemory(Test):
+    """
+    Shares guest RAM with fake_qemu.py, which reads and writes it on
+    behalf of the test through QMP; no QEMU binary is needed.
+
+    :avocado: tags=quick
+    """
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.vm = QEMUMachine(FAKE_QEMU, wrapper=[sys.executable],
+                              test_dir=self.test_dir)
+
+    def tearDown(self):
+        self.vm.shutdown()
+        shutil.rmtree(self.test_dir)
+
+    def fake_read(self, offset, size):
+        data = self.vm.command('x-fake-read', offset=offset, size=size)
+        return binascii.unhexlify(data)
+
+    def fake_write(self, offset, data):
+        self.vm.command('x-fake-write', offset=offset,
+                        data=binascii.hexlify(data).decode('ascii'))
+
+    def test_read_write(self):
+        self.vm.set_shared_memory(2 * MiB)
+        self.vm.launch()
+        mem = self.vm.guest_memory()
+        mem.write(0x1000, b'abcd')
+        self.assertEqual(self.fake_read(0x1000, 4), b'abcd')
+        self.fake_write(0x1ffffc, b'wxyz')
+        self.assertEqual(mem.read(0x1ffffc, 4), b'wxyz')
+        mem[0x10:0x12] = b'hi'
+        self.assertEqual(self.fake_read(0x10, 2), b'hi')
+        self.assertEqual(mem[0x1ffffe:], b'yz')
+        view = mem.view(0x20, 4)
+        view[0:4] = b'view'
+        del view
+        self.assertEqual(self.fake_read(0x20, 4), b'view')
+
+    def test_regions(self):
+        # 1 MiB at 0 and 1 MiB at 4 GiB, as on a machine with a PCI hole
+        self.vm.set_shared_memory(2 * MiB, regions=[(0, MiB, 0),
+                                                    (1 << 32, MiB, MiB)])
+        self.vm.launch()
+        mem = self.vm.guest_memory()
+        mem.write(1 << 32, b'high')
+        self.assertEqual(self.fake_read(MiB, 4), b'high')
+        self.assertEqual(len(mem[MiB - 16:]), 16)
+        with self.assertRaises(IndexError):
+            mem.read(MiB - 2, 4)
+        with self.assertRaises(IndexError):
+            mem.read(MiB, 1)
+        with self.assertRaises(IndexError):
+            mem[0:16:2]
+
+    def test_errors(self):
+        with self.assertRaises(QEMUMachineError):
+            self.vm.set_shared_memory(MiB + 4096)
+        with self.assertRaises(QEMUMachineError):
+            self.vm.guest_memory()
+        self.vm.launch()
+        with self.assertRaises(QEMUMachineError):
+            self.vm.guest_memory()
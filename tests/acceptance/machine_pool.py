@@ -0,0 +1,94 @@
+# Check QEMUMachinePool against a fake QEMU
+#
+# Copyright (c) 2019 Red Hat, Inc.
+#
+# This work is licensed under the terms of the GNU GPL, version 2 or
+# later.  See the COPYING file in the top-level directory.
+
+import os
+import shutil
+import sys
+import tempfile
+
+from avocado import Test
+
+SRC_ROOT_DIR = os.path.join(os.path.dirname(__file__), '..', '..')
+sys.path.append(os.path.join(SRC_ROOT_DIR, 'python'))
+
+from qemu.machine import QEMUMachine, QEMUMachineError
+from qemu.pool import QEMUMachinePool
+
+FAKE_QEMU = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'fake_qemu.py')
+
+
+class MachinePool(Test):
+    """
+    Hands out instances of fake_qemu.py from a pool; no QEMU binary is
+    needed.
+
+    :avocado: tags=quick
+    """
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.vms = []
+        # Extra arguments of the VMs to create, the default being none
+        self.vm_args = []
+
+    def tearDown(self):
+        for vm in self.vms:
+            vm.shutdown()
+        shutil.rmtree(self.test_dir)
+
+    def factory(self):
+        args = self.vm_args.pop(0) if self.vm_args else []
+        vm = QEMUMachine(FAKE_QEMU, args=args, wrapper=[sys.executable],
+                         name='vm%d' % len(self.vms), test_dir=self.test_dir)
+        self.vms.append(vm)
+        return vm
+
+    def test_acquire(self):
+        with QEMUMachinePool(self.factory, size=2) as pool:
+            pool.fill()
+            self.assertEqual(len(self.vms), 2)
+            vm = pool.acquire()
+            self.assertIs(vm, self.vms[0])
+            # Paused, and replaced in the pool
+            self.assertEqual(vm.command('query-status')['status'],
+                             'prelaunch')
+            self.assertEqual(len(self.vms), 3)
+            pool.release(vm)
+            self.assertFalse(vm.is_running())
+            stats = pool.get_stats()
+            self.assertEqual(stats['acquired'], 1)
+            self.assertEqual(stats['discarded'], 1)
+            self.assertEqual(stats['failed'], 0)
+        for vm in self.vms:
+            self.assertFalse(vm.is_running())
+
+    def test_recycle(self):
+        with QEMUMachinePool(self.factory, size=1) as pool:
+            vm = pool.acquire()
+            pool.release(vm, recycle=True)
+            self.assertIs(pool.acquire(), vm)
+            stats = pool.get_stats()
+            self.assertEqual(stats['acquired'], 2)
+            self.assertEqual(stats['recycled'], 1)
+            self.assertEqual(stats['discarded'], 0)
+
+    def test_failed_launch(self):
+        self.vm_args = [['-x-fake-exit', '1']]
+        with QEMUMachinePool(self.factory, size=2) as pool:
+            vm = pool.acquire()
+            self.assertIs(vm, self.vms[1])
+            self.assertEqual(pool.get_stats()['failed'], 1)
+            self.assertFalse(self.vms[0].is_running())
+
+    def test_too_many_failures(self):
+        self.vm_args = [['-x-fake-exit', '1']] * 10
+        with QEMUMachinePool(self.factory, size=2) as pool:
+            with self.assertRaises(QEMUMachineError):
+                pool.acquire()
+            self.assertEqual(pool.get_stats()['failed'], 3)
+            self.assertEqual(pool.get_stats()['acquired'], 0)
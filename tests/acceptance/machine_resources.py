@@ -0,0 +1,75 @@
+# Check QEMUResourceSampler against a fake QEMU
+#
+# Copyright (c) 2019 Red Hat, Inc.
+#
+# This work is licensed under the terms of the GNU GPL, version 2 or
+# later.  See the COPYING file in the top-level directory.
+
+import os
+import shutil
+import sys
+import tempfile
+
+from avocado import Test
+
+SRC_ROOT_DIR = os.path.join(os.path.dirname(__file__), '..', '..')
+sys.path.append(os.path.join(SRC_ROOT_DIR, 'python'))
+
+from qemu.machine import QEMUMachine, QEMUMachineError
+
+FAKE_QEMU = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'fake_qemu.py')
+
+
+class MachineResources(Test):
+    """
+    Samples the host resources used by fake_qemu.py while it burns CPU;
+    no QEMU binary is needed.
+
+    :avocado: tags=quick
+    """
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.vm = QEMUMachine(FAKE_QEMU, wrapper=[sys.executable],
+                              test_dir=self.test_dir)
+
+    def tearDown(self):
+        self.vm.shutdown()
+        shutil.rmtree(self.test_dir)
+
+    def test_summary(self):
+        self.vm.launch()
+        with self.vm.resource_sampler(interval=0.1) as sampler:
+            self.vm.command('x-fake-spin', seconds=0.5)
+        summary = sampler.summary()
+        self.assertTrue(summary['samples'] >= 3)
+        self.assertTrue(summary['duration'] >= 0.5)
+        self.assertTrue(summary['cpu'] > 0.1)
+        self.assertTrue(summary['utilization'] > 0)
+        self.assertTrue(summary['rss']['max'] > 0)
+        self.assertTrue(summary['rss']['min'] <= summary['rss']['max'])
+        # The main thread spins, and is reported as vCPU 0
+        main = summary['threads'][self.vm.get_pid()]
+        self.assertEqual(main['vcpu'], 0)
+        self.assertTrue(main['cpu'] > 0.1)
+        samples = sampler.samples('cpu')
+        self.assertEqual(len(samples), summary['samples'])
+        self.assertEqual(list(samples), sorted(samples))
+        for samples in sampler.thread_samples().values():
+            self.assertEqual(len(samples), summary['samples'])
+
+    def test_not_enough_samples(self):
+        self.vm.launch()
+        sampler = self.vm.resource_sampler(interval=60)
+        sampler.start()
+        try:
+            with self.assertRaises(QEMUMachineError):
+                sampler.summary()
+        finally:
+            sampler.stop()
+        self.assertEqual(sampler.summary()['samples'], 2)
+
+    def test_not_running(self):
+        with self.assertRaises(QEMUMachineError):
+            self.vm.resource_sampler().start()
@@ -0,0 +1,94 @@
+# Check QEMUStateSnapshot against a fake QEMU
+#
+# Copyright (c) 2019 Red Hat, Inc.
+#
+# This work is licensed under the terms of the GNU GPL, version 2 or
+# later.  See the COPYING file in the top-level directory.
+
+import os
+import shutil
+import sys
+import tempfile
+
+from avocado import Test
+
+SRC_ROOT_DIR = os.path.join(os.path.dirname(__file__), '..', '..')
+sys.path.append(os.path.join(SRC_ROOT_DIR, 'python'))
+
+from qemu.machine import QEMUMachine, QEMUMachineError
+from qemu.snapshot import QEMUStateSnapshot
+
+FAKE_QEMU = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'fake_qemu.py')
+
+
+class MachineSnapshot(Test):
+    """
+    Saves the state of fake_qemu.py and restores it into new instances;
+    no QEMU binary is needed.
+
+    :avocado: tags=quick
+    """
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.test_dir, 'vm.state')
+        self.vms = []
+        self.setups = 0
+        # Extra arguments of the VMs to create
+        self.vm_args = []
+
+    def tearDown(self):
+        for vm in self.vms:
+            vm.shutdown()
+        shutil.rmtree(self.test_dir)
+
+    def factory(self):
+        vm = QEMUMachine(FAKE_QEMU, args=list(self.vm_args),
+                         wrapper=[sys.executable],
+                         name='vm%d' % len(self.vms), test_dir=self.test_dir)
+        self.vms.append(vm)
+        return vm
+
+    def setup(self, vm):
+        self.setups += 1
+        vm.command('x-fake-set', key='booted', value=True)
+
+    def test_restore(self):
+        snapshot = QEMUStateSnapshot(self.factory, self.path, self.setup)
+        self.assertEqual(snapshot.path, self.path)
+        vm = snapshot.restore()
+        self.assertTrue(os.path.exists(self.path))
+        # The VM that was set up is gone
+        self.assertFalse(self.vms[0].is_running())
+        self.assertIs(vm, self.vms[1])
+        self.assertEqual(vm.command('query-status')['status'], 'running')
+        self.assertTrue(vm.command('x-fake-get', key='booted'))
+        vm = snapshot.restore(paused=True)
+        self.assertEqual(vm.command('query-status')['status'], 'paused')
+        self.assertTrue(vm.command('x-fake-get', key='booted'))
+        self.assertEqual(self.setups, 1)
+        self.assertEqual([name for name in os.listdir(self.test_dir)
+                          if name.startswith('vm.state')], ['vm.state'])
+
+    def test_existing_file(self):
+        QEMUStateSnapshot(self.factory, self.path, self.setup).create()
+        self.assertEqual(self.setups, 1)
+        # Another instance, as in another test process, reuses the file
+        snapshot = QEMUStateSnapshot(self.factory, self.path, self.setup)
+        vm = snapshot.restore()
+        self.assertTrue(vm.command('x-fake-get', key='booted'))
+        self.assertEqual(self.setups, 1)
+        snapshot.remove()
+        self.assertFalse(os.path.exists(self.path))
+        snapshot.remove()
+
+    def test_failed_save(self):
+        self.vm_args = ['-x-fake-migrate-fail', 'on']
+        snapshot = QEMUStateSnapshot(self.factory, self.path, self.setup)
+        with self.assertRaises(QEMUMachineError):
+            snapshot.restore()
+        self.assertFalse(self.vms[0].is_running())
+        # Neither the snapshot nor its temporary file are left behind
+        self.assertEqual([name for name in os.listdir(self.test_dir)
+                          if name.startswith('vm.state')], [])
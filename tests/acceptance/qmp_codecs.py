@@ -0,0 +1,94 @@
+# Check the QMP JSON codecs against a fake QEMU
+#
+# Copyright (c) 2019 Red Hat, Inc.
+#
+# This work is licensed under the terms of the GNU GPL, version 2 or
+# later.  See the COPYING file in the top-level directory.
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from avocado import Test
+
+SRC_ROOT_DIR = os.path.join(os.path.dirname(__file__), '..', '..')
+sys.path.append(os.path.join(SRC_ROOT_DIR, 'python'))
+
+from qemu import qmp
+
+FAKE_QEMU = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'fake_qemu.py')
+
+
+class QMPCodecs(Test):
+    """
+    Encodes and decodes QMP messages with every codec available, and
+    talks to fake_qemu.py with them; no QEMU binary is needed.
+
+    :avocado: tags=quick
+    """
+
+    MESSAGE = {'execute': 'blockdev-add',
+               'arguments': {'node-name': u'disk\u00e9', 'size': 1 << 40,
+                             'read-only': False, 'opts': [1, None, 'x']}}
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.proc = None
+
+    def tearDown(self):
+        if self.proc is not None:
+            self.proc.kill()
+            self.proc.wait()
+        shutil.rmtree(self.test_dir)
+
+    def connect(self, codec):
+        path = os.path.join(self.test_dir, 'qmp.sock')
+        monitor = qmp.QEMUMonitorProtocol(path, server=True, codec=codec)
+        self.proc = subprocess.Popen([sys.executable, FAKE_QEMU, '-chardev',
+                                      'socket,id=mon,path=%s' % path])
+        monitor.accept()
+        os.unlink(path)
+        return monitor
+
+    def test_round_trip(self):
+        for codec_class in qmp.available_codecs():
+            codec = codec_class()
+            data = codec.dumps(self.MESSAGE)
+            self.assertIsInstance(data, bytes)
+            self.assertEqual(codec.loads(data), self.MESSAGE)
+            # Every codec reads what the others write
+            self.assertEqual(qmp.QMPCodec().loads(data), self.MESSAGE)
+
+    def test_get_codec(self):
+        self.assertIs(type(qmp.get_codec()), qmp.QMPCodec)
+        self.assertIs(type(qmp.get_codec('json')), qmp.QMPCodec)
+        self.assertIs(type(qmp.get_codec('fastest')),
+                      qmp.available_codecs()[0])
+        self.assertIs(qmp.available_codecs()[-1], qmp.QMPCodec)
+        with self.assertRaises(qmp.QMPError):
+            qmp.get_codec('no-such-codec')
+
+    def test_commands(self):
+        for codec_class in qmp.available_codecs():
+            monitor = self.connect(codec_class())
+            try:
+                self.assertEqual(monitor.cmd('query-status')['return'],
+                                 {'status': 'running', 'running': True})
+            finally:
+                monitor.close()
+                self.proc.wait()
+                self.proc = None
+
+    def test_cmd_raw(self):
+        monitor = self.connect(qmp.get_codec('fastest'))
+        try:
+            reply = monitor.cmd_raw(b'{"execute": "x-fake-emit", '
+                                    b'"arguments": {"events": '
+                                    b'[{"event": "STOP"}]}}')
+            self.assertEqual(reply, b'{"return": {}}\n')
+            self.assertEqual(monitor.pull_event()['event'], 'STOP')
+        finally:
+            monitor.close()
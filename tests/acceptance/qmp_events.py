@@ -0,0 +1,102 @@
+# Check QMP event reading against a scripted monitor
+#
+# Copyright (c) 2019 Red Hat, Inc.
+#
+# This work is licensed under the terms of the GNU GPL, version 2 or
+# later.  See the COPYING file in the top-level directory.
+
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+from avocado import Test
+
+SRC_ROOT_DIR = os.path.join(os.path.dirname(__file__), '..', '..')
+sys.path.append(os.path.join(SRC_ROOT_DIR, 'python'))
+
+from qemu import qmp
+
+
+class QMPEvents(Test):
+    """
+    Reads events sent by a fake monitor in awkward chunks; no QEMU
+    binary is needed.
+
+    :avocado: tags=quick
+    """
+
+    def setUp(self):
+        self.sock_dir = tempfile.mkdtemp()
+        self.sock_path = os.path.join(self.sock_dir, 'qmp.sock')
+        self.qmp = qmp.QEMUMonitorProtocol(self.sock_path, server=True)
+        self.script = None
+        self.thread = None
+
+    def tearDown(self):
+        self.qmp.close()
+        if self.thread is not None:
+            self.thread.join()
+        os.unlink(self.sock_path)
+        os.rmdir(self.sock_dir)
+
+    def _monitor(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.sock_path)
+        try:
+            sock.sendall(b'{"QMP": {"version": {}, "capabilities": []}}\n')
+            sock.recv(4096)
+            sock.sendall(b'{"return": {}}\n')
+            for delay, data in self.script:
+                if data is None:
+                    sock.recv(4096)
+                else:
+                    time.sleep(delay)
+                    sock.sendall(data)
+            sock.recv(4096)
+        finally:
+            sock.close()
+
+    def start(self, script):
+        """
+        Connect to a fake monitor playing @script, a list of (delay, data)
+        tuples, data being None to wait for a command.
+        """
+        self.script = script
+        self.thread = threading.Thread(target=self._monitor)
+        self.thread.daemon = True
+        self.thread.start()
+        self.qmp.accept()
+
+    def test_event_with_reply(self):
+        self.start([(0, None),
+                    (0, b'{"return": {}}\n'
+                        b'{"event": "STOP", "timestamp": {}}\n')])
+        self.assertEqual(self.qmp.cmd('stop'), {'return': {}})
+        event = self.qmp.pull_event(wait=0.5)
+        self.assertEqual(event['event'], 'STOP')
+
+    def test_events_with_reply(self):
+        self.start([(0, None),
+                    (0, b'{"return": {}}\n'
+                        b'{"event": "STOP", "timestamp": {}}\n'
+                        b'{"event": "RESUME", "timestamp": {}}\n')])
+        self.qmp.cmd('stop')
+        events = self.qmp.get_events(wait=0.5)
+        self.assertEqual([e['event'] for e in events], ['STOP', 'RESUME'])
+
+    def test_split_event(self):
+        self.start([(0, b'{"event": "ST'),
+                    (0.2, b'OP", "timestamp": {}}\n')])
+        event = self.qmp.pull_event(wait=2.0)
+        self.assertEqual(event['event'], 'STOP')
+
+    def test_wait_after_timeout(self):
+        self.start([(0, b'{"event": "ST'),
+                    (0.5, b'OP", "timestamp": {}}\n')])
+        with self.assertRaises(qmp.QMPTimeoutError):
+            self.qmp.pull_event(wait=0.1)
+        event = self.qmp.pull_event(wait=2.0)
+        self.assertEqual(event['event'], 'STOP')
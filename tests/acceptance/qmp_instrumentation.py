@@ -0,0 +1,85 @@
+# Check QMP latency instrumentation against a fake QEMU
+#
+# Copyright (c) 2019 Red Hat, Inc.
+#
+# This work is licensed under the terms of the GNU GPL, version 2 or
+# later.  See the COPYING file in the top-level directory.
+
+import os
+import shutil
+import sys
+import tempfile
+
+from avocado import Test
+
+SRC_ROOT_DIR = os.path.join(os.path.dirname(__file__), '..', '..')
+sys.path.append(os.path.join(SRC_ROOT_DIR, 'python'))
+
+from qemu import qmp
+from qemu.machine import QEMUMachine
+
+FAKE_QEMU = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'fake_qemu.py')
+
+
+class QMPInstrumentation(Test):
+    """
+    Records the commands and events of fake_qemu.py; no QEMU binary is
+    needed.
+
+    :avocado: tags=quick
+    """
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.recorder = qmp.QMPLatencyRecorder()
+        self.vm = QEMUMachine(FAKE_QEMU, wrapper=[sys.executable],
+                              test_dir=self.test_dir)
+        self.vm.set_qmp_instrumentation(self.recorder)
+        self.vm.launch()
+
+    def tearDown(self):
+        self.vm.shutdown()
+        shutil.rmtree(self.test_dir)
+
+    def test_commands(self):
+        for i in range(3):
+            self.vm.command('query-status')
+        commands = self.recorder.summary()['commands']
+        self.assertEqual(commands['qmp_capabilities']['count'], 1)
+        stats = commands['query-status']
+        self.assertEqual(stats['count'], 3)
+        self.assertTrue(0 <= stats['min'] <= stats['mean'] <= stats['max'])
+        self.assertTrue(stats['mean-first-byte'] <= stats['mean'])
+        self.assertTrue(stats['p50'] <= stats['p99'])
+        self.assertEqual(sum(stats['histogram'].values()), 3)
+        self.assertTrue(stats['reply-bytes'] > 0)
+
+    def test_events(self):
+        self.vm.command('x-fake-emit',
+                        events=[{'event': 'STOP'}, {'event': 'STOP'},
+                                {'event': 'RESUME'}])
+        events = self.recorder.summary()['events']
+        self.assertEqual(events['STOP']['count'], 2)
+        self.assertEqual(events['RESUME']['count'], 1)
+        self.assertIsNone(events['RESUME']['rate'])
+        self.assertTrue(events['STOP']['bytes'] > 0)
+
+    def test_disable_and_reset(self):
+        self.recorder.reset()
+        self.vm.set_qmp_instrumentation(None)
+        self.vm.command('query-status')
+        self.assertEqual(self.recorder.summary(),
+                         {'commands': {}, 'events': {}})
+
+    def test_histogram(self):
+        recorder = qmp.QMPLatencyRecorder()
+        # 300 us nine times, then 3 ms
+        for i in range(9):
+            recorder.command('stop', 1.0, 1.0001, 1.0003, 16)
+        recorder.command('stop', 2.0, 2.001, 2.003, 16)
+        stats = recorder.summary()['commands']['stop']
+        self.assertEqual(stats['histogram'], {512: 9, 4096: 1})
+        self.assertEqual(stats['p50'], 0.000512)
+        self.assertEqual(stats['p99'], 0.004096)
+        self.assertEqual(stats['reply-bytes'], 160)
@@ -0,0 +1,129 @@
+# Check pipelined qtest commands and the bulk memory helpers against a
+# scripted qtest peer
+#
+# Copyright (c) 2019 Red Hat, Inc.
+#
+# This work is licensed under the terms of the GNU GPL, version 2 or
+# later.  See the COPYING file in the top-level directory.
+
+import base64
+import os
+import socket
+import sys
+import tempfile
+import threading
+
+from avocado import Test
+
+SRC_ROOT_DIR = os.path.join(os.path.dirname(__file__), '..', '..')
+sys.path.append(os.path.join(SRC_ROOT_DIR, 'python'))
+
+from qemu import qtest
+
+
+class QtestMemory(Test):
+    """
+    Moves guest memory through a fake qtest peer holding it in a
+    bytearray; no QEMU binary is needed.
+
+    :avocado: tags=quick
+    """
+
+    MEMORY_SIZE = 64 * 1024
+
+    def setUp(self):
+        self.sock_dir = tempfile.mkdtemp()
+        self.sock_path = os.path.join(self.sock_dir, 'qtest.sock')
+        self.memory = bytearray(self.MEMORY_SIZE)
+        self.qtest = qtest.QEMUQtestProtocol(self.sock_path, server=True)
+        # Small chunks, so that transfers span several chunks and batches
+        self.qtest.mem_chunk_size = 1000
+        self.qtest.mem_batch_size = 4
+        self.thread = threading.Thread(target=self._peer)
+        self.thread.daemon = True
+        self.thread.start()
+        self.qtest.accept()
+
+    def tearDown(self):
+        self.qtest.close()
+        self.thread.join()
+        os.unlink(self.sock_path)
+        os.rmdir(self.sock_dir)
+
+    def _reply(self, line):
+        words = line.split()
+        if words[0] == 'b64read':
+            addr, size = int(words[1], 0), int(words[2], 0)
+            data = base64.b64encode(bytes(self.memory[addr:addr + size]))
+            return b'OK ' + data
+        elif words[0] == 'b64write':
+            addr, size = int(words[1], 0), int(words[2], 0)
+            self.memory[addr:addr + size] = base64.b64decode(words[3])
+        elif words[0] == 'memset':
+            addr, size = int(words[1], 0), int(words[2], 0)
+            self.memory[addr:addr + size] = bytearray([int(words[3], 0)]) * size
+        elif words[0] == 'irq':
+            # Not a qtest command, but a way to get an IRQ notification
+            # in the middle of the replies
+            return b'IRQ raise ' + words[1].encode('ascii') + b'\nOK'
+        else:
+            return b'FAIL unknown command'
+        return b'OK'
+
+    def _peer(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.sock_path)
+        buf = b''
+        try:
+            while True:
+                data = sock.recv(65536)
+                if not data:
+                    break
+                buf += data
+                lines = buf.split(b'\n')
+                buf = lines.pop()
+                replies = [self._reply(line.decode('ascii')) + b'\n'
+                           for line in lines]
+                sock.sendall(b''.join(replies))
+        finally:
+            sock.close()
+
+    def test_write_read(self):
+        data = bytearray(os.urandom(10000))
+        self.qtest.memwrite(100, data)
+        self.assertEqual(self.memory[100:10100], data)
+        self.assertEqual(self.qtest.memread(100, len(data)), data)
+
+    def test_memset(self):
+        self.qtest.memset(10, 5000, 0x5a)
+        self.assertEqual(self.qtest.memread(0, 5020),
+                         bytearray(10) + bytearray(b'Z') * 5000 +
+                         bytearray(10))
+
+    def test_memcmp(self):
+        data = bytearray(os.urandom(10000))
+        self.qtest.memwrite(0, data)
+        self.assertIsNone(self.qtest.memcmp(0, bytes(data)))
+        # In the third chunk, neither at its start nor at its end
+        data[2345] ^= 0xff
+        self.assertEqual(self.qtest.memcmp(0, bytes(data)), 2345)
+        data[7] ^= 0xff
+        self.assertEqual(self.qtest.memcmp(0, memoryview(data)), 7)
+
+    def test_batch(self):
+        # Far more replies than fit in the socket buffers
+        replies = self.qtest.cmd_batch(['b64read 0x0 0x400'] * 2000)
+        self.assertEqual(len(replies), 2000)
+        zeros = base64.b64encode(b'\0' * 0x400).decode('ascii')
+        self.assertEqual(set(replies), set(['OK %s\n' % zeros]))
+
+    def test_batch_irqs(self):
+        replies = self.qtest.cmd_batch(['irq 3', 'bogus', 'irq 4'])
+        self.assertEqual(replies, ['OK\n', 'FAIL unknown command\n', 'OK\n'])
+        self.assertEqual(self.qtest.get_irqs(),
+                         ['IRQ raise 3\n', 'IRQ raise 4\n'])
+        self.assertEqual(self.qtest.get_irqs(), [])
+
+    def test_short_read(self):
+        with self.assertRaises(qtest.QEMUQtestError):
+            self.qtest.memread(self.MEMORY_SIZE - 10, 100)
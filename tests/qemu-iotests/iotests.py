@@ -17,9 +17,11 @@ from __future__ import print_function
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import codecs
 import errno
 import os
 import re
+import select
 import subprocess
 import string
 import unittest
@@ -28,6 +30,7 @@ import struct
 import json
 import signal
 import logging
+import time
 import atexit
 import io
 from collections import OrderedDict
@@ -169,43 +172,157 @@ def get_virtio_scsi_device():
         return 'virtio-scsi-ccw'
     return 'virtio-scsi-pci'
 
+class QemuIoTimeoutError(Exception):
+    '''Raised when qemu-io does not complete a command in time'''
+
 class QemuIoInteractive:
+    prompt = b'qemu-io> '
+    chunk_size = 65536
+
     def __init__(self, *args):
         self.args = qemu_io_args + list(args)
         self._p = subprocess.Popen(self.args, stdin=subprocess.PIPE,
                                    stdout=subprocess.PIPE,
-                                   stderr=subprocess.STDOUT,
-                                   universal_newlines=True)
-        assert self._p.stdout.read(9) == 'qemu-io> '
+                                   stderr=subprocess.STDOUT)
+        self._buf = bytearray()
+        assert self._read_output() == ''
 
     def close(self):
-        self._p.communicate('q\n')
-
-    def _read_output(self):
-        pattern = 'qemu-io> '
-        n = len(pattern)
-        pos = 0
-        s = []
-        while pos != n:
-            c = self._p.stdout.read(1)
+        self._p.communicate(b'q\n')
+
+    def _read_output(self, callback=None, timeout=None):
+        '''Read the output up to the next prompt and return it.  If
+        callback is given, pass it the output piece by piece as it arrives
+        and return an empty string instead.'''
+        fd = self._p.stdout.fileno()
+        n = len(self.prompt)
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        if timeout is not None:
+            deadline = time.time() + timeout
+        buf = self._buf
+        start = 0
+        while True:
+            pos = buf.find(self.prompt, start)
+            if pos >= 0:
+                break
+            # The end of the buffer may be the start of the prompt
+            start = max(len(buf) - n + 1, 0)
+            if callback is not None and start > 0:
+                callback(decoder.decode(bytes(buf[:start])))
+                del buf[:start]
+                start = 0
+            if timeout is not None:
+                remaining = deadline - time.time()
+                readable = remaining > 0 and \
+                    select.select([fd], [], [], remaining)[0]
+                if not readable:
+                    raise QemuIoTimeoutError('Timeout waiting for qemu-io '
+                                             'prompt')
+            data = os.read(fd, self.chunk_size)
             # check unexpected EOF
-            assert c != ''
-            s.append(c)
-            if c == pattern[pos]:
-                pos += 1
-            else:
-                pos = 0
-
-        return ''.join(s[:-n])
+            assert data != b''
+            buf += data
+
+        output = decoder.decode(bytes(buf[:pos]), True)
+        self._buf = buf[pos + n:]
+        if callback is not None:
+            if output:
+                callback(output)
+            return ''
+        return output
 
-    def cmd(self, cmd):
+    def cmd(self, cmd, callback=None, timeout=None):
+        '''Run a command and return its output; see _read_output() for
+        callback.  timeout is in seconds, None waiting forever; after
+        QemuIoTimeoutError is raised the session is out of step and should
+        be closed.'''
         # quit command is in close(), '\n' is added automatically
         assert '\n' not in cmd
         cmd = cmd.strip()
         assert cmd != 'q' and cmd != 'quit'
-        self._p.stdin.write(cmd + '\n')
+        self._p.stdin.write(cmd.encode('utf-8') + b'\n')
         self._p.stdin.flush()
-        return self._read_output()
+        return self._read_output(callback, timeout)
+
+    # Commands are sent in groups of at most that many bytes, so that
+    # writing never blocks while qemu-io waits for its output to be read
+    batch_size = 4096
+
+    def cmds(self, cmds):
+        '''Run several commands, sending them ahead of the replies, and
+        return the list of their outputs'''
+        outputs = []
+        batch = []
+        size = 0
+        for cmd in cmds:
+            assert '\n' not in cmd
+            cmd = cmd.strip()
+            assert cmd != 'q' and cmd != 'quit'
+            if batch and size + len(cmd) + 1 > self.batch_size:
+                outputs += self._run_batch(batch)
+                batch = []
+                size = 0
+            batch.append(cmd)
+            size += len(cmd) + 1
+        if batch:
+            outputs += self._run_batch(batch)
+        return outputs
+
+    def _run_batch(self, batch):
+        data = ''.join(cmd + '\n' for cmd in batch)
+        self._p.stdin.write(data.encode('utf-8'))
+        self._p.stdin.flush()
+        return [self._read_output() for _ in batch]
+
+
+class QemuIoSessions:
+    '''Persistent qemu-io processes, one per image and set of options
+
+    qemu_io_cached() runs the -c commands of a qemu-io command line in a
+    process that is started on first use and kept open, which saves the
+    process startup and image open costs when a test runs many of them
+    on the same image.  The image stays open in between, so close() must
+    be called before anything else writes to it or locks it.
+    '''
+
+    def __init__(self):
+        self._sessions = OrderedDict()
+
+    def get(self, *args):
+        '''Return the QemuIoInteractive session opened with args'''
+        session = self._sessions.get(args)
+        if session is None:
+            session = QemuIoInteractive(*args)
+            self._sessions[args] = session
+        return session
+
+    def run(self, *args):
+        '''Run qemu-io arguments, including -c commands, in a session and
+        return the output of all the commands'''
+        cmds = []
+        open_args = []
+        args = list(args)
+        while args:
+            arg = args.pop(0)
+            if arg in ('-c', '--cmd'):
+                cmds.append(args.pop(0))
+            else:
+                open_args.append(arg)
+        return ''.join(self.get(*open_args).cmds(cmds))
+
+    def close(self, filename=None):
+        '''Close the sessions that use filename, or all of them'''
+        for args in list(self._sessions):
+            if filename is None or filename in args:
+                self._sessions.pop(args).close()
+
+qemu_io_sessions = QemuIoSessions()
+atexit.register(qemu_io_sessions.close)
+
+def qemu_io_cached(*args):
+    '''Like qemu_io(), but run the commands in a persistent qemu-io
+    process; see QemuIoSessions'''
+    return qemu_io_sessions.run(*args)
 
 
 def qemu_nbd(*args):
@@ -23,6 +23,7 @@ import datetime
 sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..', 'python'))
 from qemu import kvm_available
 from qemu.machine import QEMUMachine
+from qemu.console import ConsoleTimeoutError
 import subprocess
 import hashlib
 import optparse
@@ -209,35 +210,30 @@ class BaseVM(object):
 
     def console_wait(self, expect, expectalt = None):
         vm = self._guest
-        output = ""
-        while True:
-            try:
-                chars = vm.console_socket.recv(1)
-            except socket.timeout:
-                sys.stderr.write("console: *** read timeout ***\n")
-                sys.stderr.write("console: waiting for: '%s'\n" % expect)
-                if not expectalt is None:
-                    sys.stderr.write("console: waiting for: '%s' (alt)\n" % expectalt)
-                sys.stderr.write("console: line buffer:\n")
-                sys.stderr.write("\n")
-                self.console_log(output.rstrip())
-                sys.stderr.write("\n")
-                raise
-            output += chars.decode("latin1")
-            if expect in output:
-                break
-            if not expectalt is None and expectalt in output:
-                break
-            if "\r" in output or "\n" in output:
-                lines = re.split("[\r\n]", output)
-                output = lines.pop()
-                if self.debug:
-                    self.console_log("\n".join(lines))
+        patterns = [expect.encode("latin1")]
+        if not expectalt is None:
+            patterns.append(expectalt.encode("latin1"))
         if self.debug:
-            self.console_log(output)
-        if not expectalt is None and expectalt in output:
-            return False
-        return True
+            console = vm.console_reader(line_callback=self.console_log,
+                                        encoding="latin1")
+        else:
+            console = vm.console_reader()
+        try:
+            # The console timeout applies to each read, so that installers
+            # printing progress for a long time are not interrupted
+            index, _ = console.wait_for(
+                patterns, idle_timeout=vm.console_socket.gettimeout())
+        except ConsoleTimeoutError:
+            sys.stderr.write("console: *** read timeout ***\n")
+            sys.stderr.write("console: waiting for: '%s'\n" % expect)
+            if not expectalt is None:
+                sys.stderr.write("console: waiting for: '%s' (alt)\n" % expectalt)
+            sys.stderr.write("console: line buffer:\n")
+            sys.stderr.write("\n")
+            self.console_log(console.tail().decode("latin1").rstrip())
+            sys.stderr.write("\n")
+            raise socket.timeout("timed out")
+        return index == 0
 
     def console_send(self, command):
         vm = self._guest